@@ -0,0 +1,546 @@
+"""Benchmark the throughput and peak memory of SequenceAlignment operations
+
+Synthetic inputs are generated in a working directory. The stand-in
+executables in ``shims/`` are placed first on the PATH so that ``samtools``,
+``bwa`` and ``bedtools`` pass data through at a known rate (see
+``--tool-mbps``) and the timings reflect the overhead of seqalign itself.
+Each benchmark runs in a fresh interpreter so that its peak RSS is measured
+independently.
+
+Usage::
+
+    python3 benchmarks/bench.py --records 200000 --reads 100000
+    python3 benchmarks/bench.py --only sort index --json results.json
+"""
+
+
+
+
+# Imports ======================================================================
+
+import argparse
+import json
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARKS_DIR)
+SHIMS_DIR = os.path.join(BENCHMARKS_DIR, 'shims')
+
+sys.path[:0] = [REPOSITORY_DIR, BENCHMARKS_DIR]
+
+import synthetic
+
+from seqalign import (
+    SequenceAlignment, BWA, RemoveDuplicates, get_median_read_length, merge
+)
+
+
+
+
+# Constants ====================================================================
+
+REFERENCE_PATH = 'reference.fa'
+
+
+
+
+# Functions ====================================================================
+
+def generate_inputs(directory, records, reads, read_length, seed=0):
+    """Generate synthetic inputs for the benchmarks
+    
+    Parameters
+    ----------
+    directory : str
+        directory in which to write the inputs
+    records : int
+        number of records in the BAM inputs
+    reads : int
+        number of reads in each FASTQ input
+    read_length : int
+        length of each read
+    seed : int
+        random seed
+    
+    Returns
+    -------
+    dict
+        paths to the generated inputs
+    """
+    
+    inputs = {
+        name: os.path.join(directory, file_name)
+        for name, file_name in (
+            ('bam', 'sorted.bam'),
+            ('bam2', 'sorted2.bam'),
+            ('reads1', 'reads_R1.fastq.gz'),
+            ('reads2', 'reads_R2.fastq.gz'),
+            ('blacklist', 'blacklist.bed'),
+            ('positions', 'positions.txt'),
+            ('reference', REFERENCE_PATH)
+        )
+    }
+    for name, n_seed in (('bam', seed), ('bam2', seed + 1)):
+        with open(inputs[name], 'wb') as f:
+            f.write(
+                synthetic.generate_bam(
+                    records,
+                    read_length=read_length,
+                    seed=n_seed
+                )
+            )
+    for name, n_seed in (('reads1', seed), ('reads2', seed + 1)):
+        synthetic.write_fastq(
+            inputs[name],
+            reads,
+            read_length=read_length,
+            seed=n_seed
+        )
+    synthetic.write_bed(inputs['blacklist'], 1000, seed=seed)
+    synthetic.write_positions(inputs['positions'], 1000, seed=seed)
+    with open(inputs['reference'], 'w') as f:
+        f.write('>chrM\nACGT\n')
+    return inputs
+
+
+def bench_view_filters(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'])
+    def run():
+        sa.remove_unpaired_reads()
+        sa.remove_supplementary_alignments()
+        sa.apply_quality_filter()
+    return run, inputs['bam']
+
+
+def bench_lazy_filters(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'], lazy=True)
+    def run():
+        sa.remove_unpaired_reads()
+        sa.remove_supplementary_alignments()
+        sa.apply_quality_filter()
+        sa.bam
+    return run, inputs['bam']
+
+
+def bench_sort(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'])
+    return sa.samtools_sort, inputs['bam']
+
+
+def bench_sort_index(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'])
+    return lambda: sa.samtools_sort(index=True), inputs['bam']
+
+
+def sorted_alignment(inputs):
+    sa = SequenceAlignment(inputs['bam'])
+    sa.is_sorted = True
+    return sa
+
+
+def bench_index(inputs, output_dir):
+    return sorted_alignment(inputs).samtools_index, inputs['bam']
+
+
+def indexed(inputs):
+    sa = sorted_alignment(inputs)
+    sa.samtools_index()
+    return sa
+
+
+def bench_idxstats(inputs, output_dir):
+    return indexed(inputs).idxstats, inputs['bam']
+
+
+def bench_percent_mitochondrial(inputs, output_dir):
+    return indexed(inputs).percent_mitochondrial, inputs['bam']
+
+
+def bench_restrict_chromosomes(inputs, output_dir):
+    sa = indexed(inputs)
+    return (
+        lambda: sa.restrict_chromosomes(*range(1, 23), 'X', 'Y'),
+        inputs['bam']
+    )
+
+
+def bench_fetch_region(inputs, output_dir):
+    sa = indexed(inputs)
+    return (
+        lambda: sum(1 for _ in sa.fetch('chr1:1000000-2000000')),
+        inputs['bam']
+    )
+
+
+def bench_blacklist(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'])
+    return (
+        lambda: sa.percent_blacklisted(inputs['blacklist'], remove=True),
+        inputs['bam']
+    )
+
+
+def bench_remove_duplicates(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'], dedupper=RemoveDuplicates())
+    return sa.remove_duplicates, inputs['bam']
+
+
+def bench_fixmate(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'])
+    return sa.samtools_fixmate, inputs['bam']
+
+
+def bench_mpileup(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'])
+    return (
+        lambda: sa.samtools_mpileup(
+            inputs['positions'],
+            reference_genome=inputs['reference']
+        ),
+        inputs['bam']
+    )
+
+
+def bench_write(inputs, output_dir):
+    sa = SequenceAlignment(inputs['bam'])
+    return (
+        lambda: sa.write(os.path.join(output_dir, 'written.bam')),
+        inputs['bam']
+    )
+
+
+def bench_merge(inputs, output_dir):
+    sa1 = SequenceAlignment(inputs['bam'])
+    sa2 = SequenceAlignment(inputs['bam2'])
+    return lambda: merge(sa1, sa2), inputs['bam'], inputs['bam2']
+
+
+def bench_merge_many(inputs, output_dir):
+    with open(inputs['bam'], 'rb') as f:
+        bam = f.read()
+    sequence_alignments = [SequenceAlignment(bam) for _ in range(40)]
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (64, hard_limit))
+    return lambda: merge(*sequence_alignments), *(inputs['bam'],) * 40
+
+
+def bench_median_read_length(inputs, output_dir):
+    return (
+        lambda: get_median_read_length(
+            (inputs['reads1'], inputs['reads2']),
+            int(1e6)
+        ),
+        inputs['reads1'],
+        inputs['reads2']
+    )
+
+
+def bench_align(inputs, output_dir):
+    return (
+        lambda: SequenceAlignment(
+            (inputs['reads1'], inputs['reads2']),
+            aligner=BWA(inputs['reference'], algorithm='mem')
+        ),
+        inputs['reads1'],
+        inputs['reads2']
+    )
+
+
+def bench_pipeline(inputs, output_dir):
+    sa = SequenceAlignment(
+        (inputs['reads1'], inputs['reads2']),
+        aligner=BWA(inputs['reference'], algorithm='mem'),
+        lazy=True
+    )
+    return (
+        lambda: (
+            sa.pipeline()
+            .samtools_sort(by_name=True)
+            .samtools_fixmate('-r', '-m')
+            .samtools_sort()
+            .samtools_markdup(remove=True)
+            .apply_quality_filter()
+            .run(os.path.join(output_dir, 'pipeline.bam'))
+        ),
+        inputs['reads1'],
+        inputs['reads2']
+    )
+
+
+def bench_readme(inputs, output_dir):
+    def run():
+        with SequenceAlignment(inputs['bam']) as sa:
+            sa.cleans_up_bam = False
+            sa.remove_supplementary_alignments()
+            sa.samtools_sort(memory_limit=10)
+            sa.samtools_index()
+            sa.write(os.path.join(output_dir, 'readme.bam'))
+    return run, inputs['bam']
+
+
+BENCHMARKS = {
+    'view_filters': bench_view_filters,
+    'lazy_filters': bench_lazy_filters,
+    'sort': bench_sort,
+    'sort_index': bench_sort_index,
+    'index': bench_index,
+    'idxstats': bench_idxstats,
+    'percent_mitochondrial': bench_percent_mitochondrial,
+    'restrict_chromosomes': bench_restrict_chromosomes,
+    'fetch_region': bench_fetch_region,
+    'blacklist': bench_blacklist,
+    'remove_duplicates': bench_remove_duplicates,
+    'fixmate': bench_fixmate,
+    'mpileup': bench_mpileup,
+    'write': bench_write,
+    'merge': bench_merge,
+    'merge_many': bench_merge_many,
+    'median_read_length': bench_median_read_length,
+    'align': bench_align,
+    'pipeline': bench_pipeline,
+    'readme': bench_readme
+}
+
+
+def peak_rss(who):
+    """Peak resident set size in bytes
+    
+    Parameters
+    ----------
+    who : int
+        resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+    
+    Returns
+    -------
+    int
+        the peak RSS
+    """
+    
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def run_one(name, inputs, output_dir, repeat=1):
+    """Run a single benchmark in this process
+    
+    Parameters
+    ----------
+    name : str
+        name of the benchmark
+    inputs : dict
+        paths to the generated inputs
+    output_dir : str
+        directory for output files
+    repeat : int
+        number of times to run the operation, each after a fresh setup
+    
+    Returns
+    -------
+    dict
+        input bytes, best wall time, throughput and peak RSS
+    """
+    
+    times = []
+    for _ in range(repeat):
+        operation, *input_paths = BENCHMARKS[name](inputs, output_dir)
+        start = time.perf_counter()
+        operation()
+        times.append(time.perf_counter() - start)
+    n_bytes = sum(os.path.getsize(path) for path in input_paths)
+    return {
+        'benchmark': name,
+        'input_bytes': n_bytes,
+        'seconds': min(times),
+        'mb_per_second': n_bytes / min(times) / 1e6,
+        'peak_rss_self': peak_rss(resource.RUSAGE_SELF),
+        'peak_rss_children': peak_rss(resource.RUSAGE_CHILDREN)
+    }
+
+
+def run_isolated(name, inputs_path, output_dir, repeat=1, tool_mbps=500):
+    """Run a single benchmark in a fresh interpreter with the shims on the
+    PATH
+    
+    Parameters
+    ----------
+    name : str
+        name of the benchmark
+    inputs_path : str
+        path to a JSON file listing the generated inputs
+    output_dir : str
+        directory for output files
+    repeat : int
+        number of times to run the operation
+    tool_mbps : float
+        throughput of the shims, in MB/s
+    
+    Returns
+    -------
+    dict
+        the benchmark result
+    """
+    
+    env = dict(
+        os.environ,
+        PATH=os.pathsep.join((SHIMS_DIR, os.environ.get('PATH', ''))),
+        PYTHONPATH=os.pathsep.join(
+            path for path in (
+                REPOSITORY_DIR,
+                BENCHMARKS_DIR,
+                os.environ.get('PYTHONPATH')
+            ) if path
+        ),
+        SEQALIGN_BENCH_MBPS=str(tool_mbps)
+    )
+    completed = subprocess.run(
+        (
+            sys.executable, os.path.abspath(__file__),
+            '--run-one', name,
+            '--inputs', inputs_path,
+            '--output-dir', output_dir,
+            '--repeat', str(repeat)
+        ),
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        check=True
+    )
+    return json.loads(completed.stdout)
+
+
+def format_table(results):
+    """Format benchmark results as a text table
+    
+    Parameters
+    ----------
+    results
+        benchmark results as returned by run_one()
+    
+    Returns
+    -------
+    str
+        the table
+    """
+    
+    lines = [
+        f'{"benchmark":<22}{"input MB":>10}{"seconds":>10}{"MB/s":>10}'
+        f'{"RSS MB":>10}{"child MB":>10}'
+    ]
+    for r in results:
+        lines.append(
+            f'{r["benchmark"]:<22}{r["input_bytes"] / 1e6:>10.1f}'
+            f'{r["seconds"]:>10.3f}{r["mb_per_second"]:>10.1f}'
+            f'{r["peak_rss_self"] / 1e6:>10.1f}'
+            f'{r["peak_rss_children"] / 1e6:>10.1f}'
+        )
+    return '\n'.join(lines)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Benchmark SequenceAlignment operations on synthetic data with '
+            'stand-in tools'
+        )
+    )
+    parser.add_argument(
+        '--records',
+        type=int,
+        default=100000,
+        help='number of records in each synthetic BAM file [100000]'
+    )
+    parser.add_argument(
+        '--reads',
+        type=int,
+        default=50000,
+        help='number of reads in each synthetic FASTQ file [50000]'
+    )
+    parser.add_argument(
+        '--read-length',
+        type=int,
+        default=100,
+        help='read length [100]'
+    )
+    parser.add_argument(
+        '--tool-mbps',
+        type=float,
+        default=500,
+        help='throughput of the stand-in tools in MB/s [500]'
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=1,
+        help='run each benchmark this many times and keep the best [1]'
+    )
+    parser.add_argument(
+        '--only',
+        nargs='+',
+        choices=tuple(BENCHMARKS),
+        help='run only these benchmarks'
+    )
+    parser.add_argument(
+        '--workdir',
+        help='directory for inputs and outputs [temporary directory]'
+    )
+    parser.add_argument(
+        '--json',
+        metavar='<path>',
+        help='also write the results to a JSON file'
+    )
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    parser.add_argument('--inputs', help=argparse.SUPPRESS)
+    parser.add_argument('--output-dir', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.run_one:
+        with open(args.inputs) as f:
+            inputs = json.load(f)
+        json.dump(
+            run_one(args.run_one, inputs, args.output_dir, repeat=args.repeat),
+            sys.stdout
+        )
+        return
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        inputs = generate_inputs(
+            workdir,
+            args.records,
+            args.reads,
+            args.read_length
+        )
+        inputs_path = os.path.join(workdir, 'inputs.json')
+        with open(inputs_path, 'w') as f:
+            json.dump(inputs, f)
+        results = []
+        for name in args.only or BENCHMARKS:
+            output_dir = tempfile.mkdtemp(dir=workdir)
+            results.append(
+                run_isolated(
+                    name,
+                    inputs_path,
+                    output_dir,
+                    repeat=args.repeat,
+                    tool_mbps=args.tool_mbps
+                )
+            )
+            print(format_table(results[-1:]).splitlines()[-1], file=sys.stderr)
+    print(format_table(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+
+
+# Execute ======================================================================
+
+if __name__ == '__main__':
+    main()
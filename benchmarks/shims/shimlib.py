@@ -0,0 +1,204 @@
+"""Helpers for the stand-in executables used by the benchmarks
+
+The shims pass data through at a known rate, set in MB/s by the
+SEQALIGN_BENCH_MBPS environment variable (default 500), so that benchmark
+timings measure the overhead of the seqalign wrappers rather than the
+performance of the real tools.
+"""
+
+
+
+
+# Imports ======================================================================
+
+import os
+import struct
+import sys
+import time
+
+from seqalign.seqalign import (
+    BAI_PSEUDO_BIN, BGZFReader, alignment_end, encode_bam_header,
+    iter_bam_records, parse_bam_header, read_record_position, write_bam
+)
+
+
+
+
+# Constants ====================================================================
+
+THROUGHPUT = float(os.environ.get('SEQALIGN_BENCH_MBPS', 500)) * 1e6
+
+
+
+
+# Functions ====================================================================
+
+def throttle(start, n_bytes):
+    """Sleep until n_bytes have taken at least as long as the throughput
+    allows since start
+    
+    Parameters
+    ----------
+    start : float
+        time.perf_counter() value when processing started
+    n_bytes : int
+        number of bytes processed
+    """
+    
+    delay = n_bytes / THROUGHPUT - (time.perf_counter() - start)
+    if delay > 0:
+        time.sleep(delay)
+
+
+def read_input(path=None):
+    """Read input data from a file, or from stdin
+    
+    Parameters
+    ----------
+    path : str
+        input path, or None or ``-`` for stdin
+    
+    Returns
+    -------
+    bytes
+        the data
+    """
+    
+    if path in {None, '-'}:
+        return sys.stdin.buffer.read()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_output(data, path=None):
+    """Write output data to a file, or to stdout
+    
+    Parameters
+    ----------
+    data : bytes
+        the data
+    path : str
+        output path, or None or ``-`` for stdout
+    """
+    
+    if path in {None, '-'}:
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+    else:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def read_bam(data):
+    """Read the header and records of a BAM file
+    
+    Parameters
+    ----------
+    data : bytes
+        a BAM file
+    
+    Returns
+    -------
+    tuple
+        the header text, (name, length) pairs for the references, and a list
+        of raw records
+    """
+    
+    reader = BGZFReader(data)
+    text, references = parse_bam_header(reader)
+    return text, references, list(iter_bam_records(reader))
+
+
+def encode_bam(text, references, records):
+    """Encode a BAM file at compression level 1
+    
+    Parameters
+    ----------
+    text : str
+        header text
+    references
+        (name, length) pairs for the references
+    records
+        raw records
+    
+    Returns
+    -------
+    bytes
+        the BAM file
+    """
+    
+    return write_bam(
+        encode_bam_header(text, references),
+        records,
+        compression_level=1
+    )
+
+
+def build_index(data):
+    """Build a BAI index of a coordinate-sorted BAM file
+    
+    Parameters
+    ----------
+    data : bytes
+        a BAM file
+    
+    Returns
+    -------
+    bytes
+        a BAI index with bins taken from the records, a linear index and a
+        pseudo-bin of read counts for each reference sequence
+    """
+    
+    reader = BGZFReader(data)
+    _, references = parse_bam_header(reader)
+    bins = [{} for _ in references]
+    linear = [[] for _ in references]
+    counts = [[0, 0] for _ in references]
+    no_coordinate = 0
+    offset = reader.tell()
+    for record in iter_bam_records(reader):
+        end_offset = reader.tell()
+        reference_id, position, flag = read_record_position(record)
+        if reference_id < 0:
+            no_coordinate += 1
+        else:
+            counts[reference_id][bool(flag & 4)] += 1
+            chunks = bins[reference_id].setdefault(
+                struct.unpack_from('<H', record, 14)[0],
+                []
+            )
+            if chunks and chunks[-1][1] == offset:
+                chunks[-1][1] = end_offset
+            else:
+                chunks.append([offset, end_offset])
+            windows = linear[reference_id]
+            for window in range(
+                position >> 14,
+                ((alignment_end(record) - 1) >> 14) + 1
+            ):
+                while len(windows) <= window:
+                    windows.append(None)
+                if windows[window] is None:
+                    windows[window] = offset
+        offset = end_offset
+    encoded = [b'BAI\x01', struct.pack('<i', len(references))]
+    for reference_bins, windows, (mapped, unmapped) in zip(
+        bins,
+        linear,
+        counts
+    ):
+        encoded.append(struct.pack('<i', len(reference_bins) + 1))
+        for bin, chunks in sorted(reference_bins.items()):
+            encoded.append(struct.pack('<Ii', bin, len(chunks)))
+            encoded.extend(struct.pack('<QQ', *chunk) for chunk in chunks)
+        encoded.append(
+            struct.pack('<IiQQQQ', BAI_PSEUDO_BIN, 2, 0, 0, mapped, unmapped)
+        )
+        previous = 0
+        for i, window in enumerate(windows):
+            windows[i] = previous = window if window is not None else previous
+        encoded.append(
+            struct.pack(f'<i{len(windows)}Q', len(windows), *windows)
+        )
+    encoded.append(struct.pack('<Q', no_coordinate))
+    return b''.join(encoded)
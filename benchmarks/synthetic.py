@@ -0,0 +1,308 @@
+"""Generate synthetic sequencing data for benchmarks
+
+Functions
+---------
+reg2bin
+    compute the BAI bin of an alignment
+encode_record
+    encode a raw BAM record
+generate_bam
+    generate a coordinate-sorted BAM file in memory
+fastq_records
+    generate FASTQ records
+write_fastq
+    write a (possibly gzipped) FASTQ file
+write_bed
+    write a BED file of random intervals
+write_positions
+    write a positions file for samtools mpileup
+"""
+
+
+
+
+# Imports ======================================================================
+
+import gzip
+import random
+import struct
+
+from seqalign.seqalign import BAM_CORE, encode_bam_header, write_bam
+
+
+
+
+# Constants ====================================================================
+
+REFERENCES = (
+    ('chr1', 249250621), ('chr2', 243199373), ('chr3', 198022430),
+    ('chr4', 191154276), ('chr5', 180915260), ('chr6', 171115067),
+    ('chr7', 159138663), ('chr8', 146364022), ('chr9', 141213431),
+    ('chr10', 135534747), ('chr11', 135006516), ('chr12', 133851895),
+    ('chr13', 115169878), ('chr14', 107349540), ('chr15', 102531392),
+    ('chr16', 90354753), ('chr17', 81195210), ('chr18', 78077248),
+    ('chr19', 59128983), ('chr20', 63025520), ('chr21', 48129895),
+    ('chr22', 51304566), ('chrX', 155270560), ('chrY', 59373566),
+    ('chrM', 16571)
+)
+HEADER_TEXT = '@HD\tVN:1.6\tSO:coordinate\n' + ''.join(
+    f'@SQ\tSN:{name}\tLN:{length}\n' for name, length in REFERENCES
+)
+BASES = b'ACGT'
+
+
+
+
+# Functions ====================================================================
+
+def reg2bin(start, end):
+    """Compute the BAI bin of an alignment, as in the SAM specification
+    
+    Parameters
+    ----------
+    start : int
+        0-based leftmost position
+    end : int
+        end position (exclusive)
+    
+    Returns
+    -------
+    int
+        the bin number
+    """
+    
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if start >> shift == end >> shift:
+            return offset + (start >> shift)
+    return 0
+
+
+def encode_record(
+    reference_id,
+    position,
+    name,
+    flag=0,
+    mapping_quality=60,
+    read_length=100,
+    next_reference_id=-1,
+    next_position=-1,
+    template_length=0
+):
+    """Encode a raw BAM record with a fully matching alignment
+    
+    Parameters
+    ----------
+    reference_id : int
+        reference sequence index, or -1 if unplaced
+    position : int
+        0-based leftmost position, or -1 if unplaced
+    name : bytes
+        read name
+    flag : int
+        SAM flag
+    mapping_quality : int
+        MAPQ score
+    read_length : int
+        length of the read
+    next_reference_id, next_position, template_length : int
+        mate information
+    
+    Returns
+    -------
+    bytes
+        the record, including its block_size field
+    """
+    
+    cigar = () if flag & 4 else ((read_length << 4),)
+    body = b''.join(
+        (
+            BAM_CORE.pack(
+                reference_id,
+                position,
+                len(name) + 1,
+                mapping_quality,
+                reg2bin(max(position, 0), max(position, 0) + read_length),
+                len(cigar),
+                flag,
+                read_length,
+                next_reference_id,
+                next_position,
+                template_length
+            ),
+            name,
+            b'\x00',
+            struct.pack(f'<{len(cigar)}I', *cigar),
+            b'\x12' * ((read_length + 1) // 2),
+            b'\x28' * read_length
+        )
+    )
+    return struct.pack('<i', len(body)) + body
+
+
+def generate_bam(
+    n_records,
+    read_length=100,
+    seed=0,
+    compression_level=6,
+    references=REFERENCES
+):
+    """Generate a coordinate-sorted BAM file of paired-end alignments
+    
+    Records are spread over the reference sequences in proportion to their
+    lengths. About 5% are duplicates, 5% have low MAPQ, 1% are supplementary
+    and 1% are unmapped.
+    
+    Parameters
+    ----------
+    n_records : int
+        number of records
+    read_length : int
+        length of each read
+    seed : int
+        random seed
+    compression_level : int
+        zlib compression level
+    references
+        (name, length) pairs for the reference sequences
+    
+    Returns
+    -------
+    bytes
+        the BAM file
+    """
+    
+    rng = random.Random(seed)
+    genome_length = sum(length for _, length in references)
+    n_unmapped = n_records // 100
+    records = []
+    for reference_id, (_, length) in enumerate(references):
+        n = round((n_records - n_unmapped) * length / genome_length)
+        for position in sorted(
+            rng.randrange(length - read_length) for _ in range(n)
+        ):
+            roll = rng.random()
+            flag = 0x1 | 0x2 | (0x40 if roll < 0.5 else 0x80)
+            if roll < 0.05:
+                flag |= 0x400
+            elif roll > 0.99:
+                flag |= 0x800
+            records.append(
+                encode_record(
+                    reference_id,
+                    position,
+                    f'read{len(records)}'.encode(),
+                    flag=flag,
+                    mapping_quality=5 if 0.05 <= roll < 0.1 else 60,
+                    read_length=read_length,
+                    next_reference_id=reference_id,
+                    next_position=position,
+                    template_length=read_length
+                )
+            )
+    for _ in range(n_unmapped):
+        records.append(
+            encode_record(
+                -1, -1, f'read{len(records)}'.encode(),
+                flag=0x4,
+                mapping_quality=0,
+                read_length=read_length
+            )
+        )
+    return write_bam(
+        encode_bam_header(HEADER_TEXT, references),
+        records,
+        compression_level=compression_level
+    )
+
+
+def fastq_records(n_reads, read_length=100, seed=0, prefix='read'):
+    """Generate FASTQ records with random sequences
+    
+    Parameters
+    ----------
+    n_reads : int
+        number of reads
+    read_length : int
+        length of each read
+    seed : int
+        random seed
+    prefix : str
+        prefix for read names
+    
+    Yields
+    ------
+    bytes
+        a four-line FASTQ record
+    """
+    
+    rng = random.Random(seed)
+    quality = b'I' * read_length
+    for i in range(n_reads):
+        sequence = bytes(rng.choices(BASES, k=read_length))
+        yield b'@%s%d\n%s\n+\n%s\n' % (prefix.encode(), i, sequence, quality)
+
+
+def write_fastq(path, n_reads, read_length=100, seed=0):
+    """Write a FASTQ file, gzipped if the path ends in ``.gz``
+    
+    Parameters
+    ----------
+    path : str
+        output path
+    n_reads : int
+        number of reads
+    read_length : int
+        length of each read
+    seed : int
+        random seed
+    """
+    
+    with (
+        gzip.open(path, 'wb', compresslevel=1) if path.endswith('.gz')
+        else open(path, 'wb')
+    ) as f:
+        f.writelines(fastq_records(n_reads, read_length=read_length, seed=seed))
+
+
+def write_bed(path, n_intervals, interval_length=10000, seed=0):
+    """Write a BED file of random intervals on the synthetic references
+    
+    Parameters
+    ----------
+    path : str
+        output path
+    n_intervals : int
+        number of intervals
+    interval_length : int
+        length of each interval
+    seed : int
+        random seed
+    """
+    
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for _ in range(n_intervals):
+            name, length = rng.choice(REFERENCES)
+            start = rng.randrange(max(1, length - interval_length))
+            f.write(f'{name}\t{start}\t{start + interval_length}\n')
+
+
+def write_positions(path, n_positions, seed=0):
+    """Write a positions file for samtools mpileup
+    
+    Parameters
+    ----------
+    path : str
+        output path
+    n_positions : int
+        number of positions
+    seed : int
+        random seed
+    """
+    
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        for _ in range(n_positions):
+            name, length = rng.choice(REFERENCES)
+            f.write(f'{name}\t{rng.randrange(1, length)}\n')
@@ -31,15 +31,65 @@ Bowtie2
     wrapper for botwie2
 RemoveDuplicates
     dedupper based on samtools view
+MarkDuplicates
+    dedupper fusing samtools collate, fixmate, sort and markdup
+PositionDedupper
+    in-process dedupper keyed on 5' position, strand and UMI
+FilterPlan
+    samtools view filters fused into a single pass
+Pipeline
+    operations on an alignment streamed through OS pipes
+SpilledBAM
+    BAM data stored in a temporary file and exposed through mmap
+BGZFReader
+    sequential reader for BGZF-compressed data in memory
+BGZFWriter
+    writer for BGZF-compressed data
+IntervalIndex
+    merged, sorted genomic intervals for fast overlap queries
+ReadMetadataCache
+    persistent cache of read length metadata for raw reads files
+AlignmentCache
+    content-addressed on-disk cache of aligned BAM data
+CoreBudget
+    divides a budget of cores among concurrently running processes
+Profiler
+    records the resource usage of the stages of a SequenceAlignment
+BatchRunner
+    runs a recipe of steps on many samples under a core and memory budget
 
 Functions
 ---------
 samtools_fixmate
+run_pipeline
+    run commands connected stdout-to-stdin
+capture_bam
+    capture BAM output in memory or, if it is large, on disk
+run_pipeline_async
+    run commands connected stdout-to-stdin as asyncio subprocesses
+capture_bam_async
+    capture BAM output from a coroutine in memory or on disk
+samtools_merge_async
+    merge BAM files with samtools merge as asyncio subprocesses
+merge_async
+    merge SequenceAlignment objects without blocking the event loop
+read_bam_header
+    read the header text and reference sequences of a BAM file
+parse_bai
+    parse a BAI index
+load_interval_index
+    load a (cached) IntervalIndex for a BED file
 median_read_length
     determine the median length of reads in a fasta or fastq file
 """
 
 from seqalign.seqalign import (
-    SequenceAlignment, BWA, Bowtie2, RemoveDuplicates, samtools_fixmate,
+    SequenceAlignment, BWA, Bowtie2, RemoveDuplicates, MarkDuplicates,
+    PositionDedupper, FilterPlan, Pipeline,
+    SpilledBAM, BGZFReader, samtools_fixmate, run_pipeline, capture_bam,
+    BGZFWriter, IntervalIndex, read_bam_header, parse_bai,
+    load_interval_index, ReadMetadataCache, AlignmentCache, CoreBudget,
+    Profiler, run_pipeline_async, capture_bam_async, samtools_merge_async,
+    merge_async, BatchRunner,
     get_median_read_length, samtools_merge, merge, trim_galore
 )
\ No newline at end of file
@@ -5,18 +5,150 @@
 
 # Imports ======================================================================
 
+import asyncio
+import bisect
+import collections
+import collections.abc
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import errno
+import functools
 import gzip
+import hashlib
+import inspect
+import io
 import itertools
+import json
 import math
+import mmap
 import os
 import os.path
 import pyhg19
+import random
+import resource
+import shutil
+import sqlite3
+import struct
 import subprocess
 import tempfifo
 import tempfile
+import threading
+import time
+import zlib
 
-from Bio import SeqIO
-from glob import glob
+from array import array
+from glob import glob, escape as glob_escape
+
+
+
+
+# Constants ====================================================================
+
+AUX_VALUE_SIZES = {
+    b'A': 1, b'c': 1, b'C': 1, b's': 2, b'S': 2, b'i': 4, b'I': 4, b'f': 4
+}
+BAI_PSEUDO_BIN = 37450
+BAM_CORE = struct.Struct('<iiBBHHHIiii')
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000'
+)
+BATCH_MEMORY_PER_INPUT_BYTE = 6
+CIGAR_CLIP_OPERATIONS = frozenset((4, 5))
+CIGAR_REFERENCE_OPERATIONS = frozenset((0, 2, 3, 7, 8))
+COMPRESSING_SAMTOOLS_COMMANDS = frozenset(
+    ('collate', 'fixmate', 'markdup', 'merge', 'sort', 'view')
+)
+KERNEL_COPY_UNSUPPORTED = frozenset(
+    (errno.EBADF, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EXDEV)
+)
+MERGE_FAN_IN = 256
+MIN_SORT_MEMORY_PER_THREAD = 64 * 1024**2
+SINGLE_THREADED_STAGES = frozenset(
+    (
+        'bedtools intersect', 'bwa samse', 'bwa sampe', 'samtools cat',
+        'samtools fixmate'
+    )
+)
+STAGE_COSTS = {
+    'bowtie2': 1.0,
+    'bwa aln': 1.0,
+    'bwa mem': 1.0,
+    'samtools collate': 0.5,
+    'samtools index': 0.25,
+    'samtools markdup': 0.5,
+    'samtools merge': 0.25,
+    'samtools sort': 1.0,
+    'samtools view': 0.25
+}
+SORT_MEMORY_FRACTION = 0.75
+SORT_MEMORY_OVERHEAD = 1.25
+THREADED_SAMTOOLS_COMMANDS = frozenset(
+    ('collate', 'index', 'markdup', 'merge', 'sort', 'view')
+)
+UMI_BASE_DIGITS = bytes.maketrans(b'ACGT', b'0123')
+
+
+
+
+# Decorators ===================================================================
+
+def profiled(method):
+    """Record a SequenceAlignment method as a stage of its profiler, if it
+    has one
+    
+    Parameters
+    ----------
+    method
+        a SequenceAlignment method, or a coroutine function
+    
+    Returns
+    -------
+    function
+        the wrapped method
+    """
+    
+    def bytes_out(self, result):
+        return (
+            len(result)
+            if isinstance(result, (bytes, bytearray, memoryview, SpilledBAM))
+            else self.data_size()
+        )
+    
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def profiled_coroutine(self, *args, **kwargs):
+            if not self.profiler:
+                return await method(self, *args, **kwargs)
+            with self.profiler.stage(
+                method.__name__,
+                bytes_in=self.data_size()
+            ) as record:
+                bytes_copied = self.bytes_copied
+                result = await method(self, *args, **kwargs)
+                record['bytes_out'] = bytes_out(self, result)
+                record['bytes_copied'] = self.bytes_copied - bytes_copied
+                return result
+        
+        return profiled_coroutine
+    
+    @functools.wraps(method)
+    def profiled_method(self, *args, **kwargs):
+        if not self.profiler:
+            return method(self, *args, **kwargs)
+        with self.profiler.stage(
+            method.__name__,
+            bytes_in=self.data_size()
+        ) as record:
+            bytes_copied = self.bytes_copied
+            result = method(self, *args, **kwargs)
+            record['bytes_out'] = bytes_out(self, result)
+            record['bytes_copied'] = self.bytes_copied - bytes_copied
+            return result
+    
+    return profiled_method
 
 
 
@@ -28,10 +160,30 @@ class SequenceAlignment():
     
     Attributes
     ----------
-    bam : bytes
-        Aligned sequencing data in BAM format
+    bam : bytes or memoryview
+        Aligned sequencing data in BAM format. If the data is stored on disk
+        this is a memoryview of the memory-mapped file.
+    bam_storage : SpilledBAM
+        Temporary file holding the BAM data, or None if it is held in memory
+    cram : bytes or SpilledBAM
+        The data in CRAM format, held between steps in place of the BAM data
+        if storage_format is ``cram``, or None
+    storage_format : str
+        ``bam`` or ``cram``, the format in which the data is held between
+        steps
+    reference_genome_path : str
+        Path to the reference genome used to read and write CRAM data
+    spill_threshold : int
+        BAM data larger than this number of bytes is stored in a temporary
+        file in temp_dir instead of in memory. If None, it is always held in
+        memory.
     index : bytes
-        BAI index file generated by samtools index
+        BAI (or CSI) index file generated by samtools index or sort. If the
+        BAM data has changed since the index was built, the index is rebuilt
+        the next time it is needed if the data is still sorted, and is None
+        otherwise.
+    index_format : str
+        ``bai`` or ``csi``, the format of the index
     mapping_quality : int
         Minimum MAPQ score for reads in this alignment
     bam_file_path : str
@@ -39,7 +191,10 @@ class SequenceAlignment():
     cleans_up_bam : bool
         When True, __exit__() will remove the last BAM file written to disk
     is_sorted : bool
-        Defaults to False, becomes True after samtools_sort() is run
+        Defaults to False, becomes True after samtools_sort() is run, and
+        False again when the bam attribute is set
+    sort_report : dict
+        Plan and peak memory of the last samtools_sort()
     aligner : obj
         A callable object representing the aligner used for sequence alignment
     dedupper : obj
@@ -49,6 +204,44 @@ class SequenceAlignment():
         Maximum number of processes available for method calls
     log : file object
         File object to which logging information will be written
+    lazy : bool
+        When True, alignment of raw reads and samtools view filters are
+        deferred until the BAM data is needed, so that filters can be applied
+        in a single pass and a Pipeline can stream from the aligner
+    pending_alignment : bool
+        True if raw reads have not been aligned yet (lazy mode only)
+    alignment_shard_reads : int
+        If set, raw reads are split into shards of this many reads (or read
+        pairs) which are aligned concurrently
+    alignment_retries : int
+        Number of times the alignment of a failed shard is retried
+    core_budget : CoreBudget
+        Divides the available cores among concurrently running processes
+    profiler : Profiler
+        If set, records the resource usage of each method that runs a
+        subprocess
+    memory_limit : float
+        Default maximum memory in GB for samtools sort
+    intermediate_compression : int
+        Compression level (0 for uncompressed) of the BAM data written by
+        each step for the next one, or None for the samtools default
+    output_compression : int
+        Compression level of the BAM files written by write() and of merged
+        alignments, or None for the samtools default
+    output_threads : int
+        Number of threads used to compress the output of write(), defaults
+        to processes
+    bytes_copied : int
+        Number of bytes of BAM data copied through the memory of this Python
+        process so far, e.g. to feed a pipe or to capture the output of a
+        tool. Copies made by the kernel (see send_file()) are not counted.
+    version : int
+        Counter incremented each time the BAM data changes
+    index_version : int
+        Value of version when the index was built
+    materialization : tuple
+        version, temporary directory and path of the BAM data on disk, as
+        provided by bam_file(), or None
     """
   
     def __init__(
@@ -59,17 +252,31 @@ class SequenceAlignment():
         dedupper=None,
         processes=1,
         log=None,
-        temp_dir=None
+        temp_dir=None,
+        lazy=False,
+        spill_threshold=None,
+        alignment_shard_reads=None,
+        alignment_retries=0,
+        core_budget=None,
+        profiler=None,
+        memory_limit=None,
+        intermediate_compression=None,
+        output_compression=None,
+        output_threads=None,
+        storage_format='bam',
+        reference_genome_path=None
     ):
         """Set the parameters for the alignment
         
         Parameters
         ----------
-        input_file : bytes, tuple, list, str
-            Sequencing data. Bytes objects are assumed to be BAM files in
-            memory. Strings are assumed to be paths to sequencing data on
-            disk. Tuples or lists are assumed to be pairs of strings indicating
-            paired-end read files.
+        input_file : bytes-like, SpilledBAM, tuple, list, str
+            Sequencing data. Bytes-like objects (bytes, bytearray or
+            memoryview) are assumed to be BAM files in memory, and are used
+            without copying. Strings are assumed to be paths to sequencing
+            data on disk (FASTA, FASTQ, SAM, BAM or CRAM). Tuples or lists
+            are assumed to be pairs of strings indicating paired-end read
+            files.
         mapping_quality : int
             Minimum MAPQ score for reads in this alignmentaligner : obj
         alignment : obj
@@ -84,19 +291,78 @@ class SequenceAlignment():
             File object to which logging information will be written
         temp_dir
             directory for temporary files
+        lazy : bool
+            If True, defer alignment and samtools view filters until the BAM
+            data is needed
+        spill_threshold : int
+            Size in bytes above which BAM data is stored on disk
+        alignment_shard_reads : int
+            If set, align raw reads in shards of this many reads
+        alignment_retries : int
+            Number of retries for each failed shard
+        core_budget : CoreBudget
+            Scheduler for thread counts, defaults to a budget of ``processes``
+            cores
+        profiler : Profiler
+            Profiler recording the resource usage of each stage
+        memory_limit : float
+            Default maximum memory in GB for sorting
+        intermediate_compression : int
+            Compression level of intermediate BAM data, 0 for uncompressed
+            or 1 for fast compression. Uncompressed data is several times
+            larger, so consider spill_threshold.
+        output_compression : int
+            Compression level applied by write() and to merged alignments
+        output_threads : int
+            Number of threads for compressing the output of write()
+        storage_format : str
+            If ``cram``, hold the data as CRAM between steps. Each step then
+            decodes the data to BAM and the result is encoded again, trading
+            CPU time for a smaller footprint in memory or on disk.
+        reference_genome_path : str
+            Reference genome for CRAM data, defaults to that of the aligner
+            or to pyhg19.PATH
         """
         
+        self.filter_plan = None
+        self.pending_alignment = False
+        self.bam_storage = None
+        self.cram = None
+        self.bytes_copied = 0
+        self.version = 0
+        self.materialization = None
+        self.materialization_lock = threading.RLock()
+        self.spill_threshold = spill_threshold
         self.index = None
+        self.index_format = 'bai'
         self.mapping_quality = int(mapping_quality)
         self.bam_file_path = None
         self.cleans_up_bam = False
         self.is_sorted = False
+        self.sort_report = None
         self.aligner = aligner
         self.dedupper = dedupper
         self.processes = int(processes)
+        self.core_budget = core_budget or CoreBudget(self.processes)
+        self.profiler = profiler
+        self.memory_limit = memory_limit
+        self.intermediate_compression = intermediate_compression
+        self.output_compression = output_compression
+        self.output_threads = output_threads
+        if storage_format not in {'bam', 'cram'}:
+            raise ValueError(f'unknown storage format {storage_format}')
+        self.storage_format = storage_format
+        self.reference_genome_path = reference_genome_path or getattr(
+            aligner,
+            'reference_genome_path',
+            pyhg19.PATH
+        )
         self.log = log
         self.temp_dir = temp_dir
-        self.bam = self.parse_input(input_file)
+        self.lazy = lazy
+        self.alignment_shard_reads = alignment_shard_reads
+        self.alignment_retries = alignment_retries
+        self.store(self.parse_input(input_file))
     
     def __enter__(self):
         """When an instance of this class is used as a context manager, it is
@@ -112,9 +378,24 @@ class SequenceAlignment():
         
         if self.cleans_up_bam:
             self.clean_up(self.bam_file_path)
-            self.clean_up('{}.bai'.format(self.bam_file_path))
+            self.clean_up(f'{self.bam_file_path}.{self.index_format}')
+            self.clean_up(f'{self.bam_file_path}.crai')
+        self.close()
         return False
     
+    def close(self):
+        """Release the temporary files holding the data: the on-disk copy
+        from materialize(), and any spilled BAM or CRAM data
+        
+        Files written by write() are kept.
+        """
+        
+        self.release_materialization()
+        if self.bam_storage:
+            self.bam_storage.close()
+        if isinstance(self.cram, SpilledBAM):
+            self.cram.close()
+    
     def __repr__(self):
         """Show some of the alignment parameters"""
         
@@ -155,7 +436,10 @@ class SequenceAlignment():
                 sequence_alignment.mapping_quality
             ),
             processes=min(self.processes, sequence_alignment.processes),
-            temp_dir=self.temp_dir
+            temp_dir=self.temp_dir,
+            spill_threshold=self.spill_threshold,
+            profiler=self.profiler,
+            compression_level=self.output_compression
         )
     
     def __or__(self, sequence_alignment):
@@ -185,8 +469,449 @@ class SequenceAlignment():
                 sequence_alignment.mapping_quality
             ),
             processes=min(self.processes, sequence_alignment.processes),
+            temp_dir=self.temp_dir,
+            spill_threshold=self.spill_threshold,
+            profiler=self.profiler,
+            compression_level=self.output_compression
+        )
+    
+    @property
+    def bam(self):
+        """Aligned sequencing data in BAM format
+        
+        Any pending alignment and filters are applied before the data is
+        returned, and data held as CRAM is decoded. Filters that fail are
+        left pending.
+        """
+        
+        if self.pending_alignment:
+            self.align_pending_reads()
+        if self.cram is not None:
+            self.decode_cram()
+        if self.filter_plan:
+            plan, self.filter_plan = self.filter_plan, None
+            try:
+                self.store(self.run_filter_plan(plan))
+            except BaseException:
+                self.filter_plan = plan
+                raise
+        return self._bam
+    
+    @bam.setter
+    def bam(self, bam):
+        self.replace_bam(bam)
+    
+    def replace_bam(self, bam, preserves_order=False):
+        """Replace the BAM data, discarding any pending alignment and
+        filters
+        
+        Parameters
+        ----------
+        bam : bytes-like, SpilledBAM
+            the new BAM data
+        preserves_order : bool
+            True if the new data was derived from the current data without
+            changing the order of the reads, so that it is still sorted if
+            the current data is. Otherwise it is marked as unsorted.
+        """
+        
+        self.pending_alignment = False
+        self.filter_plan = None
+        self.is_sorted = self.is_sorted and preserves_order
+        self.store(bam)
+    
+    @property
+    def index(self):
+        """BAI (or CSI) index of the BAM data
+        
+        If the BAM data has changed since the index was built, the index is
+        rebuilt if the data is still sorted, or dropped otherwise.
+        """
+        
+        if self._index is not None:
+            if (
+                self.pending_alignment
+                or self.filter_plan
+                or self.cram is not None
+            ):
+                self.bam
+            if self.index_version != self.version:
+                if self.is_sorted:
+                    self.samtools_index(csi=self.index_format == 'csi')
+                else:
+                    self._index = None
+        return self._index
+    
+    @index.setter
+    def index(self, index):
+        self._index = index
+        self.index_version = self.version
+    
+    def store(self, bam):
+        """Store new BAM data in memory or on disk, depending on its size
+        
+        If storage_format is ``cram``, the data is then encoded as CRAM.
+        
+        Parameters
+        ----------
+        bam : bytes-like, SpilledBAM
+            BAM data in memory, or already stored on disk
+        """
+        
+        self.version += 1
+        self.release_materialization()
+        if isinstance(self.cram, SpilledBAM):
+            self.cram.close()
+        self.cram = None
+        self.hold(bam)
+        if self.storage_format == 'cram' and bam is not None:
+            self.encode_cram()
+    
+    def hold(self, bam):
+        """Keep BAM data in memory or on disk, depending on its size, in
+        place of the current BAM data
+        
+        Parameters
+        ----------
+        bam : bytes-like, SpilledBAM
+            BAM data in memory, or already stored on disk
+        """
+        
+        previous_storage = self.bam_storage
+        if isinstance(bam, SpilledBAM):
+            self.bam_storage = bam
+        elif (
+            bam is not None
+            and self.spill_threshold is not None
+            and len(bam) > self.spill_threshold
+        ):
+            self.bam_storage = SpilledBAM.from_bytes(
+                bam,
+                temp_dir=self.temp_dir
+            )
+            self.bytes_copied += len(bam)
+        else:
+            self.bam_storage = None
+        self._bam = self.bam_storage.view if self.bam_storage else bam
+        if previous_storage and (previous_storage is not self.bam_storage):
+            previous_storage.close()
+    
+    def encode_cram(self):
+        """Replace the BAM data with the same data encoded as CRAM"""
+        
+        command, = self.tool_commands(
+            ('samtools', 'view', '-hC', '-T', self.reference_genome_path, '-')
+        )
+        if self.bam_storage:
+            with self.bam_storage.open() as stdin:
+                cram = self.capture_bam(
+                    lambda stdout: run_pipeline(
+                        command,
+                        stdin=stdin,
+                        stdout=stdout,
+                        log=self.log,
+                        check=True
+                    )
+                )
+            self.bam_storage.close()
+        else:
+            self.bytes_copied += len(self._bam)
+            cram = self.capture_bam(
+                lambda stdout: run_pipeline(
+                    command,
+                    input=self._bam,
+                    stdout=stdout,
+                    log=self.log,
+                    check=True
+                )
+            )
+        self.bam_storage, self._bam, self.cram = None, None, cram
+    
+    def decode_cram(self):
+        """Replace data held as CRAM with the same data decoded to BAM
+        
+        The content is unchanged, so the version is kept. The decoded BAM
+        data is not byte for byte the data that was encoded, so an index
+        that was up to date is rebuilt in the same pass.
+        """
+        
+        cram, self.cram = self.cram, None
+        reindex = (
+            self.is_sorted
+            and self._index is not None
+            and self.index_version == self.version
+        )
+        
+        def produce(stdout, index_path=None):
+            command, = self.tool_commands(
+                ('samtools', 'view', '-bh', '-T', self.reference_genome_path)
+                + (
+                    (
+                        '--write-index',
+                        '-o', f'{stdout.name}##idx##{index_path}'
+                    )
+                    if index_path else ()
+                )
+                + ('-',)
+            )
+            output = subprocess.DEVNULL if index_path else stdout
+            if isinstance(cram, SpilledBAM):
+                with cram.open() as stdin:
+                    return run_pipeline(
+                        command,
+                        stdin=stdin,
+                        stdout=output,
+                        log=self.log,
+                        check=True
+                    )
+            self.bytes_copied += len(cram)
+            return run_pipeline(
+                command,
+                input=cram,
+                stdout=output,
+                log=self.log,
+                check=True
+            )
+        
+        try:
+            if reindex:
+                bam, self._index = capture_indexed_bam(
+                    produce,
+                    index_format=self.index_format,
+                    spill_threshold=self.spill_threshold,
+                    temp_dir=self.temp_dir
+                )
+                if not isinstance(bam, SpilledBAM):
+                    self.bytes_copied += len(bam)
+            else:
+                bam = self.capture_bam(produce)
+        except BaseException:
+            self.cram = cram
+            raise
+        if isinstance(cram, SpilledBAM):
+            cram.close()
+        self.hold(bam)
+    
+    def data_size(self):
+        """Size of the data in bytes: the raw reads if they have not been
+        aligned yet, otherwise the BAM data
+        
+        Returns
+        -------
+        int
+            size in bytes
+        """
+        
+        if getattr(self, '_bam', None) is not None:
+            return len(self._bam)
+        if getattr(self, 'cram', None) is not None:
+            return len(self.cram)
+        if hasattr(self, 'raw_reads_path'):
+            return sum(
+                os.path.getsize(path) for path in (
+                    (self.raw_reads_path,)
+                    if isinstance(self.raw_reads_path, str)
+                    else self.raw_reads_path
+                )
+            )
+        return 0
+    
+    def capture_bam(self, produce):
+        """Capture BAM data produced by a function, spilling it to disk if it
+        is larger than spill_threshold
+        
+        Parameters
+        ----------
+        produce
+            a function taking a stdout argument, as for subprocess.Popen, and
+            returning the BAM data if stdout is subprocess.PIPE
+        
+        Returns
+        -------
+        bytes or SpilledBAM
+            The BAM data
+        """
+        
+        bam = capture_bam(
+            produce,
+            spill_threshold=self.spill_threshold,
             temp_dir=self.temp_dir
         )
+        if bam is not None and not isinstance(bam, SpilledBAM):
+            self.bytes_copied += len(bam)
+        return bam
+    
+    def tool_commands(self, *commands):
+        """Prepare samtools commands that run at the same time: give them
+        threads from the core budget and the intermediate compression level
+        
+        Parameters
+        ----------
+        *commands
+            argument tuples for subprocess.Popen
+        
+        Returns
+        -------
+        list
+            argument tuples
+        """
+        
+        return [
+            with_compression(command, self.intermediate_compression)
+            for command in self.core_budget.assign_threads(*commands)
+        ]
+    
+    def run_with_bam(self, *commands, stdout=subprocess.PIPE, check=False):
+        """Run commands connected through pipes, with the BAM data as input
+        
+        If the BAM data is stored on disk, the first command reads it directly
+        from the file.
+        
+        Parameters
+        ----------
+        *commands
+            argument tuples for subprocess.Popen. samtools commands without a
+            ``-@`` option are given threads from the core budget.
+        stdout
+            destination for the output of the last command
+        check : bool
+            If True, raise an AlignmentError if any command fails
+        
+        Returns
+        -------
+        bytes
+            output of the last command, or None if stdout is not
+            subprocess.PIPE
+        """
+        
+        bam = self.bam
+        commands = self.tool_commands(*commands)
+        if self.bam_storage:
+            with self.bam_storage.open() as stdin:
+                return run_pipeline(
+                    *commands,
+                    stdin=stdin,
+                    stdout=stdout,
+                    log=self.log,
+                    check=check
+                )
+        self.bytes_copied += len(bam)
+        return run_pipeline(
+            *commands,
+            input=bam,
+            stdout=stdout,
+            log=self.log,
+            check=check
+        )
+    
+    def transform(self, *commands, preserves_order=False):
+        """Replace the BAM data with the output of commands run on it
+        
+        Parameters
+        ----------
+        *commands
+            argument tuples for subprocess.Popen
+        preserves_order : bool
+            True if the commands keep the order of the reads, as for
+            replace_bam()
+        """
+        
+        self.replace_bam(
+            self.capture_bam(
+                lambda stdout: self.run_with_bam(
+                    *commands,
+                    stdout=stdout,
+                    check=True
+                )
+            ),
+            preserves_order=preserves_order
+        )
+    
+    def materialize(self, index=False):
+        """Provide the BAM data on disk, writing it at most once for each
+        version of the data
+        
+        The file is kept in a temporary directory until the data changes. If
+        the BAM data is already stored on disk, the directory holds a
+        symbolic link to it instead of a copy.
+        
+        Parameters
+        ----------
+        index : bool
+            If True, also write the index alongside the BAM file (rebuilding
+            it first if it is out of date)
+        
+        Returns
+        -------
+        str
+            Path to the BAM file
+        """
+        
+        with self.materialization_lock:
+            bam = self.bam
+            if (
+                self.materialization is None
+                or self.materialization[0] != self.version
+            ):
+                self.release_materialization()
+                directory = tempfile.TemporaryDirectory(dir=self.temp_dir)
+                bam_path = os.path.join(directory.name, 'data.bam')
+                if self.bam_storage:
+                    os.symlink(self.bam_storage.name, bam_path)
+                else:
+                    with open(bam_path, 'wb') as f:
+                        f.write(bam)
+                    self.bytes_copied += len(bam)
+                self.materialization = self.version, directory, bam_path
+            _, _, bam_path = self.materialization
+            if index:
+                index_data = self.index
+                index_path = f'{bam_path}.{self.index_format}'
+                if not os.path.exists(index_path):
+                    with open(index_path, 'wb') as f:
+                        f.write(index_data)
+            return bam_path
+    
+    def release_materialization(self):
+        """Remove the BAM data written to disk by materialize()"""
+        
+        with self.materialization_lock:
+            if self.materialization:
+                _, directory, _ = self.materialization
+                self.materialization = None
+                directory.cleanup()
+    
+    @contextlib.contextmanager
+    def bam_file(self):
+        """Context manager providing the path to the BAM data on disk
+        
+        The file is written by materialize(), so it is shared by every
+        method that needs a path until the data changes. If the BAM data is
+        already stored on disk, no copy is made.
+        
+        Yields
+        ------
+        str
+            Path to the BAM file
+        """
+        
+        yield self.materialize()
+    
+    @contextlib.contextmanager
+    def indexed_bam_file(self):
+        """Context manager providing the path to the BAM data on disk, with
+        its index alongside it
+        
+        As for bam_file(), the file and index are written at most once for
+        each version of the data.
+        
+        Yields
+        ------
+        str
+            Path to the BAM file
+        """
+        
+        yield self.materialize(index=True)
     
     def parse_input(self, input_file):
         """Parse the input file
@@ -196,21 +921,27 @@ class SequenceAlignment():
         
         Parameters
         ----------
-        input_file : bytes, tuple, list, str
-            Sequencing data. Bytes objects are assumed to be BAM files in
+        input_file : bytes-like, SpilledBAM, tuple, list, str
+            Sequencing data. Bytes-like objects are assumed to be BAM files in
             memory. Strings are assumed to be paths to sequencing data on
             disk. Tuples or lists are assumed to be pairs of strings indicating
             paired-end read files.
         
         Returns
         -------
-        bytes
-            A BAM File in memory
+        bytes or SpilledBAM
+            A BAM File in memory or on disk
         """
         
-        if not isinstance(input_file, (bytes, tuple, list, str)):
-            raise TypeError('input_file must be bytes, tuple, list, or str')
-        elif isinstance(input_file, bytes):
+        if not isinstance(
+            input_file,
+            (bytes, bytearray, memoryview, SpilledBAM, tuple, list, str)
+        ):
+            raise TypeError(
+                'input_file must be bytes-like, SpilledBAM, tuple, list, or '
+                'str'
+            )
+        elif isinstance(input_file, (bytes, bytearray, memoryview, SpilledBAM)):
             return input_file
         elif isinstance(input_file, (tuple, list)):
             if len(input_file) != 2:
@@ -218,40 +949,187 @@ class SequenceAlignment():
                     'If input_file_path is a tuple, it must have length 2'
                 )
             self.raw_reads_path = input_file
-            return self.align_reads()
+            return self.defer_or_align()
         elif isinstance(input_file, str):
             format = file_format_from_extension(input_file)
             if format in {'fasta', 'fastq'}:
                 self.raw_reads_path = input_file
-                return self.align_reads()
-            elif format in {'sam', 'bam'}:
-                with subprocess.Popen(
-                    (
-                        'samtools', 'view',
-                        '-bhq', str(self.mapping_quality),
-                        '-@', str(self.processes - 1),
-                        input_file
-                    ),
-                    stdout=subprocess.PIPE,
-                    stderr=self.log
-                ) as samtools_view:
-                    return samtools_view.communicate()[0]
+                return self.defer_or_align()
+            elif format in {'sam', 'bam', 'cram'}:
+                return self.capture_bam(
+                    lambda stdout: run_pipeline(
+                        self.tool_commands(
+                            (
+                                'samtools', 'view',
+                                '-bhq', str(self.mapping_quality)
+                            )
+                            + (format == 'cram') * (
+                                '-T', self.reference_genome_path
+                            )
+                            + (input_file,)
+                        )[0],
+                        stdout=stdout,
+                        log=self.log
+                    )
+                )
+    
+    def defer_or_align(self):
+        """Align raw reads now, or mark them for alignment if in lazy mode
+        
+        Returns
+        -------
+        bytes or SpilledBAM
+            The aligned BAM data, or None if alignment was deferred
+        """
+        
+        if self.lazy:
+            self.pending_alignment = True
+            return None
+        return self.capture_bam(self.align_reads)
     
-    def align_reads(self):
+    def align_pending_reads(self):
+        """Align raw reads whose alignment was deferred in lazy mode"""
+        
+        self.store(self.capture_bam(self.align_reads))
+        self.pending_alignment = False
+    
+    @profiled
+    def align_reads(self, stdout=subprocess.PIPE):
         """Align raw reads using the provided aligner
         
         The default aligner is BWA
         
+        Parameters
+        ----------
+        stdout
+            Destination for the aligned BAM data. If it is not
+            subprocess.PIPE, the aligner must accept a ``stdout`` argument.
+        
         Returns
         -------
         bytes
-            A BAM File in memory
+            A BAM File in memory, or None if stdout was redirected
         """
         
         if not self.aligner:
             self.aligner = BWA()
-        return self.aligner(self, temp_dir=self.temp_dir)
+        if self.alignment_shard_reads:
+            return self.align_shards(stdout=stdout)
+        if stdout == subprocess.PIPE:
+            return self.aligner(self, temp_dir=self.temp_dir)
+        return self.aligner(self, temp_dir=self.temp_dir, stdout=stdout)
+    
+    def align_shards(self, stdout=subprocess.PIPE, cached=True):
+        """Split raw reads into shards, align them concurrently, and
+        concatenate the results in input order
+        
+        Up to half as many shards as there are cores in the core budget are
+        aligned at a time, and each shard is retried up to alignment_retries
+        times. If the aligner has an alignment cache, it is checked for the
+        full input rather than for the individual shards.
+        
+        Parameters
+        ----------
+        stdout
+            Destination for the aligned BAM data
+        cached : bool
+            If False, skip the alignment cache
+        
+        Returns
+        -------
+        bytes
+            A BAM File in memory, or None if stdout was redirected
+        """
+        
+        cache = getattr(self.aligner, 'alignment_cache', None)
+        if cache and cached:
+            return cache.fetch_or_align(
+                lambda stdout: self.align_shards(stdout=stdout, cached=False),
+                self.aligner.cache_key(self),
+                stdout=stdout
+            )
+        aligner = copy.copy(self.aligner)
+        if cache:
+            aligner.alignment_cache = None
+        if isinstance(aligner, BWA):
+            aligner.algorithm = aligner.select_algorithm(self)
+        raw_reads_paths = (
+            (self.raw_reads_path,) if isinstance(self.raw_reads_path, str)
+            else tuple(self.raw_reads_path)
+        )
+        with tempfile.TemporaryDirectory(dir=self.temp_dir) as temp_dir_name:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(raw_reads_paths)
+            ) as executor:
+                shard_paths = tuple(
+                    executor.map(
+                        lambda i: split_raw_reads(
+                            raw_reads_paths[i],
+                            self.alignment_shard_reads,
+                            os.path.join(temp_dir_name, f'reads{i}')
+                        ),
+                        range(len(raw_reads_paths))
+                    )
+                )
+            if len(set(len(paths) for paths in shard_paths)) > 1:
+                raise MissingInputError(
+                    'Paired raw reads files have different numbers of reads'
+                )
+            workers = max(
+                1,
+                min(len(shard_paths[0]), self.core_budget.cores // 2)
+            )
+            threads = max(1, self.core_budget.cores // workers)
+            
+            def align_shard(i):
+                shard = SequenceAlignment(
+                    shard_paths[0][i] if len(shard_paths) == 1
+                    else tuple(paths[i] for paths in shard_paths),
+                    mapping_quality=self.mapping_quality,
+                    aligner=aligner,
+                    processes=threads,
+                    log=self.log,
+                    temp_dir=temp_dir_name,
+                    lazy=True
+                )
+                bam_path = os.path.join(temp_dir_name, f'shard{i}.bam')
+                for attempt in range(self.alignment_retries + 1):
+                    try:
+                        with open(bam_path, 'wb') as f:
+                            shard.align_reads(stdout=f)
+                        if bam_file_is_complete(bam_path):
+                            return bam_path
+                        error = AlignmentError(f'Truncated output: {bam_path}')
+                    except (AlignmentError, OSError) as e:
+                        error = e
+                raise error
+            
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                bam_paths = tuple(
+                    executor.map(align_shard, range(len(shard_paths[0])))
+                )
+            return run_pipeline(
+                ('samtools', 'cat', *bam_paths),
+                stdout=stdout,
+                log=self.log,
+                check=True
+            )
+    
+    def pipeline(self):
+        """Start a streaming Pipeline from this alignment
+        
+        Returns
+        -------
+        Pipeline
+            A pipeline whose source is the BAM data (or, if alignment is
+            pending, the aligner)
+        """
+        
+        return Pipeline(self)
     
+    @profiled
     def samtools_view(
         self,
         *options,
@@ -263,42 +1141,118 @@ class SequenceAlignment():
         remove_fails_quality_check=False,
         remove_duplicate=False,
         remove_supplementary=False,
-        mapping_quality=None
+        mapping_quality=None,
+        regions=None,
+        sharded=False
     ):
-        """Apply a filter to the BAM file with samtools view
+        """Apply a filter to the BAM data with samtools view
+        
+        If the lazy attribute is True and the filter consists only of flag,
+        MAPQ and region arguments, it is merged into the pending FilterPlan
+        instead of being applied immediately.
 
         Parameters
         ----------
         options : tuple
             tuple containing the options as to be passed to subprocess.Popen
+        regions : iterable
+            regions to restrict the data to (requires an index)
+        sharded : bool
+            If True, filter each chromosome (or each region) in parallel
+            (requires an index)
         """
         
-        with subprocess.Popen(
-            (
-                (
-                    'samtools', 'view', '-bh', '-@', str(self.processes - 1),
-                    '-q', str(
-                        self.mapping_quality
-                        if mapping_quality is None
-                        else mapping_quality
+        plan = FilterPlan.from_filters(
+            *options,
+            remove_unpaired=remove_unpaired,
+            remove_improperly_paired=remove_improperly_paired,
+            remove_unmapped=remove_unmapped,
+            remove_mate_unmapped=remove_mate_unmapped,
+            remove_not_primary=remove_not_primary,
+            remove_fails_quality_check=remove_fails_quality_check,
+            remove_duplicate=remove_duplicate,
+            remove_supplementary=remove_supplementary,
+            mapping_quality=(
+                self.mapping_quality
+                if mapping_quality is None
+                else mapping_quality
+            ),
+            regions=regions
+        )
+        if sharded:
+            pending = None
+            fused = copy.copy(self.filter_plan)
+            if fused and fused.fuse(plan):
+                plan, pending, self.filter_plan = fused, self.filter_plan, None
+            try:
+                self.scatter_gather(
+                    view_options=plan.options(),
+                    regions=plan.regions
+                )
+            except BaseException:
+                if pending:
+                    self.filter_plan = pending
+                raise
+        elif not self.defer_filter(plan):
+            self.replace_bam(
+                self.run_filter_plan(plan),
+                preserves_order=True
+            )
+    
+    def defer_filter(self, plan):
+        """In lazy mode, record a FilterPlan as pending or merge it into the
+        pending plan
+        
+        Parameters
+        ----------
+        plan : FilterPlan
+            the filters to apply
+        
+        Returns
+        -------
+        bool
+            True if the plan was deferred, False if it must be applied now
+        """
+        
+        if self.lazy and self.filter_plan is None and plan.fusable:
+            self.filter_plan = plan
+            return True
+        return bool(
+            self.lazy and self.filter_plan and self.filter_plan.fuse(plan)
+        )
+    
+    @profiled
+    def run_filter_plan(self, plan):
+        """Apply a FilterPlan to the BAM data in a single samtools view pass
+        
+        Parameters
+        ----------
+        plan : FilterPlan
+            the filters to apply
+        
+        Returns
+        -------
+        bytes or SpilledBAM
+            The filtered BAM data
+        """
+        
+        args, = self.tool_commands(
+            ('samtools', 'view', '-bh') + plan.options()
+        )
+        if plan.regions:
+            with self.region_stream(plan.regions) as stdin:
+                return self.capture_bam(
+                    lambda stdout: run_pipeline(
+                        args,
+                        stdin=stdin,
+                        stdout=stdout,
+                        log=self.log,
+                        check=True
                     )
                 )
-                + tuple(options)
-                + remove_unpaired * ('-f', '1')
-                + remove_improperly_paired * ('-f', '2')
-                + remove_unmapped * ('-F', '4')
-                + remove_mate_unmapped * ('-F', '8')
-                + remove_not_primary * ('-F', '256')
-                + remove_fails_quality_check * ('-F', '512')
-                + remove_duplicate * ('-F', '1024')
-                + remove_supplementary * ('-F', '2048')
-            ),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=self.log
-        ) as samtools_view:
-            bam, _ = samtools_view.communicate(input=self.bam)
-        self.bam = bam
+        return self.capture_bam(
+            lambda stdout: self.run_with_bam(args, stdout=stdout, check=True)
+        )
     
     def remove_unpaired_reads(self):
         """Remove unpaired (or improperly paired) reads from the BAM data using
@@ -321,30 +1275,58 @@ class SequenceAlignment():
         
         self.samtools_view('-F', '1804', '-q', str(self.mapping_quality))
     
-    def percent_mitochondrial(self):
+    @profiled
+    def idxstats(self):
+        """Count reads per reference sequence, like samtools idxstats
+        
+        The counts are read directly from the BAI index and the BAM header,
+        without running samtools.
+        
+        Returns
+        -------
+        list
+            (name, length, mapped, unmapped) tuples for each reference
+            sequence, followed by ('*', 0, 0, unmapped) for reads with no
+            coordinates
+        """
+        
         if not self.index:
             raise RuntimeError(
                 'use SequenceAlignment.samtools_index() before using '
-                'SequenceAlignment.percent_mitochondrial()'
+                'SequenceAlignment.idxstats()'
             )
-        with tempfile.NamedTemporaryFile(dir=self.temp_dir) as temp_bam:
-            temp_bam.write(self.bam)
-            with open('{}.bai'.format(temp_bam.name), 'wb') as f:
-                f.write(self.index)
-            with subprocess.Popen(
-                ('samtools', 'view', '-c', temp_bam.name),
-                stdout=subprocess.PIPE,
-                stderr=self.log
-            ) as samtools_view:
-                total = int(samtools_view.communicate()[0].decode())
-            with subprocess.Popen(
-                ('samtools', 'view', '-c', temp_bam.name, 'chrM'),
-                stdout=subprocess.PIPE,
-                stderr=self.log
-            ) as samtools_view:
-                mitochondrial = int(samtools_view.communicate()[0].decode())
-            os.remove('{}.bai'.format(temp_bam.name))
-            return mitochondrial / total
+        _, references = read_bam_header(self.bam)
+        index_references, no_coordinate = parse_bai(self.index, bins=False)
+        if len(references) != len(index_references):
+            raise BAMFormatError(
+                'BAM header and BAI index have different numbers of reference '
+                'sequences'
+            )
+        return [
+            (name, length, counts['mapped'], counts['unmapped'])
+            for (name, length), counts in zip(references, index_references)
+        ] + [('*', 0, 0, no_coordinate)]
+    
+    def percent_mitochondrial(self, mitochondrial_chromosome='chrM'):
+        """Fraction of reads on the mitochondrial chromosome
+        
+        Parameters
+        ----------
+        mitochondrial_chromosome : str
+            name of the mitochondrial chromosome in the BAM header
+        
+        Returns
+        -------
+        float
+            the fraction of reads that are mitochondrial
+        """
+        
+        total, mitochondrial = 0, 0
+        for name, _, mapped, unmapped in self.idxstats():
+            total += mapped + unmapped
+            if name == mitochondrial_chromosome:
+                mitochondrial += mapped + unmapped
+        return mitochondrial / total
 
     def restrict_chromosomes(self, *chromosomes):
         """Restrict the BAM data to reads on certain chromosomes
@@ -360,112 +1342,479 @@ class SequenceAlignment():
                 'use SequenceAlignment.samtools_index() before using '
                 'SequenceAlignment.restrict_chromosomes()'
             )
-        with tempfile.NamedTemporaryFile(dir=self.temp_dir) as temp_bam:
-            temp_bam.write(self.bam)
-            with open('{}.bai'.format(temp_bam.name), 'wb') as f:
-                f.write(self.index)
-            self.samtools_view(
-                temp_bam.name,
-                *(f'chr{c}'.replace('chrchr', 'chr') for c in chromosomes)
+        self.samtools_view(
+            regions=tuple(
+                f'chr{c}'.replace('chrchr', 'chr') for c in chromosomes
+            )
+        )
+    
+    def region_queries(self, regions):
+        """Plan the index lookups for reads overlapping regions
+        
+        Parameters
+        ----------
+        regions : iterable
+            regions in samtools format (``chr1``, ``chr1:1000`` or
+            ``chr1:1000-2000``, 1-based and inclusive), or ``*`` for reads
+            with no coordinates
+        
+        Returns
+        -------
+        list
+            (reference ID, start, end, chunks) tuples for non-overlapping
+            regions in coordinate order, where chunks are the merged
+            (start, end) virtual offset pairs that may hold overlapping reads
+        """
+        
+        if not self.index:
+            raise RuntimeError(
+                'use SequenceAlignment.samtools_index() before restricting '
+                'to regions'
             )
-            os.remove('{}.bai'.format(temp_bam.name))
+        _, references = read_bam_header(self.bam)
+        return plan_region_queries(
+            (parse_region(region, references) for region in regions),
+            *cached_region_index(self.index)
+        )
+    
+    def fetch(self, *regions):
+        """Iterate over the reads overlapping regions, using the index to
+        decompress only the BGZF blocks that may hold them
+        
+        Each read is returned once, in coordinate order, even if it overlaps
+        several regions.
+        
+        Parameters
+        ----------
+        *regions
+            regions in samtools format, as for region_queries()
+        
+        Returns
+        -------
+        iterator
+            raw BAM records, including their block_size fields
+        """
+        
+        return iter_region_records(self.bam, self.region_queries(regions))
+    
+    @profiled
+    def restrict_regions(self, *regions):
+        """Restrict the BAM data to reads overlapping regions, reading only
+        the parts of the data that the index points to
+        
+        Parameters
+        ----------
+        *regions
+            regions in samtools format, as for region_queries()
+        """
+        
+        queries = self.region_queries(regions)
+        bam = self.bam
+        header = encode_bam_header(*read_bam_header(bam))
+        self.replace_bam(
+            self.capture_bam(
+                lambda stdout: write_bam(
+                    header,
+                    iter_region_records(bam, queries),
+                    stdout=stdout,
+                    compression_level=(
+                        6 if self.intermediate_compression is None
+                        else self.intermediate_compression
+                    )
+                )
+            ),
+            preserves_order=True
+        )
+    
+    @contextlib.contextmanager
+    def region_stream(self, regions):
+        """Context manager providing a pipe from which the reads overlapping
+        regions can be read as uncompressed BAM data
+        
+        The reads are found with fetch() and written to the pipe by a thread.
+        
+        Parameters
+        ----------
+        regions : iterable
+            regions in samtools format, as for region_queries()
+        
+        Yields
+        ------
+        file object
+            the read end of the pipe
+        """
+        
+        queries = self.region_queries(regions)
+        bam = self.bam
+        header = encode_bam_header(*read_bam_header(bam))
+        errors = []
+        read_fd, write_fd = os.pipe()
+        
+        def feed():
+            try:
+                with open(write_fd, 'wb') as pipe:
+                    write_bam(
+                        header,
+                        iter_region_records(bam, queries),
+                        stdout=pipe,
+                        compression_level=0
+                    )
+            except BrokenPipeError:
+                pass
+            except BaseException as e:
+                errors.append(e)
+        
+        writer = threading.Thread(target=feed)
+        with open(read_fd, 'rb') as stdin:
+            writer.start()
+            try:
+                yield stdin
+            finally:
+                stdin.close()
+                writer.join()
+        if errors:
+            raise errors[0]
     
-    def samtools_index(self):
+    @profiled
+    def samtools_index(self, csi=False):
         """Index the BAM data
+        
+        To avoid a separate pass over the data, use samtools_sort(index=True)
+        instead
+        
+        Parameters
+        ----------
+        csi : bool
+            If True, build a CSI index instead of a BAI index (required for
+            reference sequences longer than 512 Mbp)
         """
         
         if not self.is_sorted:
             raise Exception('BAM must be sorted before it can be indexed')
-        with tempfifo.NamedTemporaryFIFO(dir=self.temp_dir) as (
-            bam_pipe
-        ), tempfifo.NamedTemporaryFIFO(dir=self.temp_dir) as (
-            index_pipe
-        ):
-            with subprocess.Popen(
-                (
-                    'sh', '-c',
-                    'cat {0} & samtools index {1} {0} & cat > {1}'.format(
-                        index_pipe.name,
-                        bam_pipe.name
-                    )
+        index_format = 'csi' if csi else 'bai'
+        with self.bam_file() as bam_path, tempfile.TemporaryDirectory(
+            dir=self.temp_dir
+        ) as temp_dir:
+            index_path = os.path.join(temp_dir, f'index.{index_format}')
+            run_pipeline(
+                *self.tool_commands(
+                    ('samtools', 'index')
+                    + csi * ('-c',)
+                    + ('-o', index_path, bam_path)
                 ),
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=self.log
-            ) as samtools_index:
-                self.index, _ = samtools_index.communicate(input=self.bam)
+                log=self.log,
+                check=True
+            )
+            with open(index_path, 'rb') as f:
+                self.index = f.read()
+        self.index_format = index_format
     
-    def samtools_sort(self, memory_limit=5):
-        """Sort the BAM data using samtools"""
+    def plan_sort(self, memory_limit=None):
+        """Plan the threads and memory for samtools sort
         
-        if memory_limit < 5:
-            raise MemoryLimitError('Please provide at least 5 GB of memory')
-        with subprocess.Popen(
-            (
-                'samtools', 'sort',
-                '-T', str(self.temp_dir or tempfile.gettempdir()),
-                '-m', '{}M'.format(int(1024 / self.processes * memory_limit)),
-                '-@', str(self.processes - 1)
-            ),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=self.log
-        ) as samtools_sort:
-            bam, _ = samtools_sort.communicate(input=self.bam)
-        self.bam = bam
+        The memory needed to sort the data in a single in-memory run is
+        estimated from the uncompressed size of the BAM data. If that fits in
+        the budget (a fraction of the available system memory, capped at
+        memory_limit), that much memory is used and no temporary files are
+        written. Otherwise the whole budget is used, and the data is sorted
+        in several runs that are merged from temporary files.
+        
+        Parameters
+        ----------
+        memory_limit : float
+            maximum memory in GB. If None, the memory_limit attribute is used,
+            and if that is None only available memory is considered
+        
+        Returns
+        -------
+        dict
+            ``threads``, total ``memory`` and ``memory_per_thread`` in bytes,
+            estimated in-memory ``data_size`` (None if the data has not been
+            aligned yet) and expected number of ``spill_files``
+        """
+        
+        threads, = self.core_budget.allocate('samtools sort')
+        memory_limit = memory_limit or self.memory_limit
+        budget = available_memory() * SORT_MEMORY_FRACTION
+        if memory_limit:
+            budget = min(budget, memory_limit * 1024**3)
+        threads = max(
+            1,
+            min(threads, int(budget // MIN_SORT_MEMORY_PER_THREAD))
+        )
+        data_size = (
+            None if self.pending_alignment or self._bam is None
+            else int(bgzf_uncompressed_size(self._bam) * SORT_MEMORY_OVERHEAD)
+        )
+        if data_size is not None and data_size <= budget:
+            memory = max(data_size, threads * MIN_SORT_MEMORY_PER_THREAD)
+            spill_files = 0
+        else:
+            memory = max(budget, threads * MIN_SORT_MEMORY_PER_THREAD)
+            spill_files = (
+                threads * math.ceil(data_size / memory) if data_size else None
+            )
+        return {
+            'threads': threads,
+            'memory': int(memory),
+            'memory_per_thread': int(memory // threads),
+            'data_size': data_size,
+            'spill_files': spill_files
+        }
+    
+    def sort_command(self, plan, temp_dir, output_path, index_path=None):
+        """Command for samtools sort
+        
+        Parameters
+        ----------
+        plan : dict
+            threads and memory from plan_sort()
+        temp_dir : str
+            directory for the temporary files of samtools sort
+        output_path : str
+            path for the sorted BAM file if an index is written alongside it
+        index_path : str
+            If set, write the index here while sorting. Otherwise the sorted
+            data is written to stdout
+        
+        Returns
+        -------
+        tuple
+            arguments for subprocess.Popen
+        """
+        
+        return (
+            'samtools', 'sort',
+            '-T', os.path.join(temp_dir, 'sort'),
+            '-m', str(plan['memory_per_thread']),
+            '-@', str(plan['threads'] - 1)
+        ) + compression_options(self.intermediate_compression) + bool(
+            index_path
+        ) * (
+            '-o', f'{output_path}##idx##{index_path}',
+            '--write-index'
+        )
+    
+    def load_sorted(self, sorted_bam):
+        """Replace the BAM data with sorted data from a temporary file
+        
+        The current data is released before the sorted data is read, and the
+        sorted data stays on disk if it is larger than spill_threshold.
+        
+        Parameters
+        ----------
+        sorted_bam : SpilledBAM
+            the sorted data
+        """
+        
+        self.bam = None
+        self.bam = load_spilled_bam(sorted_bam, self.spill_threshold)
+
+    @profiled
+    def samtools_sort(self, memory_limit=None, index=False, csi=False):
+        """Sort the BAM data using samtools
+        
+        Threads and memory are planned by plan_sort(). The sorted data is
+        written to a temporary file, and the unsorted data is released before
+        it is read back, so that the two are never held in memory together.
+        
+        Parameters
+        ----------
+        memory_limit : float
+            maximum memory in GB. If None, only available memory is considered
+        index : bool
+            If True, build the index while sorting (samtools sort
+            --write-index), saving a separate samtools_index() pass
+        csi : bool
+            If True, build a CSI index instead of a BAI index
+        
+        Returns
+        -------
+        dict
+            the plan from plan_sort(), with the ``peak_memory`` in bytes
+            actually used by samtools sort
+        """
+        
+        bam = self.bam
+        plan = self.plan_sort(memory_limit)
+        sorted_bam = SpilledBAM(temp_dir=self.temp_dir)
+        try:
+            with contextlib.ExitStack() as stack:
+                temp_dir = stack.enter_context(
+                    tempfile.TemporaryDirectory(dir=self.temp_dir)
+                )
+                stdin = (
+                    stack.enter_context(self.bam_storage.open())
+                    if self.bam_storage else subprocess.PIPE
+                )
+                index_format = 'csi' if csi else 'bai'
+                index_path = os.path.join(temp_dir, f'index.{index_format}')
+                sort = stack.enter_context(
+                    subprocess.Popen(
+                        self.sort_command(
+                            plan,
+                            temp_dir,
+                            sorted_bam.name,
+                            index_path if index or csi else None
+                        ),
+                        stdin=stdin,
+                        stdout=sorted_bam.file,
+                        stderr=self.log
+                    )
+                )
+                if stdin == subprocess.PIPE:
+                    write_to_pipe(sort.stdin, bam)
+                rusage = wait_for_rusage(sort)
+                check_returncodes(sort)
+                if index or csi:
+                    with open(index_path, 'rb') as f:
+                        sorted_index = f.read()
+            del bam
+            self.load_sorted(sorted_bam)
+        except BaseException:
+            sorted_bam.close()
+            raise
         self.is_sorted=True
+        if index or csi:
+            self.index, self.index_format = sorted_index, index_format
+        plan['peak_memory'] = rusage.ru_maxrss * 1024
+        self.sort_report = plan
+        return plan
     
-    def percent_blacklisted(self, blacklist_path):
-        with subprocess.Popen(
-            ('samtools', 'view', '-c'),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=self.log
-        ) as samtools_view:
-            total = int(samtools_view.communicate(input=self.bam)[0].decode())
-        with subprocess.Popen(
-            ('bedtools', 'intersect', '-abam', 'stdin', '-b', blacklist_path),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=self.log
-        ) as bedtools_intersect:
-            blacklisted_bam, _ = bedtools_intersect.communicate(input=self.bam)
-        with subprocess.Popen(
-            ('samtools', 'view', '-c'),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=self.log
-        ) as samtools_view:
-            blacklisted = int(
-                samtools_view.communicate(input=blacklisted_bam)[0].decode()
-            )
+    @profiled
+    def percent_blacklisted(self, blacklist_path, remove=False):
+        """Fraction of reads overlapping regions in a BED file
+        
+        The BAM data is scanned once. If remove is True, the overlapping reads
+        are removed during the same scan.
+        
+        Parameters
+        ----------
+        blacklist_path : str
+            Path to a BED file on disk
+        remove : bool
+            If True, also remove the blacklisted reads
+        
+        Returns
+        -------
+        float
+            the fraction of reads that are blacklisted
+        """
+        
+        total, blacklisted = self.scan_blacklist(blacklist_path, remove=remove)
         return blacklisted / total
 
-    def remove_blacklisted_reads(self, blacklist_path):
-        """Remove reads from regions in a provided BED file using bedtools
+    @profiled
+    def remove_blacklisted_reads(self, blacklist_path, sharded=False):
+        """Remove reads from regions in a provided BED file
         
         Parameters
         ----------
         blacklist_path : str
             Path to a BED file on disk
+        sharded : bool
+            If True, process each chromosome in parallel with bedtools
+            (requires an index)
         """
         
-        with subprocess.Popen(
-            (
-                'bedtools', 'intersect',
-                '-abam', 'stdin',
-                '-b', blacklist_path,
-                '-v'
-            ),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=self.log
-        ) as bedtools_intersect:
-            bam, _ = bedtools_intersect.communicate(input=self.bam)
-        self.bam = bam
+        if sharded:
+            self.scatter_gather(
+                (
+                    'bedtools', 'intersect',
+                    '-abam', 'stdin',
+                    '-b', blacklist_path,
+                    '-v'
+                )
+            )
+        else:
+            self.scan_blacklist(blacklist_path, remove=True)
     
-    def remove_duplicates(self, dedupper=None):
-        """Remove duplicates from the BAM data using the provided dedupper"""
+    @profiled
+    def scan_blacklist(self, blacklist_path, remove=False):
+        """Count reads overlapping regions in a BED file, and optionally
+        remove them, in a single pass over the BAM data
+        
+        Mapped reads overlapping a region by at least one base are
+        blacklisted. The interval index for the BED file is cached, so it is
+        only built once per process.
+        
+        Parameters
+        ----------
+        blacklist_path : str
+            Path to a BED file on disk
+        remove : bool
+            If True, replace the BAM data with the reads that are not
+            blacklisted
+        
+        Returns
+        -------
+        tuple
+            the total number of reads and the number of blacklisted reads
+        """
+        
+        blacklist = load_interval_index(blacklist_path)
+        reader = BGZFReader(self.bam)
+        header_text, references = parse_bam_header(reader)
+        reference_intervals = tuple(
+            blacklist.intervals.get(name) for name, _ in references
+        )
+        counts = {'total': 0, 'blacklisted': 0}
+        
+        def kept_records():
+            for record in iter_bam_records(reader):
+                counts['total'] += 1
+                reference_id, position, flag = read_record_position(record)
+                intervals = (
+                    reference_intervals[reference_id]
+                    if (reference_id >= 0) and not (flag & 4)
+                    else None
+                )
+                if intervals and intervals_overlap(
+                    intervals,
+                    position,
+                    alignment_end(record)
+                ):
+                    counts['blacklisted'] += 1
+                else:
+                    yield record
+        
+        if remove:
+            self.replace_bam(
+                self.capture_bam(
+                    lambda stdout: write_bam(
+                        encode_bam_header(header_text, references),
+                        kept_records(),
+                        stdout=stdout,
+                        compression_level=(
+                            6 if self.intermediate_compression is None
+                            else self.intermediate_compression
+                        )
+                    )
+                ),
+                preserves_order=True
+            )
+        else:
+            collections.deque(kept_records(), maxlen=0)
+        return counts['total'], counts['blacklisted']
+    
+    @profiled
+    def remove_duplicates(self, dedupper=None, sharded=False):
+        """Remove duplicates from the BAM data using the provided dedupper
+        
+        Parameters
+        ----------
+        dedupper
+            dedupper to use, defaults to the dedupper attribute
+        sharded : bool
+            If True, process each chromosome in parallel (requires an index
+            and a dedupper with a ``command()`` method). Pairs with mates on
+            different chromosomes are handled independently on each.
+        
+        Deduppers with an ``apply()`` method, such as MarkDuplicates, run
+        on the SequenceAlignment directly. Those with a ``command()`` method
+        are run on the BAM data as a subprocess. Other deduppers are called
+        with the BAM data and return the deduplicated data.
+        """
         
         if not (dedupper or self.dedupper):
             raise Exception(
@@ -473,9 +1822,29 @@ class SequenceAlignment():
             )
         else:
             dedupper = dedupper if dedupper else self.dedupper
-            self.bam = dedupper(self.bam, log=self.log)
+            if sharded:
+                if not hasattr(dedupper, 'command'):
+                    raise TypeError(
+                        'dedupper must have a command() method to be sharded'
+                    )
+                self.scatter_gather(dedupper.command())
+            elif hasattr(dedupper, 'apply'):
+                dedupper.apply(self)
+            elif hasattr(dedupper, 'command'):
+                self.transform(dedupper.command(), preserves_order=True)
+            else:
+                self.replace_bam(
+                    dedupper(self.bam, log=self.log),
+                    preserves_order=True
+                )
     
-    def samtools_mpileup(self, positions, reference_genome=pyhg19.PATH):
+    @profiled
+    def samtools_mpileup(
+        self,
+        positions,
+        reference_genome=pyhg19.PATH,
+        sharded=False
+    ):
         """Generate a pileup from the BAM data using samtools mpileup
         
         Parameters
@@ -484,6 +1853,9 @@ class SequenceAlignment():
             Path to a variant positions file on disk
         reference_genome : 
             Path to a reference genome on disk
+        sharded : bool
+            If True, generate the pileup for each chromosome in parallel
+            (requires an index)
         
         Returns
         -------
@@ -491,59 +1863,854 @@ class SequenceAlignment():
             A pileup file generated by samtools mpileup
         """
         
-        with subprocess.Popen(
+        if sharded:
+            with self.scatter(
+                lambda bam_path, region: (
+                    (
+                        'samtools', 'mpileup',
+                        '-f', reference_genome,
+                        '-l', positions,
+                        '-r', region,
+                        bam_path
+                    ),
+                ),
+                regions=self.shard_regions(unplaced=False)
+            ) as shard_paths:
+                pileup = []
+                for shard_path in shard_paths:
+                    with open(shard_path, 'rb') as f:
+                        pileup.append(f.read())
+                return b''.join(pileup)
+        return self.run_with_bam(
             (
                 'samtools', 'mpileup',
                 '-f', reference_genome,
                 '-l', positions,
                 '-'
-            ),
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=self.log
-        ) as samtools_mpileup:
-            return samtools_mpileup.communicate(self.bam)[0]
+            )
+        )
     
+    def shard_regions(self, unplaced=True):
+        """Regions into which the BAM data is split for sharded operations
+        
+        Parameters
+        ----------
+        unplaced : bool
+            If True, include a final ``*`` region for reads with no
+            coordinates
+        
+        Returns
+        -------
+        tuple
+            names of the reference sequences that have reads, in header order
+        """
+        
+        stats = self.idxstats()
+        return tuple(
+            name for name, _, mapped, unmapped in stats[:-1]
+            if mapped + unmapped
+        ) + (('*',) if unplaced and stats[-1][3] else ())
+    
+    @contextlib.contextmanager
+    def scatter(self, shard_commands, regions=None):
+        """Run commands on regions of the BAM data in parallel
+        
+        The BAM data must be indexed. Up to ``processes`` regions are
+        processed at a time, each by its own pipeline of subprocesses, and
+        the core budget is divided among the regions processed at the same
+        time. samtools commands without a ``-@`` option are given threads
+        from the share of their region.
+        
+        Parameters
+        ----------
+        shard_commands
+            function taking the path to the indexed BAM file and a region and
+            returning argument tuples for a pipeline processing that region
+        regions : iterable
+            regions to process, defaults to shard_regions(). The regions must
+            not share reads, or those reads are processed more than once.
+        
+        Yields
+        ------
+        list
+            paths to temporary files holding the output for each region, in
+            order
+        """
+        
+        if not self.index:
+            raise RuntimeError(
+                'use SequenceAlignment.samtools_index() before running '
+                'sharded operations'
+            )
+        regions = tuple(regions) if regions else self.shard_regions()
+        workers = max(1, min(self.processes, len(regions)))
+        shard_budget = CoreBudget(
+            self.core_budget.cores // workers,
+            costs=self.core_budget.costs
+        )
+        with self.indexed_bam_file() as bam_path, (
+            tempfile.TemporaryDirectory(dir=self.temp_dir)
+        ) as temp_dir, concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers
+        ) as executor:
+            shard_paths = [
+                os.path.join(temp_dir, f'shard{i}') for i in range(len(regions))
+            ]
+            
+            def run_shard(shard_path, region):
+                with open(shard_path, 'wb') as stdout:
+                    run_pipeline(
+                        *(
+                            with_compression(
+                                command,
+                                self.intermediate_compression
+                            )
+                            for command in shard_budget.assign_threads(
+                                *shard_commands(bam_path, region)
+                            )
+                        ),
+                        stdout=stdout,
+                        log=self.log,
+                        check=True
+                    )
+            
+            for future in [
+                executor.submit(run_shard, shard_path, region)
+                for shard_path, region in zip(shard_paths, regions)
+            ]:
+                future.result()
+            yield shard_paths
+    
+    def region_shards(self, regions):
+        """Group regions into shards, one for each reference sequence
+        
+        Parameters
+        ----------
+        regions : iterable
+            regions in samtools format
+        
+        Returns
+        -------
+        tuple
+            tuples of regions on the same reference sequence, in header
+            order, with any ``*`` region last
+        """
+        
+        _, references = read_bam_header(self.bam)
+        shards = {}
+        for region in regions:
+            reference_id, _, _ = parse_region(region, references)
+            shards.setdefault(
+                reference_id if reference_id >= 0 else len(references),
+                []
+            ).append(region)
+        return tuple(tuple(shards[key]) for key in sorted(shards))
+    
+    @profiled
+    def scatter_gather(self, *commands, view_options=(), regions=None):
+        """Extract each region of the BAM data with samtools view, pipe it
+        through commands in parallel, and concatenate the results in order
+        
+        Regions are grouped into one shard per reference sequence (see
+        region_shards()), and the regions of a shard are extracted by one
+        samtools view with the multi-region iterator (``-M``). A read that
+        overlaps several regions, e.g. across the boundary of ``chr1:1-100``
+        and ``chr1:101-200``, is therefore output once.
+        
+        Parameters
+        ----------
+        *commands
+            argument tuples for subprocess.Popen, each reading and writing
+            BAM data
+        view_options : tuple
+            options for the samtools view command extracting each region
+        regions : iterable
+            regions to process, defaults to shard_regions()
+        """
+        
+        with self.scatter(
+            lambda bam_path, shard: (
+                ('samtools', 'view', '-bh')
+                + (len(shard) > 1) * ('-M',)
+                + tuple(view_options)
+                + (bam_path,)
+                + shard,
+            ) + commands,
+            regions=(
+                self.region_shards(regions) if regions
+                else tuple((name,) for name in self.shard_regions())
+            )
+        ) as shard_paths:
+            self.replace_bam(
+                self.capture_bam(
+                    lambda stdout: run_pipeline(
+                        ('samtools', 'cat') + tuple(shard_paths),
+                        stdout=stdout,
+                        log=self.log,
+                        check=True
+                    )
+                ),
+                preserves_order=True
+            )
+    
+    @profiled
     def samtools_fixmate(self):
         """Apply samtools fixmate to the alignment"""
         
-        self.bam = samtools_fixmate(self.bam, log=self.log)
+        self.transform(
+            ('samtools', 'fixmate', '-r', '-', '-'),
+            preserves_order=True
+        )
     
+    @profiled
     def write(self, bam_file_path):
         """Write a BAM file to disk, along with an index if one is present
         
+        BAM data stored on disk is copied by the kernel with send_file(),
+        without passing through the memory of this process. If a compression
+        level is set for intermediate or output data, the data is instead
+        recompressed at the output level by samtools view, using
+        output_threads threads, and any index is rebuilt in the same pass.
+        
+        If the path ends in ``.cram`` the data is written as CRAM, with a
+        CRAI index if an index is present (see write_cram()).
+        
         Parameters
         ----------
         bam_file_path : str
             Path where the BAM file will be written
         """
         
-        with open(bam_file_path, 'wb') as f:
-            f.write(self.bam)
+        if bam_file_path.endswith('.cram'):
+            self.write_cram(bam_file_path)
+            self.bam_file_path = bam_file_path
+            return
+        bam = self.bam
+        if (
+            self.intermediate_compression is not None
+            or self.output_compression is not None
+        ):
+            self.recompress(bam_file_path)
+            self.bam_file_path = bam_file_path
+            return
+        if self.bam_storage:
+            with self.bam_storage.open() as source, open(
+                bam_file_path,
+                'wb'
+            ) as f:
+                self.bytes_copied += send_file(source, f)
+        else:
+            with open(bam_file_path, 'wb') as f:
+                f.write(bam)
+            self.bytes_copied += len(bam)
         self.bam_file_path = bam_file_path
         if self.index:
-            with open('{}.bai'.format(bam_file_path), 'wb') as f:
+            with open(f'{bam_file_path}.{self.index_format}', 'wb') as f:
                 f.write(self.index)
     
-    def clean_up(self, path):
-        """Remove a file
+    def write_cram(self, cram_file_path):
+        """Write the data to disk as CRAM, along with a CRAI index if an
+        index is present
+        
+        Data already held as CRAM is copied as it is, unless an output
+        compression level is set. Otherwise the BAM data is encoded with
+        samtools view against reference_genome_path, using output_threads
+        threads, and the index is built in the same pass.
         
         Parameters
         ----------
-        path
-            path to file that will be removed
+        cram_file_path : str
+            Path where the CRAM file will be written
+        
+        Raises
+        ------
+        AlignmentError
+            If samtools fails, in which case any partial output is removed
         """
         
-        if (os.path.isfile(path) if path else False):
-            os.remove(path)
-
-
-class BWA():
-    """A class with methods for calling BWA
-    
-    Notes
-    -----
-    BWA defaults:
+        if self.pending_alignment or self.filter_plan:
+            self.bam
+        index_path = (
+            f'{cram_file_path}.crai'
+            if self.is_sorted and self._index is not None else None
+        )
+        try:
+            if self.cram is not None and self.output_compression is None:
+                with open(cram_file_path, 'wb') as f:
+                    if isinstance(self.cram, SpilledBAM):
+                        with self.cram.open() as source:
+                            self.bytes_copied += send_file(source, f)
+                    else:
+                        f.write(self.cram)
+                        self.bytes_copied += len(self.cram)
+                if index_path:
+                    run_pipeline(
+                        *self.tool_commands(
+                            (
+                                'samtools', 'index',
+                                '-o', index_path,
+                                cram_file_path
+                            )
+                        ),
+                        log=self.log,
+                        check=True
+                    )
+                return
+            self.run_with_bam(
+                (
+                    'samtools', 'view', '-hC',
+                    '-T', self.reference_genome_path,
+                    '-@', str((self.output_threads or self.processes) - 1)
+                )
+                + (self.output_compression is not None) * (
+                    '--output-fmt-option', f'level={self.output_compression}'
+                )
+                + (
+                    (
+                        '-o', f'{cram_file_path}##idx##{index_path}',
+                        '--write-index'
+                    )
+                    if index_path else ('-o', cram_file_path)
+                )
+                + ('-',),
+                stdout=subprocess.DEVNULL,
+                check=True
+            )
+        except BaseException:
+            self.clean_up(cram_file_path)
+            self.clean_up(index_path)
+            raise
+    
+    def recompress(self, bam_file_path):
+        """Write the BAM data to disk at the output compression level,
+        along with an index if one is present
+        
+        Parameters
+        ----------
+        bam_file_path : str
+            Path where the BAM file will be written
+        
+        Raises
+        ------
+        AlignmentError
+            If samtools fails, in which case any partial output is removed
+        """
+        
+        index_path = (
+            f'{bam_file_path}.{self.index_format}'
+            if self.is_sorted and self._index is not None else None
+        )
+        try:
+            self.run_with_bam(
+                (
+                    'samtools', 'view', '-bh',
+                    '-@', str((self.output_threads or self.processes) - 1)
+                )
+                + compression_options(
+                    6 if self.output_compression is None
+                    else self.output_compression
+                )
+                + (
+                    (
+                        '-o', f'{bam_file_path}##idx##{index_path}',
+                        '--write-index'
+                    )
+                    if index_path else ('-o', bam_file_path)
+                )
+                + ('-',),
+                stdout=subprocess.DEVNULL,
+                check=True
+            )
+        except BaseException:
+            self.clean_up(bam_file_path)
+            self.clean_up(index_path)
+            raise
+    
+    def clean_up(self, path):
+        """Remove a file
+        
+        Parameters
+        ----------
+        path
+            path to file that will be removed
+        """
+        
+        if (os.path.isfile(path) if path else False):
+            os.remove(path)
+
+    @classmethod
+    async def create_async(cls, input_file, **kwargs):
+        """Create a SequenceAlignment without blocking the event loop
+        
+        A BAM or SAM file on disk is loaded in a worker thread, and raw reads
+        are aligned with align_reads_async() unless lazy is True.
+        
+        Parameters
+        ----------
+        input_file : bytes, SpilledBAM, tuple, list, str
+            Sequencing data, as for SequenceAlignment()
+        **kwargs
+            other parameters for SequenceAlignment()
+        
+        Returns
+        -------
+        SequenceAlignment
+            the new alignment
+        """
+        
+        lazy = kwargs.pop('lazy', False)
+        sa = await asyncio.to_thread(cls, input_file, lazy=True, **kwargs)
+        sa.lazy = lazy
+        if not lazy:
+            await sa.bam_async()
+        return sa
+    
+    async def bam_async(self):
+        """Aligned sequencing data in BAM format, with any pending alignment
+        and filters applied without blocking the event loop
+        
+        Returns
+        -------
+        bytes or memoryview
+            The BAM data
+        """
+        
+        if self.pending_alignment:
+            self.store(await self.capture_bam_async(self.align_reads_async))
+            self.pending_alignment = False
+        if self.cram is not None:
+            await asyncio.to_thread(self.decode_cram)
+        if self.filter_plan:
+            plan, self.filter_plan = self.filter_plan, None
+            try:
+                self.store(await self.run_filter_plan_async(plan))
+            except BaseException:
+                self.filter_plan = plan
+                raise
+        return self._bam
+    
+    async def capture_bam_async(self, produce):
+        """Capture BAM data produced by a coroutine function, spilling it to
+        disk if it is larger than spill_threshold
+        
+        Parameters
+        ----------
+        produce
+            a coroutine function taking a stdout argument, as for
+            asyncio.create_subprocess_exec, and returning the BAM data if
+            stdout is subprocess.PIPE
+        
+        Returns
+        -------
+        bytes or SpilledBAM
+            The BAM data
+        """
+        
+        bam = await capture_bam_async(
+            produce,
+            spill_threshold=self.spill_threshold,
+            temp_dir=self.temp_dir
+        )
+        if bam is not None and not isinstance(bam, SpilledBAM):
+            self.bytes_copied += len(bam)
+        return bam
+    
+    async def run_with_bam_async(
+        self,
+        *commands,
+        stdout=subprocess.PIPE,
+        check=False
+    ):
+        """Run commands connected through pipes, with the BAM data as input,
+        as for run_with_bam()
+        
+        Parameters
+        ----------
+        *commands
+            argument tuples for asyncio.create_subprocess_exec
+        stdout
+            destination for the output of the last command
+        check : bool
+            If True, raise an AlignmentError if any command fails
+        
+        Returns
+        -------
+        bytes
+            output of the last command, or None if stdout is not
+            subprocess.PIPE
+        """
+        
+        bam = await self.bam_async()
+        commands = self.tool_commands(*commands)
+        if self.bam_storage:
+            with self.bam_storage.open() as stdin:
+                return await run_pipeline_async(
+                    *commands,
+                    stdin=stdin,
+                    stdout=stdout,
+                    log=self.log,
+                    check=check
+                )
+        self.bytes_copied += len(bam)
+        return await run_pipeline_async(
+            *commands,
+            input=bam,
+            stdout=stdout,
+            log=self.log,
+            check=check
+        )
+    
+    @profiled
+    async def align_reads_async(self, stdout=subprocess.PIPE):
+        """Align raw reads using the provided aligner, as for align_reads()
+        
+        BWA mem and Bowtie2 alignments run as asyncio subprocesses. Sharded
+        or cached alignments, bwa aln and other aligners run in a worker
+        thread.
+        
+        Parameters
+        ----------
+        stdout
+            Destination for the aligned BAM data
+        
+        Returns
+        -------
+        bytes
+            A BAM File in memory, or None if stdout was redirected
+        """
+        
+        if not self.aligner:
+            self.aligner = BWA()
+        streams = (
+            isinstance(self.aligner, (BWA, Bowtie2))
+            and not self.aligner.alignment_cache
+            and not self.alignment_shard_reads
+            and (
+                isinstance(self.aligner, Bowtie2)
+                or await asyncio.to_thread(
+                    self.aligner.select_algorithm,
+                    self
+                ) == 'mem'
+            )
+        )
+        if not streams:
+            return await asyncio.to_thread(self.align_reads, stdout)
+        return await run_pipeline_async(
+            *self.aligner.commands(self),
+            stdout=stdout,
+            log=self.log,
+            check=True
+        )
+    
+    @profiled
+    async def samtools_view_async(
+        self,
+        *options,
+        mapping_quality=None,
+        regions=None,
+        **filters
+    ):
+        """Apply a filter to the BAM data with samtools view, as for
+        samtools_view()
+        
+        Parameters
+        ----------
+        *options
+            options to pass to samtools view
+        mapping_quality : int
+            minimum MAPQ score, defaults to the mapping_quality attribute
+        regions : iterable
+            regions to restrict the data to (requires an index)
+        **filters
+            remove_* keyword arguments, as for samtools_view()
+        """
+        
+        plan = FilterPlan.from_filters(
+            *options,
+            mapping_quality=(
+                self.mapping_quality
+                if mapping_quality is None
+                else mapping_quality
+            ),
+            regions=regions,
+            **filters
+        )
+        if not self.defer_filter(plan):
+            self.replace_bam(
+                await self.run_filter_plan_async(plan),
+                preserves_order=True
+            )
+    
+    async def run_filter_plan_async(self, plan):
+        """Apply a FilterPlan to the BAM data in a single samtools view pass,
+        as for run_filter_plan()
+        
+        Parameters
+        ----------
+        plan : FilterPlan
+            the filters to apply
+        
+        Returns
+        -------
+        bytes or SpilledBAM
+            The filtered BAM data
+        """
+        
+        args, = self.tool_commands(
+            ('samtools', 'view', '-bh') + plan.options()
+        )
+        if not plan.regions:
+            return await self.capture_bam_async(
+                lambda stdout: self.run_with_bam_async(
+                    args,
+                    stdout=stdout,
+                    check=True
+                )
+            )
+        if not await self.index_async():
+            raise RuntimeError(
+                'use SequenceAlignment.samtools_index_async() before '
+                'restricting to regions'
+            )
+        with contextlib.ExitStack() as stack:
+            stdin = await asyncio.to_thread(
+                stack.enter_context,
+                self.region_stream(plan.regions)
+            )
+            return await self.capture_bam_async(
+                lambda stdout: run_pipeline_async(
+                    args,
+                    stdin=stdin,
+                    stdout=stdout,
+                    log=self.log,
+                    check=True
+                )
+            )
+    
+    async def remove_unpaired_reads_async(self):
+        """Remove unpaired (or improperly paired) reads from the BAM data using
+        samtools view
+        """
+        
+        await self.samtools_view_async(remove_unpaired=True)
+    
+    async def remove_supplementary_alignments_async(self):
+        """Remove supplementary alignments from the BAM data using samtools
+        view
+        """
+        
+        await self.samtools_view_async(remove_supplementary=True)
+    
+    async def apply_quality_filter_async(self):
+        """Apply a quality filter to the BAM data using samtools view, with 
+        flags: -F 1804 -q {mapping_quality}
+        """
+        
+        await self.samtools_view_async(
+            '-F', '1804', '-q', str(self.mapping_quality)
+        )
+    
+    async def restrict_chromosomes_async(self, *chromosomes):
+        """Restrict the BAM data to reads on certain chromosomes
+        
+        Parameters
+        ----------
+        *chromosomes
+            the chromosomes to include
+        """
+        
+        if not await self.index_async():
+            raise RuntimeError(
+                'use SequenceAlignment.samtools_index_async() before using '
+                'SequenceAlignment.restrict_chromosomes_async()'
+            )
+        await self.samtools_view_async(
+            regions=tuple(
+                f'chr{c}'.replace('chrchr', 'chr') for c in chromosomes
+            )
+        )
+
+    @profiled
+    async def samtools_sort_async(
+        self,
+        memory_limit=None,
+        index=False,
+        csi=False
+    ):
+        """Sort the BAM data using samtools, as for samtools_sort()
+        
+        Parameters
+        ----------
+        memory_limit : float
+            maximum memory in GB. If None, only available memory is considered
+        index : bool
+            If True, build the index while sorting
+        csi : bool
+            If True, build a CSI index instead of a BAI index
+        
+        Returns
+        -------
+        dict
+            the plan from plan_sort(). The ``peak_memory`` of samtools sort
+            is None, since asyncio does not report the resource usage of
+            subprocesses.
+        """
+        
+        bam = await self.bam_async()
+        plan = self.plan_sort(memory_limit)
+        sorted_bam = SpilledBAM(temp_dir=self.temp_dir)
+        index_format = 'csi' if csi else 'bai'
+        try:
+            with tempfile.TemporaryDirectory(dir=self.temp_dir) as temp_dir:
+                index_path = (
+                    os.path.join(temp_dir, f'index.{index_format}')
+                    if index or csi else None
+                )
+                await self.run_with_bam_async(
+                    self.sort_command(
+                        plan,
+                        temp_dir,
+                        sorted_bam.name,
+                        index_path
+                    ),
+                    stdout=sorted_bam.file,
+                    check=True
+                )
+                if index_path:
+                    with open(index_path, 'rb') as f:
+                        sorted_index = f.read()
+            del bam
+            await asyncio.to_thread(self.load_sorted, sorted_bam)
+        except BaseException:
+            sorted_bam.close()
+            raise
+        self.is_sorted = True
+        if index or csi:
+            self.index, self.index_format = sorted_index, index_format
+        plan['peak_memory'] = None
+        self.sort_report = plan
+        return plan
+
+    @profiled
+    async def samtools_index_async(self, csi=False):
+        """Index the BAM data, as for samtools_index()
+        
+        Parameters
+        ----------
+        csi : bool
+            If True, build a CSI index instead of a BAI index
+        """
+        
+        if not self.is_sorted:
+            raise Exception('BAM must be sorted before it can be indexed')
+        await self.bam_async()
+        index_format = 'csi' if csi else 'bai'
+        with contextlib.ExitStack() as stack:
+            bam_path = await asyncio.to_thread(
+                stack.enter_context,
+                self.bam_file()
+            )
+            temp_dir = stack.enter_context(
+                tempfile.TemporaryDirectory(dir=self.temp_dir)
+            )
+            index_path = os.path.join(temp_dir, f'index.{index_format}')
+            await run_pipeline_async(
+                *self.tool_commands(
+                    ('samtools', 'index')
+                    + csi * ('-c',)
+                    + ('-o', index_path, bam_path)
+                ),
+                log=self.log,
+                check=True
+            )
+            with open(index_path, 'rb') as f:
+                self.index = f.read()
+        self.index_format = index_format
+
+    async def index_async(self):
+        """The index of the BAM data, rebuilt with samtools_index_async() if
+        the data has changed but is still sorted, as for the index attribute
+        
+        Returns
+        -------
+        bytes
+            the BAI or CSI index, or None
+        """
+        
+        await self.bam_async()
+        if (
+            self._index is not None
+            and self.index_version != self.version
+            and self.is_sorted
+        ):
+            await self.samtools_index_async(csi=self.index_format == 'csi')
+        return self.index
+    
+    async def idxstats_async(self):
+        """Count reads per reference sequence, as for idxstats()
+        
+        Returns
+        -------
+        list
+            (name, length, mapped, unmapped) tuples
+        """
+        
+        await self.index_async()
+        return self.idxstats()
+
+    async def percent_mitochondrial_async(
+        self,
+        mitochondrial_chromosome='chrM'
+    ):
+        """Fraction of reads on the mitochondrial chromosome
+        
+        Parameters
+        ----------
+        mitochondrial_chromosome : str
+            name of the mitochondrial chromosome in the BAM header
+        
+        Returns
+        -------
+        float
+            the fraction of reads that are mitochondrial
+        """
+        
+        await self.index_async()
+        return self.percent_mitochondrial(mitochondrial_chromosome)
+    
+    async def percent_blacklisted_async(self, blacklist_path, remove=False):
+        """Fraction of reads overlapping regions in a BED file, as for
+        percent_blacklisted()
+        
+        The scan runs in a worker thread.
+        
+        Parameters
+        ----------
+        blacklist_path : str
+            Path to a BED file on disk
+        remove : bool
+            If True, also remove the blacklisted reads
+        
+        Returns
+        -------
+        float
+            the fraction of reads that are blacklisted
+        """
+        
+        await self.bam_async()
+        return await asyncio.to_thread(
+            self.percent_blacklisted,
+            blacklist_path,
+            remove=remove
+        )
+
+
+class BWA():
+    """A class with methods for calling BWA
+    
+    Notes
+    -----
+    BWA defaults:
         trim_qual:     0
         seed_len:      inf
         max_seed_diff: 2
@@ -575,6 +2742,13 @@ class BWA():
     algorithm_switch_bp : int
         Read length at which the algorithm will automatically switch from aln
         to mem [70]
+    read_metadata_cache : ReadMetadataCache
+        If set, read lengths are looked up in this cache before sampling
+    alignment_cache : AlignmentCache
+        If set, alignments are looked up in this cache before running bwa
+    intermediate_compression : int
+        Compression level of the BAM output (0 for uncompressed), or None
+        to use that of the SequenceAlignment
     """
     
     def __init__(
@@ -585,7 +2759,10 @@ class BWA():
         max_seed_diff=2,
         max_reads_for_length_check=int(1e6),
         algorithm=None,
-        algorithm_switch_bp=70
+        algorithm_switch_bp=70,
+        read_metadata_cache=None,
+        alignment_cache=None,
+        intermediate_compression=None
     ):
         """Set the parameters for sequence alignment with BWA
         
@@ -601,6 +2778,12 @@ class BWA():
             Maximum mismatches in seed before a read is dropped [2]
         max_reads_for_length_check : int
             Maximum number of reads to use for read length checking [1e6]
+        read_metadata_cache : ReadMetadataCache
+            cache for read length metadata
+        alignment_cache : AlignmentCache
+            cache for aligned BAM data
+        intermediate_compression : int
+            compression level of the BAM output
         """
         
         self.reference_genome_path = reference_genome_path
@@ -610,48 +2793,38 @@ class BWA():
         self.max_reads_for_length_check = max_reads_for_length_check
         self.algorithm = algorithm
         self.algorithm_switch_bp = algorithm_switch_bp
+        self.read_metadata_cache = read_metadata_cache
+        self.alignment_cache = alignment_cache
+        self.intermediate_compression = intermediate_compression
     
     def __repr__(self):
         return 'BWA()'
     
-    def __call__(self, sequence_alignment, temp_dir=None):
-        """Perform sequence alignment using an appropriate algorithm
-        
-        First, read lengths are checked to determine the appropriate algorithm,
-        then the alignment is carried out.
+    def compression_level(self, sequence_alignment):
+        """Compression level of the BAM output for a SequenceAlignment
         
         Parameters
         ----------
         sequence_alignment : SequenceAlignment
             a SequenceAlignemnt object
-        temp_dir : str
-            directory for temporary files
         
         Returns
         -------
-        bytes
-            A BAM file in memory
+        int
+            compression level, or None for the samtools default
         """
         
-        if self.algorithm == 'aln':
-            return self.bwa_aln(sequence_alignment, temp_dir=temp_dir)
-        if self.algorithm == 'mem':
-            return self.bwa_mem(sequence_alignment)
-        
-        median_read_length = get_median_read_length(
-            sequence_alignment.raw_reads_path,
-            self.max_reads_for_length_check
-        )
-        if median_read_length <= self.algorithm_switch_bp:
-            return self.bwa_aln(sequence_alignment, temp_dir=temp_dir)
-        elif median_read_length > self.algorithm_switch_bp:
-            return self.bwa_mem(sequence_alignment)
+        if self.intermediate_compression is None:
+            return sequence_alignment.intermediate_compression
+        return self.intermediate_compression
     
-    def bwa_aln(self, sequence_alignment, temp_dir=None):
-        """Perform sequence alignment using the bwa aln algorithm
-        
-        Single-end and paired end reads are handled appropriately based on the
-        type of the SequenceAlignment's raw reads path
+    def __call__(
+        self,
+        sequence_alignment,
+        temp_dir=None,
+        stdout=subprocess.PIPE
+    ):
+        """Perform sequence alignment, or fetch it from the alignment cache
         
         Parameters
         ----------
@@ -659,28 +2832,169 @@ class BWA():
             a SequenceAlignemnt object
         temp_dir : str
             directory for temporary files
+        stdout
+            destination for the BAM output, as for subprocess.Popen
         
         Returns
         -------
         bytes
-            A BAM file
+            A BAM file in memory, or None if stdout is not subprocess.PIPE
         """
         
-        if not isinstance(sequence_alignment.raw_reads_path, str):
-            with tempfifo.NamedTemporaryFIFO(dir=temp_dir) as (
-                sai_pipe_0
-            ), tempfifo.NamedTemporaryFIFO(dir=temp_dir) as (
-                sai_pipe_1
-            ):
-                with subprocess.Popen(
-                    (
+        if not self.alignment_cache:
+            return self.align(
+                sequence_alignment,
+                temp_dir=temp_dir,
+                stdout=stdout
+            )
+        return self.alignment_cache.fetch_or_align(
+            lambda stdout: self.align(
+                sequence_alignment,
+                temp_dir=temp_dir,
+                stdout=stdout
+            ),
+            self.cache_key(sequence_alignment),
+            stdout=stdout
+        )
+    
+    def cache_key(self, sequence_alignment):
+        """Key for the alignment of a SequenceAlignment's raw reads in the
+        alignment cache
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        
+        Returns
+        -------
+        str
+            cache key
+        """
+        
+        return self.alignment_cache.key(
+            (
+                'bwa',
+                self.trim_qual,
+                self.seed_len,
+                self.max_seed_diff,
+                self.algorithm,
+                self.algorithm_switch_bp,
+                sequence_alignment.mapping_quality
+            ),
+            sequence_alignment.raw_reads_path,
+            self.reference_genome_path
+        )
+    
+    def select_algorithm(self, sequence_alignment):
+        """Choose between the aln and mem algorithms based on read length
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        
+        Returns
+        -------
+        str
+            ``aln`` or ``mem``
+        """
+        
+        if self.algorithm:
+            return self.algorithm
+        median_read_length = get_median_read_length(
+            sequence_alignment.raw_reads_path,
+            self.max_reads_for_length_check,
+            cache=self.read_metadata_cache
+        )
+        return (
+            'aln' if median_read_length <= self.algorithm_switch_bp else 'mem'
+        )
+    
+    def align(
+        self,
+        sequence_alignment,
+        temp_dir=None,
+        stdout=subprocess.PIPE
+    ):
+        """Perform sequence alignment using an appropriate algorithm
+        
+        First, read lengths are checked to determine the appropriate algorithm,
+        then the alignment is carried out.
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        temp_dir : str
+            directory for temporary files
+        stdout
+            destination for the BAM output, as for subprocess.Popen
+        
+        Returns
+        -------
+        bytes
+            A BAM file in memory, or None if stdout is not subprocess.PIPE
+        """
+        
+        if self.select_algorithm(sequence_alignment) == 'aln':
+            return self.bwa_aln(
+                sequence_alignment,
+                temp_dir=temp_dir,
+                stdout=stdout
+            )
+        return self.bwa_mem(sequence_alignment, stdout=stdout)
+    
+    def bwa_aln(
+        self,
+        sequence_alignment,
+        temp_dir=None,
+        stdout=subprocess.PIPE
+    ):
+        """Perform sequence alignment using the bwa aln algorithm
+        
+        Single-end and paired end reads are handled appropriately based on the
+        type of the SequenceAlignment's raw reads path
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        temp_dir : str
+            directory for temporary files
+        stdout
+            destination for the BAM output, as for subprocess.Popen
+        
+        Returns
+        -------
+        bytes
+            A BAM file, or None if stdout is not subprocess.PIPE
+        """
+        
+        if not isinstance(sequence_alignment.raw_reads_path, str):
+            aln_threads_0, aln_threads_1, _, view_threads = (
+                sequence_alignment.core_budget.allocate(
+                    'bwa aln', 'bwa aln', 'bwa sampe', 'samtools view'
+                )
+            )
+            with tempfifo.NamedTemporaryFIFO(dir=temp_dir) as (
+                sai_pipe_0
+            ), tempfifo.NamedTemporaryFIFO(dir=temp_dir) as (
+                sai_pipe_1
+            ):
+                with subprocess.Popen(
+                    (
                         'sh', '-c',
                         (
-                            'bwa sampe {0} {1} {2} {3} {4} & '
+                            'bwa sampe {0} {1} {2} {3} {4} & sampe=$!; '
                             'bwa aln -t {5} -q {6} -l {7} -k {8} {0} {3} > '
-                            '{1} & '
-                            'bwa aln -t {5} -q {6} -l {7} -k {8} {0} {4} > '
-                            '{2} & '
+                            '{1} & aln0=$!; '
+                            'bwa aln -t {9} -q {6} -l {7} -k {8} {0} {4} > '
+                            '{2} & aln1=$!; '
+                            'status=0; '
+                            'for job in $sampe $aln0 $aln1; do '
+                            'wait $job || status=1; done; '
+                            'exit $status'
                         )
                         .format(
                             self.reference_genome_path,
@@ -688,10 +3002,11 @@ class BWA():
                             sai_pipe_1.name,
                             sequence_alignment.raw_reads_path[0],
                             sequence_alignment.raw_reads_path[1],
-                            math.floor(sequence_alignment.processes / 2),
+                            aln_threads_0,
                             self.trim_qual,
                             self.seed_len,
-                            self.max_seed_diff
+                            self.max_seed_diff,
+                            aln_threads_1
                         )
                     ),
                     stdout=subprocess.PIPE,
@@ -701,27 +3016,37 @@ class BWA():
                         (
                             'samtools', 'view',
                             '-Sbq', str(sequence_alignment.mapping_quality),
-                            '-@', str(sequence_alignment.processes - 1)
+                            '-@', str(view_threads - 1)
+                        ) + compression_options(
+                            self.compression_level(sequence_alignment)
                         ),
                         stdin=bwa_aln_sampe.stdout,
-                        stdout=subprocess.PIPE,
+                        stdout=stdout,
                         stderr=sequence_alignment.log
                     ) as samtools_view:
-                        return samtools_view.communicate()[0]
+                        bam = samtools_view.communicate()[0]
+            check_returncodes(bwa_aln_sampe, samtools_view)
+            return bam
         else:
+            aln_threads, _, view_threads = (
+                sequence_alignment.core_budget.allocate(
+                    'bwa aln', 'bwa samse', 'samtools view'
+                )
+            )
             with tempfifo.NamedTemporaryFIFO(dir=temp_dir) as sai_pipe:
                 with subprocess.Popen(
                     (
                         'sh', '-c',
                         (
-                            'bwa samse {0} {1} {2} & '
-                            'bwa aln -t {3} -q {4} -l {5} -k {6} {0} {2} > {1}; '
+                            'bwa samse {0} {1} {2} & samse=$!; '
+                            'bwa aln -t {3} -q {4} -l {5} -k {6} {0} {2} > {1} '
+                            '&& wait $samse'
                         )
                         .format(
                             self.reference_genome_path,
                             sai_pipe.name,
                             sequence_alignment.raw_reads_path,
-                            sequence_alignment.processes,
+                            aln_threads,
                             self.trim_qual,
                             self.seed_len,
                             self.max_seed_diff
@@ -736,16 +3061,20 @@ class BWA():
                                 '-bhq', str(
                                     sequence_alignment.mapping_quality
                                 ),
-                                '-@', str(sequence_alignment.processes - 1)
+                                '-@', str(view_threads - 1)
+                            ) + compression_options(
+                                self.compression_level(sequence_alignment)
                             ),
                             stdin=bwa_aln_samse.stdout,
-                            stdout=subprocess.PIPE,
+                            stdout=stdout,
                             stderr=sequence_alignment.log
                         ) as samtools_view:
-                            return samtools_view.communicate()[0]
+                            bam = samtools_view.communicate()[0]
+            check_returncodes(bwa_aln_samse, samtools_view)
+            return bam
     
-    def bwa_mem(self, sequence_alignment):
-        """Perform sequence alignment using the bwa mem algorithm
+    def commands(self, sequence_alignment):
+        """Commands for the bwa mem algorithm, piped into samtools view
         
         Parameters
         ----------
@@ -754,13 +3083,16 @@ class BWA():
         
         Returns
         -------
-        bytes
-            A BAM file
+        tuple
+            argument tuples for bwa mem and samtools view
         """
         
-        with subprocess.Popen(
+        mem_threads, view_threads = sequence_alignment.core_budget.allocate(
+            'bwa mem', 'samtools view'
+        )
+        return (
             (
-                'bwa', 'mem', '-M', '-t', str(sequence_alignment.processes),
+                'bwa', 'mem', '-M', '-t', str(mem_threads),
                 self.reference_genome_path
             )
             + (
@@ -768,20 +3100,44 @@ class BWA():
                 if not isinstance(sequence_alignment.raw_reads_path, str)
                 else (sequence_alignment.raw_reads_path,)
             ),
+            (
+                'samtools', 'view',
+                '-bhq', str(sequence_alignment.mapping_quality),
+                '-@', str(view_threads - 1)
+            ) + compression_options(self.compression_level(sequence_alignment))
+        )
+    
+    def bwa_mem(self, sequence_alignment, stdout=subprocess.PIPE):
+        """Perform sequence alignment using the bwa mem algorithm
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        stdout
+            destination for the BAM output, as for subprocess.Popen
+        
+        Returns
+        -------
+        bytes
+            A BAM file, or None if stdout is not subprocess.PIPE
+        """
+        
+        mem_command, view_command = self.commands(sequence_alignment)
+        with subprocess.Popen(
+            mem_command,
             stdout=subprocess.PIPE,
             stderr=sequence_alignment.log
         ) as bwa_mem:
             with subprocess.Popen(
-                (
-                    'samtools', 'view',
-                    '-bhq', str(sequence_alignment.mapping_quality),
-                    '-@', str(sequence_alignment.processes - 1)
-                ),
+                view_command,
                 stdin=bwa_mem.stdout,
-                stdout=subprocess.PIPE,
+                stdout=stdout,
                 stderr=sequence_alignment.log
             ) as samtools_view:
-                return samtools_view.communicate()[0]
+                bam = samtools_view.communicate()[0]
+        check_returncodes(bwa_mem, samtools_view)
+        return bam
 
 
 class Bowtie2():
@@ -791,25 +3147,127 @@ class Bowtie2():
     ----------
     index
         prefix for bowtie2 index
+    alignment_cache : AlignmentCache
+        cache for aligned BAM data
+    intermediate_compression : int
+        compression level of the BAM output
     
     Attributes
     ----------
     index
         prefix for bowtie2 index
+    alignment_cache : AlignmentCache
+        If set, alignments are looked up in this cache before running bowtie2
+    intermediate_compression : int
+        Compression level of the BAM output (0 for uncompressed), or None
+        to use that of the SequenceAlignment
     """
 
-    def __init__(self, index=pyhg19.BOWTIE2_INDEX):
+    def __init__(
+        self,
+        index=pyhg19.BOWTIE2_INDEX,
+        alignment_cache=None,
+        intermediate_compression=None
+    ):
         self.index = index
+        self.alignment_cache = alignment_cache
+        self.intermediate_compression = intermediate_compression
 
     def __repr__(self):
         return f'Bowtie2(index={self.index})'
+    
+    def compression_level(self, sequence_alignment):
+        """Compression level of the BAM output for a SequenceAlignment
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        
+        Returns
+        -------
+        int
+            compression level, or None for the samtools default
+        """
+        
+        if self.intermediate_compression is None:
+            return sequence_alignment.intermediate_compression
+        return self.intermediate_compression
 
-    def __call__(self, sequence_alignment):
-        with subprocess.Popen(
+    def __call__(
+        self,
+        sequence_alignment,
+        temp_dir=None,
+        stdout=subprocess.PIPE
+    ):
+        """Perform sequence alignment, or fetch it from the alignment cache
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        temp_dir : str
+            directory for temporary files (unused)
+        stdout
+            destination for the BAM output, as for subprocess.Popen
+        
+        Returns
+        -------
+        bytes
+            A BAM file, or None if stdout is not subprocess.PIPE
+        """
+        
+        if not self.alignment_cache:
+            return self.align(sequence_alignment, stdout=stdout)
+        return self.alignment_cache.fetch_or_align(
+            lambda stdout: self.align(sequence_alignment, stdout=stdout),
+            self.cache_key(sequence_alignment),
+            stdout=stdout
+        )
+    
+    def cache_key(self, sequence_alignment):
+        """Key for the alignment of a SequenceAlignment's raw reads in the
+        alignment cache
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        
+        Returns
+        -------
+        str
+            cache key
+        """
+        
+        return self.alignment_cache.key(
+            ('bowtie2', sequence_alignment.mapping_quality),
+            sequence_alignment.raw_reads_path,
+            self.index
+        )
+    
+    def commands(self, sequence_alignment):
+        """Commands for bowtie2, piped into samtools view
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        
+        Returns
+        -------
+        tuple
+            argument tuples for bowtie2 and samtools view
+        """
+        
+        bowtie2_threads, view_threads = (
+            sequence_alignment.core_budget.allocate('bowtie2', 'samtools view')
+        )
+        return (
             (
                 'bowtie2',
                 '-x', self.index,
-                '--threads', str(sequence_alignment.processes),
+                '--threads', str(bowtie2_threads),
                 '--maxins', '2000'
             )
             + (
@@ -820,209 +3278,4504 @@ class Bowtie2():
                 if not isinstance(sequence_alignment.raw_reads_path, str)
                 else ('-U', sequence_alignment.raw_reads_path)
             ),
+            (
+                'samtools', 'view',
+                '-bhq', str(sequence_alignment.mapping_quality),
+                '-@', str(view_threads - 1)
+            ) + compression_options(self.compression_level(sequence_alignment))
+        )
+    
+    def align(self, sequence_alignment, stdout=subprocess.PIPE):
+        """Perform sequence alignment with bowtie2
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            a SequenceAlignemnt object
+        stdout
+            destination for the BAM output, as for subprocess.Popen
+        
+        Returns
+        -------
+        bytes
+            A BAM file, or None if stdout is not subprocess.PIPE
+        """
+        
+        bowtie2_command, view_command = self.commands(sequence_alignment)
+        with subprocess.Popen(
+            bowtie2_command,
             stdout=subprocess.PIPE,
             stderr=sequence_alignment.log
         ) as bowtie2:
             with subprocess.Popen(
-                (
-                    'samtools', 'view',
-                    '-bhq', str(sequence_alignment.mapping_quality),
-                    '-@', str(sequence_alignment.processes - 1)
-                ),
+                view_command,
                 stdin=bowtie2.stdout,
-                stdout=subprocess.PIPE,
+                stdout=stdout,
                 stderr=sequence_alignment.log
             ) as samtools_view:
-                return samtools_view.communicate()[0]
+                bam = samtools_view.communicate()[0]
+        check_returncodes(bowtie2, samtools_view)
+        return bam
 
 
 class STAR():
     pass
 
 
-class RemoveDuplicates():
-    """Remove duplicates with samtools view
+class CoreBudget():
+    """Divide a budget of cores among processes that run concurrently
+    
+    Each stage is identified by its command name (e.g. ``bwa mem`` or
+    ``samtools view``). Single-threaded stages get one core each, and the
+    remaining cores are divided among the other stages in proportion to their
+    cost. Costs default to STAGE_COSTS and can be overridden when the budget
+    is created; they are not measured.
     
     Parameters
     ----------
-    processes
-        number of processes to use
+    cores : int
+        number of cores available
+    costs : dict
+        relative costs of stages, overriding the defaults
+    
+    Attributes
+    ----------
+    cores : int
+        number of cores available
+    costs : dict
+        relative costs of stages
+    """
+    
+    def __init__(self, cores=1, costs=None):
+        self.cores = max(1, int(cores))
+        self.costs = dict(STAGE_COSTS)
+        if costs:
+            self.costs.update(costs)
+    
+    def __repr__(self):
+        return f'CoreBudget(cores={self.cores})'
+    
+    def allocate(self, *stages):
+        """Assign thread counts to stages that run concurrently
+        
+        Parameters
+        ----------
+        *stages
+            names of the stages
+        
+        Returns
+        -------
+        tuple
+            number of threads for each stage, at least 1
+        """
+        
+        threaded = [
+            i for i, stage in enumerate(stages)
+            if stage not in SINGLE_THREADED_STAGES
+        ]
+        threads = [1] * len(stages)
+        spare = self.cores - len(stages)
+        if spare <= 0 or not threaded:
+            return tuple(threads)
+        costs = [self.costs.get(stages[i], 0.25) for i in threaded]
+        shares = [
+            spare * cost / sum(costs) if sum(costs) else spare / len(costs)
+            for cost in costs
+        ]
+        for i, share in zip(threaded, shares):
+            threads[i] += math.floor(share)
+        remainders = sorted(
+            zip(threaded, shares),
+            key=lambda item: item[1] - math.floor(item[1]),
+            reverse=True
+        )
+        for i, _ in remainders[:self.cores - sum(threads)]:
+            threads[i] += 1
+        return tuple(threads)
+    
+    def assign_threads(self, *commands):
+        """Add thread options to samtools commands that run concurrently
+        
+        Parameters
+        ----------
+        *commands
+            argument tuples for subprocess.Popen
+        
+        Returns
+        -------
+        tuple
+            the commands, with ``-@`` options added to samtools commands that
+            did not have one
+        """
+        
+        return tuple(
+            with_threads(command, threads)
+            for command, threads in zip(
+                commands,
+                self.allocate(*(stage_name(command) for command in commands))
+            )
+        )
+
+
+class BatchRunner():
+    """Run a recipe of SequenceAlignment steps on many samples in a process
+    pool, under a total budget of cores and memory
+    
+    Each sample is a job that needs cores_per_job cores and an amount of
+    memory estimated from the size of its input, which also stands in for
+    its expected duration. While every waiting job fits in the free
+    capacity, jobs start in the order given. When capacity is tight, the
+    shortest waiting job that fits starts first. A job needing more memory
+    than the whole budget runs when nothing else is running.
+    
+    Parameters
+    ----------
+    steps
+        the recipe: SequenceAlignment method names, (method name, args,
+        kwargs) tuples, or functions taking a SequenceAlignment. Functions
+        must be defined at module level so they can be sent to the workers.
+    cores : int
+        total number of cores, defaults to os.cpu_count()
+    memory : int
+        total memory in bytes, defaults to the available memory
+    cores_per_job : int
+        cores for each sample, defaults to an even share of the cores
+    memory_per_job : int
+        memory in bytes for each sample, defaults to
+        BATCH_MEMORY_PER_INPUT_BYTE times the size of its input
+    **kwargs
+        other parameters for SequenceAlignment(), which must be picklable.
+        ``processes`` and ``memory_limit`` are set for each job from its
+        cores and memory, so they cannot be given.
+    
+    Attributes
+    ----------
+    steps
+        the recipe
+    cores : int
+        total number of cores
+    memory : int
+        total memory in bytes
+    cores_per_job : int
+        cores for each sample, or None for an even share
+    memory_per_job : int
+        memory for each sample, or None to estimate it
+    kwargs : dict
+        other parameters for SequenceAlignment()
+    """
+    
+    def __init__(
+        self,
+        steps,
+        cores=None,
+        memory=None,
+        cores_per_job=None,
+        memory_per_job=None,
+        **kwargs
+    ):
+        for key, replacement in (
+            ('processes', 'cores_per_job'),
+            ('memory_limit', 'memory_per_job')
+        ):
+            if key in kwargs:
+                raise TypeError(
+                    f'BatchRunner sets {key} for each job, use {replacement} '
+                    'instead'
+                )
+        self.steps = tuple(steps)
+        self.cores = max(1, int(cores or os.cpu_count() or 1))
+        self.memory = int(memory or available_memory())
+        self.cores_per_job = cores_per_job
+        self.memory_per_job = memory_per_job
+        self.kwargs = kwargs
+    
+    def __repr__(self):
+        return (
+            f'BatchRunner(steps={len(self.steps)}, cores={self.cores}, '
+            f'memory={self.memory})'
+        )
+    
+    def jobs(self, samples):
+        """Describe the job for each sample
+        
+        Parameters
+        ----------
+        samples
+            a mapping from sample names to inputs, or a sequence of inputs
+            (named by position). Inputs are as for SequenceAlignment().
+        
+        Returns
+        -------
+        list
+            dicts with the ``sample`` name, ``input_file``, input ``size`` in
+            bytes, and the ``cores`` and ``memory`` for each job
+        """
+        
+        samples = tuple(
+            samples.items() if isinstance(samples, collections.abc.Mapping)
+            else enumerate(samples)
+        )
+        cores = min(
+            self.cores,
+            self.cores_per_job
+            or max(1, self.cores // max(1, len(samples)))
+        )
+        jobs = []
+        for name, input_file in samples:
+            size = input_size(input_file)
+            jobs.append(
+                {
+                    'sample': name,
+                    'input_file': input_file,
+                    'size': size,
+                    'cores': cores,
+                    'memory': int(
+                        self.memory_per_job
+                        or max(
+                            size * BATCH_MEMORY_PER_INPUT_BYTE,
+                            cores * MIN_SORT_MEMORY_PER_THREAD
+                        )
+                    )
+                }
+            )
+        return jobs
+    
+    def next_job(self, pending, free_cores, free_memory, idle):
+        """Choose the next job to start
+        
+        Parameters
+        ----------
+        pending : list
+            jobs waiting to start, in order
+        free_cores : int
+            cores not used by running jobs
+        free_memory : int
+            memory not used by running jobs
+        idle : bool
+            True if no jobs are running
+        
+        Returns
+        -------
+        dict
+            the job to start, or None if none fits
+        """
+        
+        fitting = [
+            job for job in pending
+            if (job['cores'] <= free_cores and job['memory'] <= free_memory)
+            or idle
+        ]
+        if not fitting:
+            return None
+        if (
+            sum(job['cores'] for job in pending) <= free_cores
+            and sum(job['memory'] for job in pending) <= free_memory
+        ):
+            return pending[0]
+        return min(fitting, key=lambda job: job['size'])
+    
+    def run(self, samples):
+        """Run the recipe on each sample
+        
+        Parameters
+        ----------
+        samples
+            a mapping from sample names to inputs, or a sequence of inputs
+        
+        Returns
+        -------
+        list
+            a dict for each sample, in the order given: the job description
+            from jobs(), the ``results`` of the steps, the ``steps`` as (name,
+            seconds) pairs, the ``queued_seconds`` before the job started,
+            its total ``seconds``, and the ``error`` raised, if any
+        """
+        
+        jobs = self.jobs(samples)
+        pending = list(jobs)
+        running = {}
+        free_cores, free_memory = self.cores, self.memory
+        start = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max(1, min(len(jobs), self.cores))
+        ) as executor:
+            while pending or running:
+                job = self.next_job(
+                    pending,
+                    free_cores,
+                    free_memory,
+                    not running
+                )
+                if job:
+                    pending.remove(job)
+                    free_cores -= job['cores']
+                    free_memory -= job['memory']
+                    job['queued_seconds'] = time.perf_counter() - start
+                    running[
+                        executor.submit(
+                            run_batch_job,
+                            job['input_file'],
+                            self.steps,
+                            job['cores'],
+                            job['memory'],
+                            self.kwargs
+                        )
+                    ] = job
+                    continue
+                done, _ = concurrent.futures.wait(
+                    running,
+                    return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    job = running.pop(future)
+                    free_cores += job['cores']
+                    free_memory += job['memory']
+                    try:
+                        job.update(future.result())
+                    except Exception as e:
+                        job.update(
+                            {
+                                'results': [],
+                                'steps': [],
+                                'seconds': None,
+                                'error': e
+                            }
+                        )
+        return jobs
+
+
+class FilterPlan():
+    """A set of samtools view filters to be applied in a single pass
+    
+    Flag and MAPQ filters commute, so consecutive filters can be fused:
+    required flags (-f) and excluded flags (-F) are combined with a bitwise OR
+    and the strictest minimum MAPQ (-q) is kept.
+    
+    Parameters
+    ----------
+    *options
+        options to pass to samtools view
+    require_flags : int
+        reads must have all of these flags (-f)
+    exclude_flags : int
+        reads must have none of these flags (-F)
+    mapping_quality : int
+        minimum MAPQ score (-q)
+    regions : iterable
+        regions to restrict the data to
+    
+    Attributes
+    ----------
+    require_flags : int
+        reads must have all of these flags (-f)
+    exclude_flags : int
+        reads must have none of these flags (-F)
+    mapping_quality : int
+        minimum MAPQ score (-q)
+    regions : tuple
+        regions to restrict the data to, or None
+    extra_options : tuple
+        options that could not be interpreted as flag or MAPQ filters
+    """
+    
+    def __init__(
+        self,
+        *options,
+        require_flags=0,
+        exclude_flags=0,
+        mapping_quality=0,
+        regions=None
+    ):
+        self.require_flags = int(require_flags)
+        self.exclude_flags = int(exclude_flags)
+        self.mapping_quality = int(mapping_quality)
+        self.regions = tuple(regions) if regions else None
+        self.extra_options = ()
+        options = tuple(str(option) for option in options)
+        for flag, value in zip(options[::2], options[1::2]):
+            if flag not in {'-f', '-F', '-q'}:
+                self.extra_options = options
+                break
+        else:
+            if len(options) % 2:
+                self.extra_options = options
+        if not self.extra_options:
+            try:
+                values = tuple(
+                    (flag, int(value) if flag == '-q' else int(value, 0))
+                    for flag, value in zip(options[::2], options[1::2])
+                )
+            except ValueError:
+                # Symbolic or octal flags (e.g. UNMAP,SECONDARY or 010) are
+                # passed through to samtools unchanged
+                self.extra_options = options
+                values = ()
+            for flag, value in values:
+                if flag == '-f':
+                    self.require_flags |= value
+                elif flag == '-F':
+                    self.exclude_flags |= value
+                elif flag == '-q':
+                    self.mapping_quality = value
+    
+    @classmethod
+    def from_filters(
+        cls,
+        *options,
+        remove_unpaired=False,
+        remove_improperly_paired=False,
+        remove_unmapped=False,
+        remove_mate_unmapped=False,
+        remove_not_primary=False,
+        remove_fails_quality_check=False,
+        remove_duplicate=False,
+        remove_supplementary=False,
+        mapping_quality=0,
+        regions=None
+    ):
+        """Construct a plan from the keyword filters of samtools_view()
+        
+        Returns
+        -------
+        FilterPlan
+            a plan applying the requested filters
+        """
+        
+        return cls(
+            *options,
+            require_flags=(
+                remove_unpaired * 1 | remove_improperly_paired * 2
+            ),
+            exclude_flags=(
+                remove_unmapped * 4
+                | remove_mate_unmapped * 8
+                | remove_not_primary * 256
+                | remove_fails_quality_check * 512
+                | remove_duplicate * 1024
+                | remove_supplementary * 2048
+            ),
+            mapping_quality=mapping_quality,
+            regions=regions
+        )
+    
+    def __repr__(self):
+        return (
+            f'FilterPlan(require_flags={self.require_flags}, '
+            f'exclude_flags={self.exclude_flags}, '
+            f'mapping_quality={self.mapping_quality}, '
+            f'regions={self.regions})'
+        )
+    
+    @property
+    def fusable(self):
+        """True if this plan can be merged with another plan"""
+        
+        return not self.extra_options
+    
+    def fuse(self, plan):
+        """Merge another plan into this one, if possible
+        
+        Parameters
+        ----------
+        plan : FilterPlan
+            a plan to be applied after this one
+        
+        Returns
+        -------
+        bool
+            True if the plans were merged, False if they must be applied
+            separately
+        """
+        
+        if not (self.fusable and plan.fusable):
+            return False
+        if self.regions and plan.regions and (self.regions != plan.regions):
+            return False
+        self.require_flags |= plan.require_flags
+        self.exclude_flags |= plan.exclude_flags
+        self.mapping_quality = max(self.mapping_quality, plan.mapping_quality)
+        self.regions = self.regions or plan.regions
+        return True
+    
+    def options(self):
+        """Return the command-line options for samtools view
+        
+        Returns
+        -------
+        tuple
+            options for samtools view, not including regions
+        """
+        
+        return (
+            ('-q', str(self.mapping_quality))
+            + self.extra_options
+            + bool(self.require_flags) * ('-f', str(self.require_flags))
+            + bool(self.exclude_flags) * ('-F', str(self.exclude_flags))
+        )
+
+
+class SpilledBAM():
+    """BAM data stored in a temporary file on disk and exposed through mmap
+    
+    Parameters
+    ----------
+    temp_dir : str
+        directory for the temporary file
+    
+    Attributes
+    ----------
+    file : file object
+        the temporary file, which is removed when closed
+    name : str
+        path to the temporary file
+    view : memoryview
+        read-only view of the memory-mapped file, available after map()
+    """
+    
+    def __init__(self, temp_dir=None):
+        self.file = tempfile.NamedTemporaryFile(dir=temp_dir, suffix='.bam')
+        self.name = self.file.name
+        self.view = None
+    
+    def __repr__(self):
+        return f'SpilledBAM(name={self.name})'
+    
+    def __len__(self):
+        return os.fstat(self.file.fileno()).st_size
+    
+    @classmethod
+    def from_bytes(cls, bam, temp_dir=None):
+        """Write BAM data to a temporary file
+        
+        Parameters
+        ----------
+        bam : bytes
+            BAM data in memory
+        temp_dir : str
+            directory for the temporary file
+        
+        Returns
+        -------
+        SpilledBAM
+            The BAM data, stored on disk
+        """
+        
+        spilled_bam = cls(temp_dir=temp_dir)
+        spilled_bam.file.write(bam)
+        return spilled_bam.map()
+    
+    def map(self):
+        """Memory-map the file, after it has been completely written
+        
+        Returns
+        -------
+        SpilledBAM
+            this object
+        """
+        
+        self.file.flush()
+        self.view = memoryview(
+            mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            if len(self)
+            else b''
+        )
+        return self
+    
+    def open(self):
+        """Open the file for reading, independently of other readers
+        
+        Returns
+        -------
+        file object
+            The file, opened in binary mode
+        """
+        
+        return open(self.name, 'rb')
+    
+    def read(self):
+        """Read the file into memory
+        
+        Returns
+        -------
+        bytes
+            The BAM data
+        """
+        
+        self.file.flush()
+        with self.open() as f:
+            return f.read()
+    
+    def close(self):
+        """Remove the file. Existing views of its data remain valid."""
+        
+        self.view = None
+        self.file.close()
+
+
+class BGZFReader():
+    """Sequential reader for BGZF-compressed data, such as a BAM file, held
+    in memory
+    
+    Parameters
+    ----------
+    data : bytes-like
+        BGZF-compressed data
+    virtual_offset : int
+        virtual offset at which to start reading
+    
+    Attributes
+    ----------
+    data : bytes-like
+        BGZF-compressed data
+    block_offset : int
+        offset of the current block in the compressed data
+    next_block_offset : int
+        offset of the next block in the compressed data
+    block : bytes
+        decompressed contents of the current block
+    position : int
+        position within the decompressed contents of the current block
+    """
+    
+    def __init__(self, data, virtual_offset=0):
+        self.data = data
+        self.seek(virtual_offset)
+    
+    def __repr__(self):
+        return f'BGZFReader(virtual_offset={self.tell()})'
+    
+    def seek(self, virtual_offset):
+        """Move to a virtual offset
+        
+        Parameters
+        ----------
+        virtual_offset : int
+            the block offset shifted 16 bits to the left, plus the position
+            within the decompressed block
+        """
+        
+        self.load_block(virtual_offset >> 16)
+        self.position = virtual_offset & 0xffff
+    
+    def tell(self):
+        """Return the current virtual offset
+        
+        At the end of a block, this is the offset of the start of the next
+        block, so that offsets can be compared with those in an index.
+        
+        Returns
+        -------
+        int
+            the virtual offset
+        """
+        
+        if self.block and self.position >= len(self.block):
+            return self.next_block_offset << 16
+        return (self.block_offset << 16) | self.position
+    
+    def load_block(self, block_offset):
+        """Decompress the block starting at an offset
+        
+        Parameters
+        ----------
+        block_offset : int
+            offset of the block in the compressed data
+        """
+        
+        self.block_offset = block_offset
+        self.position = 0
+        if block_offset >= len(self.data):
+            self.block, self.next_block_offset = b'', block_offset
+        else:
+            self.block, self.next_block_offset = read_bgzf_block(
+                self.data,
+                block_offset
+            )
+    
+    def read(self, size):
+        """Read decompressed data
+        
+        Parameters
+        ----------
+        size : int
+            number of bytes to read
+        
+        Returns
+        -------
+        bytes
+            the data, which is shorter than size only at the end of the file
+        """
+        
+        chunks = []
+        while size > 0:
+            if self.position >= len(self.block):
+                if self.next_block_offset >= len(self.data):
+                    break
+                self.load_block(self.next_block_offset)
+                continue
+            chunk = self.block[self.position:self.position + size]
+            self.position += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+
+class BGZFWriter():
+    """Writer for BGZF-compressed data, such as a BAM file
+    
+    Parameters
+    ----------
+    file : file object
+        binary file object to write the compressed data to
+    compression_level : int
+        zlib compression level
+    
+    Attributes
+    ----------
+    file : file object
+        binary file object to write the compressed data to
+    compression_level : int
+        zlib compression level
+    buffer : bytearray
+        uncompressed data not yet written to a block
+    """
+    
+    def __init__(self, file, compression_level=6):
+        self.file = file
+        self.compression_level = compression_level
+        self.buffer = bytearray()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+    
+    def write(self, data):
+        """Write uncompressed data
+        
+        Parameters
+        ----------
+        data : bytes-like
+            the data to compress and write
+        """
+        
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.write_block(self.buffer[:BGZF_BLOCK_SIZE])
+            del self.buffer[:BGZF_BLOCK_SIZE]
+    
+    def write_block(self, data):
+        """Compress data and write it as a single BGZF block
+        
+        Parameters
+        ----------
+        data : bytes-like
+            at most BGZF_BLOCK_SIZE bytes of data
+        """
+        
+        compressor = zlib.compressobj(
+            self.compression_level,
+            zlib.DEFLATED,
+            -15
+        )
+        compressed_data = compressor.compress(data) + compressor.flush()
+        self.file.write(
+            struct.pack(
+                '<4BI2BH2BHH',
+                31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2,
+                len(compressed_data) + 25
+            )
+        )
+        self.file.write(compressed_data)
+        self.file.write(struct.pack('<II', zlib.crc32(data), len(data)))
+    
+    def close(self):
+        """Write any remaining data and the BGZF end-of-file marker"""
+        
+        if self.buffer:
+            self.write_block(self.buffer)
+            self.buffer = bytearray()
+        self.file.write(BGZF_EOF)
+
+
+class IntervalIndex():
+    """Genomic intervals, merged and sorted on each chromosome for fast
+    overlap queries
+    
+    Parameters
+    ----------
+    intervals
+        iterable of (chromosome, start, end) tuples, with 0-based half-open
+        coordinates
+    
+    Attributes
+    ----------
+    intervals : dict
+        maps each chromosome name to a pair of arrays giving the starts and
+        ends of the merged intervals
+    """
+    
+    def __init__(self, intervals):
+        intervals_by_chromosome = collections.defaultdict(list)
+        for chromosome, start, end in intervals:
+            intervals_by_chromosome[chromosome].append((start, end))
+        self.intervals = {}
+        for chromosome, chromosome_intervals in intervals_by_chromosome.items():
+            starts, ends = array('q'), array('q')
+            for start, end in sorted(chromosome_intervals):
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.intervals[chromosome] = starts, ends
+    
+    def __repr__(self):
+        return f'IntervalIndex(chromosomes={len(self.intervals)})'
+    
+    @classmethod
+    def from_bed(cls, bed_path):
+        """Build an index from a BED file (which may be gzipped)
+        
+        Parameters
+        ----------
+        bed_path : str
+            Path to a BED file on disk
+        
+        Returns
+        -------
+        IntervalIndex
+            index of the intervals in the BED file
+        """
+        
+        with (
+            gzip.open(bed_path, 'rt')
+            if bed_path.endswith('.gz')
+            else open(bed_path, 'r')
+        ) as bed:
+            return cls(
+                (chromosome, int(start), int(end))
+                for chromosome, start, end, *_ in (
+                    line.split() for line in bed
+                    if line.strip() and not line.startswith(
+                        ('#', 'track', 'browser')
+                    )
+                )
+            )
+    
+    def overlaps(self, chromosome, start, end):
+        """Check whether a region overlaps any interval
+        
+        Parameters
+        ----------
+        chromosome : str
+            chromosome name
+        start : int
+            0-based start of the region
+        end : int
+            end of the region (exclusive)
+        
+        Returns
+        -------
+        bool
+            True if the region overlaps an interval by at least one base
+        """
+        
+        intervals = self.intervals.get(chromosome)
+        return bool(intervals) and intervals_overlap(intervals, start, end)
+
+
+class ReadMetadataCache():
+    """Persistent cache of read length metadata for raw reads files
+    
+    Entries are stored in an SQLite database, keyed on the path, size,
+    modification time and inode of each file along with the sampling
+    parameters, so a file that changes is simply re-sampled. The least
+    recently used entries are evicted beyond max_entries.
+    
+    Parameters
+    ----------
+    path : str
+        Path to the cache database, defaults to
+        ``$XDG_CACHE_HOME/seqalign/read_metadata.sqlite``
+    max_entries : int
+        Maximum number of entries to keep
+    
+    Attributes
+    ----------
+    path : str
+        Path to the cache database
+    max_entries : int
+        Maximum number of entries to keep
+    """
+    
+    def __init__(self, path=None, max_entries=10000):
+        self.path = path or os.path.join(
+            cache_directory(),
+            'read_metadata.sqlite'
+        )
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS read_metadata ('
+                'path TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, '
+                'sampling TEXT, format TEXT, histogram TEXT, median REAL, '
+                'reads INTEGER, last_used REAL, '
+                'PRIMARY KEY (path, size, mtime_ns, inode, sampling))'
+            )
+    
+    def __repr__(self):
+        return f'ReadMetadataCache(path={self.path})'
+    
+    @contextlib.contextmanager
+    def connect(self):
+        """Connect to the cache database, committing on success
+        
+        Yields
+        ------
+        sqlite3.Connection
+            A connection to the database
+        """
+        
+        with contextlib.closing(
+            sqlite3.connect(self.path, timeout=60)
+        ) as connection, connection:
+            yield connection
+    
+    def key(self, raw_reads_path, sampling):
+        """Build the cache key for a file
+        
+        Parameters
+        ----------
+        raw_reads_path : str
+            Path to raw reads file
+        sampling : str
+            Description of the sampling parameters
+        
+        Returns
+        -------
+        tuple
+            absolute path, size, modification time, inode and sampling
+        """
+        
+        stat = os.stat(raw_reads_path)
+        return (
+            os.path.abspath(raw_reads_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+            sampling
+        )
+    
+    def get(self, raw_reads_path, sampling):
+        """Look up the metadata for a file
+        
+        Parameters
+        ----------
+        raw_reads_path : str
+            Path to raw reads file
+        sampling : str
+            Description of the sampling parameters
+        
+        Returns
+        -------
+        dict
+            keys ``format``, ``histogram``, ``median`` and ``reads``, or None
+            if the file is not in the cache
+        """
+        
+        key = self.key(raw_reads_path, sampling)
+        with self.connect() as connection:
+            row = connection.execute(
+                'SELECT format, histogram, median, reads FROM read_metadata '
+                'WHERE path=? AND size=? AND mtime_ns=? AND inode=? '
+                'AND sampling=?',
+                key
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                'UPDATE read_metadata SET last_used=? '
+                'WHERE path=? AND size=? AND mtime_ns=? AND inode=? '
+                'AND sampling=?',
+                (time.time(),) + key
+            )
+        format, histogram, median, reads = row
+        return {
+            'format': format,
+            'histogram': collections.Counter(
+                {int(length): count
+                    for length, count in json.loads(histogram).items()}
+            ),
+            'median': median,
+            'reads': reads
+        }
+    
+    def put(self, raw_reads_path, sampling, format, histogram):
+        """Store the metadata for a file, evicting old entries if necessary
+        
+        Parameters
+        ----------
+        raw_reads_path : str
+            Path to raw reads file
+        sampling : str
+            Description of the sampling parameters
+        format : str
+            ``fasta`` or ``fastq``
+        histogram : dict
+            Maps read lengths to read counts
+        """
+        
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO read_metadata VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                self.key(raw_reads_path, sampling)
+                + (
+                    format,
+                    json.dumps(histogram),
+                    median_from_histogram(histogram),
+                    sum(histogram.values()),
+                    time.time()
+                )
+            )
+            connection.execute(
+                'DELETE FROM read_metadata WHERE rowid IN ('
+                'SELECT rowid FROM read_metadata ORDER BY last_used DESC '
+                'LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+    
+    def read_length_histogram(
+        self,
+        raw_reads_path,
+        number_of_reads,
+        sampling='head',
+        stride=1,
+        seed=None
+    ):
+        """Sample the read lengths of a file, or look them up in the cache
+        
+        Parameters are as for read_length_histogram().
+        
+        Returns
+        -------
+        collections.Counter
+            Histogram mapping read lengths to read counts
+        """
+        
+        sampling_key = f'{sampling}:{number_of_reads}:{stride}:{seed}'
+        metadata = self.get(raw_reads_path, sampling_key)
+        if metadata:
+            return metadata['histogram']
+        histogram = read_length_histogram(
+            raw_reads_path,
+            number_of_reads,
+            sampling=sampling,
+            stride=stride,
+            seed=seed
+        )
+        self.put(
+            raw_reads_path,
+            sampling_key,
+            file_format_from_extension(raw_reads_path),
+            histogram
+        )
+        return histogram
+
+
+class AlignmentCache():
+    """Content-addressed on-disk cache of aligned BAM data
+    
+    Each entry is named by a SHA-256 digest of the aligner parameters and the
+    fingerprints (path, size, modification time, inode) of the raw reads and
+    reference index files. When the total size of the cache exceeds max_bytes,
+    the least recently used entries are removed.
+    
+    Parameters
+    ----------
+    directory : str
+        Directory holding the cached BAM files, defaults to
+        ``$XDG_CACHE_HOME/seqalign/alignments``
+    max_bytes : int
+        Maximum total size of the cached BAM files [100 GB]
+    
+    Attributes
+    ----------
+    directory : str
+        Directory holding the cached BAM files
+    max_bytes : int
+        Maximum total size of the cached BAM files
+    """
+    
+    def __init__(self, directory=None, max_bytes=100 * 1024**3):
+        self.directory = directory or os.path.join(
+            cache_directory(),
+            'alignments'
+        )
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+    
+    def __repr__(self):
+        return f'AlignmentCache(directory={self.directory})'
+    
+    def key(self, parameters, raw_reads_path, index_prefix):
+        """Compute the cache key for an alignment
+        
+        Parameters
+        ----------
+        parameters : tuple
+            JSON-serializable aligner parameters
+        raw_reads_path : str, tuple, list
+            raw reads file, or pair of files
+        index_prefix : str
+            reference genome or index prefix. All files starting with this
+            prefix are fingerprinted.
+        
+        Returns
+        -------
+        str
+            hex digest identifying the alignment
+        """
+        
+        if isinstance(raw_reads_path, str):
+            raw_reads_path = (raw_reads_path,)
+        return hashlib.sha256(
+            json.dumps(
+                (
+                    parameters,
+                    fingerprint_files(
+                        *raw_reads_path,
+                        *sorted(glob(f'{glob_escape(index_prefix)}*'))
+                    )
+                )
+            ).encode()
+        ).hexdigest()
+    
+    def path(self, key):
+        """Path of the cached BAM file for a key"""
+        
+        return os.path.join(self.directory, f'{key}.bam')
+    
+    def fetch_or_align(self, align, key, stdout=subprocess.PIPE):
+        """Return a cached alignment, or run the aligner and cache its output
+        
+        Parameters
+        ----------
+        align
+            a function taking a stdout argument, as for subprocess.Popen, and
+            returning the BAM data if stdout is subprocess.PIPE
+        key : str
+            cache key from key()
+        stdout
+            destination for the BAM output, as for subprocess.Popen
+        
+        Returns
+        -------
+        bytes
+            A BAM file in memory, or None if stdout is not subprocess.PIPE
+        
+        Raises
+        ------
+        AlignmentError
+            If the output of the aligner is truncated, in which case nothing
+            is cached
+        """
+        
+        cached_path = self.path(key)
+        try:
+            os.utime(cached_path)
+        except FileNotFoundError:
+            with tempfile.NamedTemporaryFile(
+                dir=self.directory,
+                suffix='.bam.tmp',
+                delete=False
+            ) as temp:
+                try:
+                    align(temp)
+                    temp.flush()
+                    if not bam_file_is_complete(temp.name):
+                        raise AlignmentError(
+                            f'Truncated alignment output for {key}'
+                        )
+                    os.replace(temp.name, cached_path)
+                except BaseException:
+                    os.remove(temp.name)
+                    raise
+            self.evict(keep=cached_path)
+        with open(cached_path, 'rb') as cached_bam:
+            if stdout == subprocess.PIPE:
+                return cached_bam.read()
+            send_file(cached_bam, stdout)
+    
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in
+        max_bytes
+        
+        Parameters
+        ----------
+        keep : str
+            path of an entry that should not be removed
+        """
+        
+        entries = []
+        for path in glob(os.path.join(self.directory, '*.bam')):
+            if path == keep:
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+
+
+class Profiler():
+    """Record the resource usage of the stages of a SequenceAlignment
+    
+    Each stage record is a dict with keys ``stage`` (the method name),
+    ``parent`` (the enclosing stage, or None), ``bytes_in`` and ``bytes_out``
+    (size of the data before and after), ``bytes_copied`` (BAM data copied
+    through the memory of the Python process), ``wall_seconds``,
+    ``user_cpu_seconds`` and ``system_cpu_seconds`` (CPU time of child
+    processes that exited during the stage, from resource.getrusage) and
+    ``peak_rss`` (the largest resident set size in bytes of any child process
+    so far). Child CPU time is counted for the whole Python process, so
+    stages run concurrently in other threads or asyncio tasks are included.
+    Parents are tracked separately for each thread and each asyncio task.
+    
+    Parameters
+    ----------
+    callback
+        function called with each stage record as the stage finishes, e.g. to
+        send it to a metrics system
+    
+    Attributes
+    ----------
+    callback
+        function called with each stage record
+    stages : list
+        stage records, in order of completion
+    """
+    
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stages = []
+        self.lock = threading.Lock()
+        self.stack = contextvars.ContextVar('profiler_stack', default=())
+    
+    def __repr__(self):
+        return f'Profiler(stages={len(self.stages)})'
+    
+    @contextlib.contextmanager
+    def stage(self, name, bytes_in=None):
+        """Context manager recording a stage
+        
+        Parameters
+        ----------
+        name : str
+            name of the stage
+        bytes_in : int
+            size of the input data
+        
+        Yields
+        ------
+        dict
+            the stage record, to which ``bytes_out`` and ``bytes_copied`` can
+            be added
+        """
+        
+        stack = self.stack.get()
+        record = {
+            'stage': name,
+            'parent': stack[-1] if stack else None,
+            'bytes_in': bytes_in,
+            'bytes_out': None,
+            'bytes_copied': None
+        }
+        token = self.stack.set(stack + (name,))
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.stack.reset(token)
+            record.update(
+                {
+                    'wall_seconds': end - start,
+                    'user_cpu_seconds': end_usage.ru_utime - usage.ru_utime,
+                    'system_cpu_seconds': end_usage.ru_stime - usage.ru_stime,
+                    'peak_rss': end_usage.ru_maxrss * 1024
+                }
+            )
+            with self.lock:
+                self.stages.append(record)
+            if self.callback:
+                self.callback(record)
+    
+    def report(self):
+        """Summarize the recorded stages
+        
+        Returns
+        -------
+        dict
+            ``stages`` (the stage records) and totals over the top-level
+            stages: ``wall_seconds``, ``cpu_seconds``, ``bytes_copied`` and
+            ``peak_rss``
+        """
+        
+        with self.lock:
+            stages = list(self.stages)
+        top_level = [record for record in stages if record['parent'] is None]
+        return {
+            'stages': stages,
+            'wall_seconds': sum(r['wall_seconds'] for r in top_level),
+            'cpu_seconds': sum(
+                r['user_cpu_seconds'] + r['system_cpu_seconds']
+                for r in top_level
+            ),
+            'bytes_copied': sum(
+                r['bytes_copied'] or 0 for r in top_level
+            ),
+            'peak_rss': max((r['peak_rss'] for r in stages), default=0)
+        }
+    
+    def to_json(self, **kwargs):
+        """Summarize the recorded stages as JSON
+        
+        Parameters
+        ----------
+        **kwargs
+            keyword arguments for json.dumps
+        
+        Returns
+        -------
+        str
+            the report() as JSON
+        """
+        
+        return json.dumps(self.report(), **kwargs)
+
+
+class RemoveDuplicates():
+    """Remove duplicates with samtools view
+    
+    Parameters
+    ----------
+    processes
+        number of processes to use
+
+    Attributes
+    ----------
+    processes
+        number of processes to use
+    """
+    
+    def __init__(self, processes=1):
+        self.processes = processes
+    
+    def __call__(self, bam, log=None):
+        with subprocess.Popen(
+            with_threads(self.command(), self.processes),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=log if log else subprocess.DEVNULL
+        ) as samtools_view:
+            return samtools_view.communicate(input=bam)[0]
+    
+    def command(self):
+        """Command line for the dedupper, for use as a Pipeline stage
+        
+        The thread count is left to the core budget of the pipeline or
+        SequenceAlignment running the command.
+        
+        Returns
+        -------
+        tuple
+            arguments for subprocess.Popen
+        """
+        
+        return ('samtools', 'view', '-bh', '-F', '0x400')
+
+
+class MarkDuplicates():
+    """Mark (and optionally remove) duplicates with samtools, as a single
+    streamed pipeline: collate, fixmate -m, coordinate sort and markdup
+    
+    Intermediate stages pass uncompressed BAM to each other, and threads and
+    sort memory come from the core budget and plan_sort() of the
+    SequenceAlignment. The output is coordinate-sorted.
+    
+    Parameters
+    ----------
+    remove : bool
+        If True, remove duplicates instead of only marking them
+    memory_limit : float
+        maximum memory in GB for the sort stage
+    processes : int
+        number of processes to use when called directly on BAM data
+    
+    Attributes
+    ----------
+    remove : bool
+        If True, duplicates are removed
+    memory_limit : float
+        maximum memory in GB for the sort stage
+    processes : int
+        number of processes to use when called directly on BAM data
+    stats : dict
+        duplicate statistics from the last run, from parse_markdup_stats()
+    stats_path : str
+        file to which the pending run will write its statistics
+    """
+    
+    def __init__(self, remove=False, memory_limit=None, processes=1):
+        self.remove = remove
+        self.memory_limit = memory_limit
+        self.processes = processes
+        self.stats = None
+        self.stats_path = None
+    
+    def __repr__(self):
+        return f'MarkDuplicates(remove={self.remove})'
+    
+    def __call__(self, bam, log=None):
+        sa = SequenceAlignment(bam, processes=self.processes, log=log)
+        self.apply(sa)
+        return sa.bam
+    
+    def extend(self, pipeline):
+        """Add the stages of the dedupper to a Pipeline
+        
+        The statistics are written to a temporary file, which is read by
+        read_stats() after the pipeline has run.
+        
+        Parameters
+        ----------
+        pipeline : Pipeline
+            the pipeline to extend
+        
+        Returns
+        -------
+        Pipeline
+            the pipeline
+        """
+        
+        fd, self.stats_path = tempfile.mkstemp(
+            dir=pipeline.sequence_alignment.temp_dir,
+            suffix='.markdup.txt'
+        )
+        os.close(fd)
+        return (
+            pipeline
+            .samtools_collate()
+            .samtools_fixmate('-m', '-u')
+            .samtools_sort(memory_limit=self.memory_limit, uncompressed=True)
+            .samtools_markdup(remove=self.remove, stats_path=self.stats_path)
+        )
+    
+    def read_stats(self):
+        """Read and remove the statistics file of the last run
+        
+        Returns
+        -------
+        dict
+            duplicate statistics, from parse_markdup_stats()
+        """
+        
+        try:
+            with open(self.stats_path) as f:
+                self.stats = parse_markdup_stats(f)
+        finally:
+            os.remove(self.stats_path)
+            self.stats_path = None
+        return self.stats
+    
+    def apply(self, sequence_alignment):
+        """Mark or remove duplicates in the BAM data of a
+        SequenceAlignment
+        
+        Parameters
+        ----------
+        sequence_alignment : SequenceAlignment
+            the alignment to deduplicate
+        
+        Returns
+        -------
+        dict
+            duplicate statistics, from parse_markdup_stats()
+        """
+        
+        pipeline = self.extend(sequence_alignment.pipeline())
+        try:
+            pipeline.apply()
+        finally:
+            self.read_stats()
+        return self.stats
+
+
+class PositionDedupper():
+    """Mark or remove duplicates in coordinate-sorted BAM data in a single
+    streaming pass, without external tools
+    
+    Reads are duplicates if they share a reference sequence, unclipped 5'
+    position, strand and (optionally) UMI, and the first such read in
+    coordinate order is kept. This suits single-end data such as ChIP-seq and
+    ATAC-seq; the reads of a pair are treated independently. Unmapped,
+    secondary and supplementary records are passed through unchanged.
+    
+    Each key, including the UMI (see encode_umi()), is packed into one
+    integer, and keys are forgotten once the stream has moved further past
+    them than the longest read seen so far, counting its clipped bases. No
+    table of UMIs is kept, so memory use depends on read depth and read
+    length rather than on the size of the input.
+    
+    Parameters
+    ----------
+    umi_tag : str
+        two-character tag holding the UMI (e.g. ``RX``), or None to ignore
+        UMIs
+    remove : bool
+        If True, remove duplicates. If False, set the duplicate flag on them
+        (and clear it on the other reads examined).
+    compression_level : int
+        zlib compression level for the output
+    
+    Attributes
+    ----------
+    umi_tag : bytes
+        tag holding the UMI, or None
+    remove : bool
+        If True, duplicates are removed
+    compression_level : int
+        zlib compression level for the output
+    stats : dict
+        counts of ``examined`` reads and duplicates (``duplicate_total``)
+        from the last run, with the ``duplicate_fraction``
+    """
+    
+    def __init__(self, umi_tag=None, remove=True, compression_level=6):
+        self.umi_tag = umi_tag.encode() if umi_tag else None
+        self.remove = remove
+        self.compression_level = compression_level
+        self.stats = None
+    
+    def __repr__(self):
+        return (
+            f'PositionDedupper(umi_tag={self.umi_tag}, remove={self.remove})'
+        )
+    
+    def __call__(self, bam, log=None):
+        reader = BGZFReader(bam)
+        header = encode_bam_header(*parse_bam_header(reader))
+        return write_bam(
+            header,
+            self.filter(iter_bam_records(reader)),
+            compression_level=self.compression_level
+        )
+    
+    def filter(self, records):
+        """Mark or remove the duplicates in a stream of records
+        
+        Parameters
+        ----------
+        records
+            iterable of raw BAM records, sorted by coordinate
+        
+        Yields
+        ------
+        bytes
+            raw BAM records, with duplicates removed or flagged
+        """
+        
+        seen = set()
+        previous = (-1, -1)
+        purge_position = window = examined = duplicates = 0
+        for record in records:
+            reference_id, position, flag = read_record_position(record)
+            current = (reference_id & 0xffffffff, position)
+            if current < previous:
+                raise BAMFormatError(
+                    'BAM data must be coordinate-sorted to remove duplicates'
+                )
+            if current[0] != previous[0]:
+                seen.clear()
+                purge_position = position + window
+            previous = current
+            if flag & 0x904:
+                yield record
+                continue
+            examined += 1
+            read_length, = struct.unpack_from('<i', record, 20)
+            five_prime = five_prime_position(record)
+            window = max(window, read_length + max(position - five_prime, 0))
+            if position > purge_position:
+                threshold = (position - window + 0x80000000) << 1
+                seen = {
+                    key for key in seen
+                    if key & 0x1ffffffff >= threshold
+                }
+                purge_position = position + window
+            key = (
+                encode_umi(
+                    read_record_tag(record, self.umi_tag) if self.umi_tag
+                    else None
+                ) << 33
+                | (five_prime + 0x80000000) << 1
+                | bool(flag & 0x10)
+            )
+            duplicate = key in seen
+            seen.add(key)
+            duplicates += duplicate
+            if duplicate and self.remove:
+                continue
+            if not self.remove:
+                record = bytearray(record)
+                struct.pack_into(
+                    '<H', record, 18, flag & ~0x400 | duplicate * 0x400
+                )
+            yield record
+        self.stats = {
+            'examined': examined,
+            'duplicate_total': duplicates,
+            'duplicate_fraction': duplicates / examined if examined else 0.0
+        }
+
+
+class Pipeline():
+    """A series of operations on a SequenceAlignment, connected stdout-to-stdin
+    through OS pipes so that only the final result is materialised
+    
+    Stage methods return the pipeline itself, so they can be chained:
+    
+        sa.pipeline().samtools_fixmate('-r').samtools_sort().apply()
+    
+    Consecutive samtools_view stages are fused into a single samtools view
+    process. Dedupper stages use the dedupper's ``extend()`` method to add
+    stages of its own, or its ``command()`` method, if it has one; otherwise
+    the pipeline materialises the data, calls the dedupper, and continues
+    streaming from its output.
+    
+    Parameters
+    ----------
+    sequence_alignment : SequenceAlignment
+        the source of the pipeline
+    
+    Attributes
+    ----------
+    sequence_alignment : SequenceAlignment
+        the source of the pipeline
+    stages : list
+        FilterPlan objects, argument tuples, or callables taking and returning
+        BAM data
+    is_sorted : bool
+        True if the output of the pipeline will be coordinate-sorted
+    """
+    
+    def __init__(self, sequence_alignment):
+        self.sequence_alignment = sequence_alignment
+        self.stages = []
+        self.is_sorted = sequence_alignment.is_sorted
+    
+    def __repr__(self):
+        return f'Pipeline(stages={self.stages})'
+    
+    def samtools_view(self, *options, mapping_quality=None, **filters):
+        """Add a samtools view filter stage
+        
+        Parameters
+        ----------
+        *options
+            options to pass to samtools view
+        mapping_quality : int
+            minimum MAPQ, defaults to that of the SequenceAlignment
+        **filters
+            keyword filters as for SequenceAlignment.samtools_view(), except
+            regions, which require an index of the data entering the stage
+        
+        Raises
+        ------
+        ValueError
+            If regions are given. Restrict the SequenceAlignment with
+            samtools_view() or restrict_regions() before building the
+            pipeline instead.
+        """
+        
+        if filters.get('regions'):
+            raise ValueError(
+                'Pipeline stages cannot be restricted to regions, restrict '
+                'the SequenceAlignment before building the pipeline'
+            )
+        plan = FilterPlan.from_filters(
+            *options,
+            mapping_quality=(
+                self.sequence_alignment.mapping_quality
+                if mapping_quality is None
+                else mapping_quality
+            ),
+            **filters
+        )
+        if not (
+            self.stages
+            and isinstance(self.stages[-1], FilterPlan)
+            and self.stages[-1].fuse(plan)
+        ):
+            self.stages.append(plan)
+        return self
+    
+    def remove_unpaired_reads(self):
+        """Add a stage removing unpaired reads"""
+        
+        return self.samtools_view(remove_unpaired=True)
+    
+    def remove_supplementary_alignments(self):
+        """Add a stage removing supplementary alignments"""
+        
+        return self.samtools_view(remove_supplementary=True)
+    
+    def apply_quality_filter(self):
+        """Add a quality filter stage with flags: -F 1804 -q {mapping_quality}
+        """
+        
+        return self.samtools_view(
+            '-F', '1804',
+            '-q', str(self.sequence_alignment.mapping_quality)
+        )
+    
+    def samtools_sort(
+        self,
+        memory_limit=None,
+        by_name=False,
+        uncompressed=False
+    ):
+        """Add a samtools sort stage
+        
+        Memory is planned by SequenceAlignment.plan_sort()
+        
+        Parameters
+        ----------
+        memory_limit : float
+            maximum memory in GB. If None, only available memory is considered
+        by_name : bool
+            if True, sort by read name instead of by coordinate
+        uncompressed : bool
+            if True, write uncompressed BAM for the next stage
+        """
+        
+        plan = self.sequence_alignment.plan_sort(memory_limit)
+        self.stages.append(
+            ('samtools', 'sort', '-m', str(plan['memory']))
+            + by_name * ('-n',)
+            + uncompressed * ('-u',)
+        )
+        self.is_sorted = not by_name
+        return self
+    
+    def samtools_collate(self):
+        """Add a samtools collate stage, grouping the reads of each pair
+        together without fully sorting by name
+        
+        The output is uncompressed, for the next stage.
+        """
+        
+        self.stages.append(('samtools', 'collate', '-O', '-u', '-'))
+        self.is_sorted = False
+        return self
+    
+    def samtools_fixmate(self, *options):
+        """Add a samtools fixmate stage
+        
+        Parameters
+        ----------
+        *options
+            options to pass to samtools fixmate, e.g. ``-r`` to remove
+            unmapped and secondary reads
+        """
+        
+        self.stages.append(
+            ('samtools', 'fixmate') + tuple(options) + ('-', '-')
+        )
+        self.is_sorted = False
+        return self
+    
+    def samtools_markdup(self, remove=False, stats_path=None):
+        """Add a samtools markdup stage
+        
+        Input must be coordinate-sorted and have mate scores from
+        ``samtools fixmate -m``.
+        
+        Parameters
+        ----------
+        remove : bool
+            if True, remove duplicates instead of marking them
+        stats_path : str
+            if set, write duplicate statistics to this file (see
+            parse_markdup_stats())
+        """
+        
+        self.stages.append(
+            ('samtools', 'markdup')
+            + remove * ('-r',)
+            + (('-f', stats_path) if stats_path else ())
+            + ('-', '-')
+        )
+        return self
+    
+    def remove_blacklisted_reads(self, blacklist_path):
+        """Add a stage removing reads in regions of a BED file
+        
+        Parameters
+        ----------
+        blacklist_path : str
+            Path to a BED file on disk
+        """
+        
+        self.stages.append(
+            (
+                'bedtools', 'intersect',
+                '-abam', 'stdin',
+                '-b', blacklist_path,
+                '-v'
+            )
+        )
+        return self
+    
+    def remove_duplicates(self, dedupper=None):
+        """Add a dedupper stage
+        
+        Parameters
+        ----------
+        dedupper
+            dedupper to use, defaults to that of the SequenceAlignment
+        """
+        
+        dedupper = dedupper or self.sequence_alignment.dedupper
+        if not dedupper:
+            raise Exception(
+                "Indicate a dedupper if you're going to remove duplicates"
+            )
+        if hasattr(dedupper, 'extend'):
+            return dedupper.extend(self)
+        self.stages.append(
+            dedupper.command() if hasattr(dedupper, 'command') else dedupper
+        )
+        return self
+    
+    def commands(self, stages, temp_dir, output=False):
+        """Convert stages to arguments for subprocess.Popen
+        
+        The stages run concurrently, so the core budget of the
+        SequenceAlignment is divided among them. The ``-m`` option of a sort
+        stage gives the memory for the whole stage, and is divided among its
+        threads and among the sort stages running at the same time here.
+        Stages write BAM data at the intermediate compression level of the
+        SequenceAlignment, except that the last one uses its output
+        compression level if its output is the final output.
+        
+        Parameters
+        ----------
+        stages
+            FilterPlan objects or argument tuples
+        temp_dir : str
+            directory for temporary files of samtools sort
+        output : bool
+            If True, the last stage writes the final output
+        
+        Returns
+        -------
+        list
+            argument tuples
+        """
+        
+        stages = [
+            ('samtools', 'view', '-bh') + stage.options()
+            if isinstance(stage, FilterPlan) else stage
+            for stage in stages
+        ]
+        threads = self.sequence_alignment.core_budget.allocate(
+            *(stage_name(stage) for stage in stages)
+        )
+        sorts = sum(stage[:2] == ('samtools', 'sort') for stage in stages)
+        commands = []
+        for stage, stage_threads in zip(stages, threads):
+            if stage[:2] == ('samtools', 'collate'):
+                stage = stage[:2] + (
+                    '-T', os.path.join(temp_dir, f'collate{len(commands)}')
+                ) + stage[2:]
+            elif stage[:2] == ('samtools', 'sort'):
+                memory = stage.index('-m') + 1
+                stage = (
+                    stage[:2]
+                    + ('-T', os.path.join(temp_dir, f'sort{len(commands)}'))
+                    + stage[2:memory]
+                    + (
+                        str(
+                            max(
+                                MIN_SORT_MEMORY_PER_THREAD,
+                                int(stage[memory]) // stage_threads // sorts
+                            )
+                        ),
+                    )
+                    + stage[memory + 1:]
+                )
+            commands.append(
+                with_compression(
+                    with_threads(stage, stage_threads),
+                    self.sequence_alignment.output_compression
+                    if output and len(commands) == len(stages) - 1
+                    else self.sequence_alignment.intermediate_compression
+                )
+            )
+        return commands
+    
+    def run(self, output_path=None):
+        """Run the pipeline
+        
+        The SequenceAlignment itself is not modified, use apply() for that.
+        
+        Parameters
+        ----------
+        output_path : str
+            If provided, the output is written directly to this path
+        
+        Returns
+        -------
+        bytes, SpilledBAM or str
+            The BAM data (in memory or spilled to disk according to the
+            spill_threshold of the SequenceAlignment), or output_path if one
+            was provided
+        """
+        
+        if output_path:
+            with open(output_path, 'wb') as output_file:
+                self.execute(stdout=output_file, output=True)
+            return output_path
+        return self.sequence_alignment.capture_bam(self.execute)
+    
+    def execute(self, stdout=subprocess.PIPE, output=False):
+        """Run the pipeline, sending its output to stdout
+        
+        Parameters
+        ----------
+        stdout
+            destination for the output, as for subprocess.Popen
+        output : bool
+            If True, this is the final output, which is written at the
+            output compression level of the SequenceAlignment
+        
+        Returns
+        -------
+        bytes
+            A BAM file in memory, or None if stdout is not subprocess.PIPE
+        """
+        
+        sa = self.sequence_alignment
+        if not sa.profiler:
+            return self.run_stages(stdout=stdout, output=output)
+        with sa.profiler.stage('pipeline', bytes_in=sa.data_size()) as record:
+            bam = self.run_stages(stdout=stdout, output=output)
+            record['bytes_out'] = (
+                len(bam) if bam is not None
+                else os.fstat(stdout.fileno()).st_size
+                if hasattr(stdout, 'fileno') else None
+            )
+            return bam
+    
+    def run_stages(self, stdout=subprocess.PIPE, output=False):
+        """Run the stages of the pipeline, sending the output to stdout
+        
+        Parameters
+        ----------
+        stdout
+            destination for the output, as for subprocess.Popen
+        output : bool
+            If True, this is the final output, as for execute()
+        
+        Returns
+        -------
+        bytes
+            A BAM file in memory, or None if stdout is not subprocess.PIPE
+        """
+        
+        sa = self.sequence_alignment
+        stages = list(self.stages)
+        plan = sa.filter_plan
+        if plan and not plan.regions:
+            stages.insert(0, FilterPlan(
+                require_flags=plan.require_flags,
+                exclude_flags=plan.exclude_flags,
+                mapping_quality=plan.mapping_quality
+            ))
+        aligner_streams = (
+            sa.pending_alignment
+            and (not plan or not plan.regions)
+            and stages
+            and not callable(stages[0])
+            and 'stdout' in inspect.signature(
+                sa.aligner or BWA()
+            ).parameters
+        )
+        if aligner_streams:
+            bam = None
+        elif plan and not plan.regions:
+            if sa.pending_alignment:
+                sa.align_pending_reads()
+            if sa.cram is not None:
+                sa.decode_cram()
+            bam = sa._bam
+        else:
+            bam = sa.bam
+        with contextlib.ExitStack() as stack:
+            temp_dir = stack.enter_context(
+                tempfile.TemporaryDirectory(dir=sa.temp_dir)
+            )
+            if sa.bam_storage and not aligner_streams:
+                source = {'stdin': stack.enter_context(sa.bam_storage.open())}
+            else:
+                source = {'input': bam}
+            while stages:
+                segment = tuple(
+                    itertools.takewhile(lambda s: not callable(s), stages)
+                )
+                stages = stages[len(segment):]
+                final_stdout = subprocess.PIPE if stages else stdout
+                if aligner_streams:
+                    aligner_streams = False
+                    bam = self.stream_from_aligner(
+                        self.commands(
+                            segment,
+                            temp_dir,
+                            output=output and not stages
+                        ),
+                        stdout=final_stdout
+                    )
+                elif segment:
+                    bam = run_pipeline(
+                        *self.commands(
+                            segment,
+                            temp_dir,
+                            output=output and not stages
+                        ),
+                        stdout=final_stdout,
+                        log=sa.log,
+                        check=True,
+                        **source
+                    )
+                if stages:
+                    bam = stages.pop(0)(bam, log=sa.log)
+                source = {'input': bam}
+        if (stdout != subprocess.PIPE) and (bam is not None):
+            stdout.write(bam)
+            return None
+        return bam
+    
+    def stream_from_aligner(self, commands, stdout=subprocess.PIPE):
+        """Run the aligner of the SequenceAlignment, streaming its output
+        through a series of commands
+        
+        Parameters
+        ----------
+        commands
+            argument tuples for subprocess.Popen
+        stdout
+            destination for the output of the last command
+        
+        Returns
+        -------
+        bytes
+            A BAM file in memory, or None if stdout is not subprocess.PIPE
+        
+        Raises
+        ------
+        AlignmentError
+            If the aligner or any of the commands fails. An exception raised
+            by the aligner is raised again here.
+        """
+        
+        sa = self.sequence_alignment
+        read_fd, write_fd = os.pipe()
+        errors = []
+        
+        def align():
+            try:
+                sa.align_reads(stdout=write_fd)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                os.close(write_fd)
+        
+        aligner = threading.Thread(target=align)
+        aligner.start()
+        try:
+            with open(read_fd, 'rb') as stdin:
+                bam = run_pipeline(
+                    *commands,
+                    stdin=stdin,
+                    stdout=stdout,
+                    log=sa.log,
+                    check=True
+                )
+        finally:
+            aligner.join()
+            if errors:
+                raise errors[0]
+        return bam
+    
+    def apply(self):
+        """Run the pipeline and replace the BAM data of the SequenceAlignment
+        with its output
+        """
+        
+        sa = self.sequence_alignment
+        sa.bam = self.run()
+        sa.is_sorted = self.is_sorted
+        self.stages = []
+
+
+
+
+# Exceptions ===================================================================
+
+class Error(Exception):
+   """Base class for other exceptions"""
+   
+   pass
+
+
+class FileExtensionError(Error):
+    """File extension error"""
+    
+    pass
+
+
+class MemoryLimitError(Error):
+    """Memory limit error"""
+    
+    pass
+
+
+class MissingInputError(Error):
+    """Missing input error"""
+    
+    pass
+
+
+class BAMFormatError(Error):
+    """BAM format error"""
+    
+    pass
+
+
+class AlignmentError(Error):
+    """Alignment error"""
+    
+    pass
+
+
+
+
+# Functions ====================================================================
+
+def run_batch_job(input_file, steps, cores, memory, kwargs):
+    """Run a recipe of steps on one sample, in a worker of a BatchRunner
+    
+    Parameters
+    ----------
+    input_file : bytes, tuple, list, str
+        Sequencing data, as for SequenceAlignment()
+    steps
+        the recipe, as for BatchRunner
+    cores : int
+        cores for the sample
+    memory : int
+        memory for the sample in bytes, used as the sort memory limit
+    kwargs : dict
+        other parameters for SequenceAlignment()
+    
+    Returns
+    -------
+    dict
+        the ``results`` of the steps, the ``steps`` as (name, seconds) pairs
+        (including loading the input), total ``seconds`` and the ``error``
+        raised, if any
+    """
+    
+    start = time.perf_counter()
+    record = {'results': [], 'steps': [], 'error': None}
+    sa = None
+    try:
+        sa = SequenceAlignment(
+            input_file,
+            processes=cores,
+            memory_limit=memory / 1024**3,
+            **kwargs
+        )
+        record['steps'].append(
+            ('SequenceAlignment', time.perf_counter() - start)
+        )
+        for step in steps:
+            step_start = time.perf_counter()
+            if callable(step):
+                name, result = step.__name__, step(sa)
+            elif isinstance(step, str):
+                name, result = step, getattr(sa, step)()
+            else:
+                name, *arguments = step
+                result = getattr(sa, name)(
+                    *(arguments[0] if arguments else ()),
+                    **(arguments[1] if len(arguments) > 1 else {})
+                )
+            record['results'].append(result)
+            record['steps'].append((name, time.perf_counter() - step_start))
+    except Exception as e:
+        record['error'] = e
+    finally:
+        if sa:
+            sa.close()
+    record['seconds'] = time.perf_counter() - start
+    return record
+
+
+def samtools_fixmate(bam: bytes, log=None):
+    """Apply samtools fixmate to a BAM file (bytes object)
+
+    Parameters
+    ----------
+    bam : bytes
+        bytes object representing a BAM file
+    
+    Returns
+    -------
+    bytes
+        BAM file with mates fixed
+    """
+
+    with subprocess.Popen(
+        ('samtools', 'fixmate', '-r', '-', '-'),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=log,
+    ) as samtools_fixmate:
+        return samtools_fixmate.communicate(bam)[0]
+
+
+def capture_bam(produce, spill_threshold=None, temp_dir=None):
+    """Capture BAM data produced by a function, spilling it to disk if it is
+    larger than spill_threshold
+    
+    Parameters
+    ----------
+    produce
+        a function taking a stdout argument, as for subprocess.Popen, and
+        returning the BAM data if stdout is subprocess.PIPE
+    spill_threshold : int
+        size in bytes above which the data is kept on disk. If None, it is
+        always captured in memory
+    temp_dir : str
+        directory for the temporary file
+    
+    Returns
+    -------
+    bytes or SpilledBAM
+        The BAM data
+    """
+    
+    if spill_threshold is None:
+        return produce(subprocess.PIPE)
+    spilled_bam = SpilledBAM(temp_dir=temp_dir)
+    produce(spilled_bam.file)
+    return load_spilled_bam(spilled_bam, spill_threshold)
+
+
+def capture_indexed_bam(
+    produce,
+    index_format='bai',
+    spill_threshold=None,
+    temp_dir=None
+):
+    """Capture BAM data and its index, produced by a function that writes
+    them to named files
+    
+    Parameters
+    ----------
+    produce
+        a function taking a file object for a named file, to which the BAM
+        data is written, and a path for the index
+    index_format : str
+        ``bai`` or ``csi``
+    spill_threshold : int
+        size in bytes above which the data is kept on disk. If None, it is
+        always read into memory
+    temp_dir : str
+        directory for the temporary files
+    
+    Returns
+    -------
+    tuple
+        the BAM data (bytes or SpilledBAM) and the index (bytes)
+    """
+    
+    spilled_bam = SpilledBAM(temp_dir=temp_dir)
+    try:
+        with tempfile.TemporaryDirectory(dir=temp_dir) as index_dir:
+            index_path = os.path.join(index_dir, f'index.{index_format}')
+            produce(spilled_bam.file, index_path)
+            with open(index_path, 'rb') as f:
+                index = f.read()
+    except BaseException:
+        spilled_bam.close()
+        raise
+    return load_spilled_bam(spilled_bam, spill_threshold), index
+
+
+def load_spilled_bam(spilled_bam, spill_threshold=None):
+    """Keep BAM data on disk if it is larger than spill_threshold,
+    otherwise read it into memory and remove the file
+    
+    Parameters
+    ----------
+    spilled_bam : SpilledBAM
+        the completely written BAM data
+    spill_threshold : int
+        size in bytes above which the data is kept on disk. If None, it is
+        always read into memory
+    
+    Returns
+    -------
+    bytes or SpilledBAM
+        The BAM data
+    """
+    
+    if spill_threshold is not None and len(spilled_bam) > spill_threshold:
+        return spilled_bam.map()
+    bam = spilled_bam.read()
+    spilled_bam.close()
+    return bam
+
+
+async def capture_bam_async(produce, spill_threshold=None, temp_dir=None):
+    """Capture BAM data produced by a coroutine function, as for
+    capture_bam()
+    
+    Parameters
+    ----------
+    produce
+        a coroutine function taking a stdout argument and returning the BAM
+        data if stdout is subprocess.PIPE
+    spill_threshold : int
+        size in bytes above which the data is kept on disk. If None, it is
+        always captured in memory
+    temp_dir : str
+        directory for the temporary file
+    
+    Returns
+    -------
+    bytes or SpilledBAM
+        The BAM data
+    """
+    
+    if spill_threshold is None:
+        return await produce(subprocess.PIPE)
+    spilled_bam = SpilledBAM(temp_dir=temp_dir)
+    try:
+        await produce(spilled_bam.file)
+    except BaseException:
+        spilled_bam.close()
+        raise
+    return load_spilled_bam(spilled_bam, spill_threshold)
+
+
+async def capture_indexed_bam_async(
+    produce,
+    index_format='bai',
+    spill_threshold=None,
+    temp_dir=None
+):
+    """Capture BAM data and its index produced by a coroutine function, as
+    for capture_indexed_bam()
+    
+    Parameters
+    ----------
+    produce
+        a coroutine function taking a file object for a named file and a
+        path for the index
+    index_format : str
+        ``bai`` or ``csi``
+    spill_threshold : int
+        size in bytes above which the data is kept on disk
+    temp_dir : str
+        directory for the temporary files
+    
+    Returns
+    -------
+    tuple
+        the BAM data (bytes or SpilledBAM) and the index (bytes)
+    """
+    
+    spilled_bam = SpilledBAM(temp_dir=temp_dir)
+    try:
+        with tempfile.TemporaryDirectory(dir=temp_dir) as index_dir:
+            index_path = os.path.join(index_dir, f'index.{index_format}')
+            await produce(spilled_bam.file, index_path)
+            with open(index_path, 'rb') as f:
+                index = f.read()
+    except BaseException:
+        spilled_bam.close()
+        raise
+    return load_spilled_bam(spilled_bam, spill_threshold), index
+
+
+def run_pipeline(
+    *commands,
+    input=None,
+    stdin=None,
+    stdout=subprocess.PIPE,
+    log=None,
+    check=False
+):
+    """Run commands connected stdout-to-stdin through OS pipes
+    
+    Parameters
+    ----------
+    *commands
+        argument tuples for subprocess.Popen
+    input : bytes
+        data to send to the first command
+    stdin
+        file object or descriptor for the first command, if input is None
+    stdout
+        destination for the output of the last command
+    log : file object
+        File object to which stderr of each command will be written
+    check : bool
+        If True, raise an AlignmentError if any command fails
+    
+    Returns
+    -------
+    bytes
+        output of the last command, or None if stdout is not subprocess.PIPE
+    """
+    
+    with contextlib.ExitStack() as stack:
+        processes = []
+        for i, command in enumerate(commands):
+            processes.append(
+                stack.enter_context(
+                    subprocess.Popen(
+                        command,
+                        stdin=(
+                            processes[-1].stdout if processes
+                            else subprocess.PIPE if input is not None
+                            else stdin
+                        ),
+                        stdout=(
+                            stdout if i == len(commands) - 1
+                            else subprocess.PIPE
+                        ),
+                        stderr=log
+                    )
+                )
+            )
+            if len(processes) > 1:
+                processes[-2].stdout.close()
+        if input is None or len(processes) == 1:
+            output = processes[-1].communicate(input=input)[0]
+        else:
+            writer = threading.Thread(
+                target=write_to_pipe,
+                args=(processes[0].stdin, input)
+            )
+            writer.start()
+            output = processes[-1].communicate()[0]
+            writer.join()
+    if check:
+        check_returncodes(*processes)
+    return output
+
+
+async def run_pipeline_async(
+    *commands,
+    input=None,
+    stdin=None,
+    stdout=subprocess.PIPE,
+    log=None,
+    check=False
+):
+    """Run commands connected stdout-to-stdin through OS pipes, as
+    asyncio subprocesses
+    
+    Parameters
+    ----------
+    *commands
+        argument tuples for asyncio.create_subprocess_exec
+    input : bytes
+        data to send to the first command
+    stdin
+        file object or descriptor for the first command, if input is None
+    stdout
+        destination for the output of the last command
+    log : file object
+        File object to which stderr of each command will be written
+    check : bool
+        If True, raise an AlignmentError if any command fails
+    
+    Returns
+    -------
+    bytes
+        output of the last command, or None if stdout is not subprocess.PIPE
+    """
+    
+    pipes = [os.pipe() for _ in commands[1:]]
+    processes = []
+    try:
+        for i, command in enumerate(commands):
+            processes.append(
+                await asyncio.create_subprocess_exec(
+                    *command,
+                    stdin=(
+                        pipes[i - 1][0] if i
+                        else subprocess.PIPE if input is not None
+                        else stdin
+                    ),
+                    stdout=pipes[i][1] if i < len(pipes) else stdout,
+                    stderr=log
+                )
+            )
+    except BaseException:
+        for process in processes:
+            process.kill()
+        raise
+    finally:
+        for fds in pipes:
+            for fd in fds:
+                os.close(fd)
+    output, _ = await asyncio.gather(
+        (
+            processes[-1].stdout.read() if stdout == subprocess.PIPE
+            else asyncio.sleep(0)
+        ),
+        (
+            write_to_pipe_async(processes[0].stdin, input)
+            if input is not None
+            else asyncio.sleep(0)
+        )
+    )
+    for command, process in zip(commands, processes):
+        await process.wait()
+        if check and process.returncode:
+            raise AlignmentError(
+                f'{command[0]} exited with status {process.returncode}'
+            )
+    return output
+
+
+def stage_name(command):
+    """Name of a command for the purposes of a CoreBudget
+    
+    Parameters
+    ----------
+    command : tuple
+        arguments for subprocess.Popen
+    
+    Returns
+    -------
+    str
+        the program name, followed by the subcommand for bwa, samtools and
+        bedtools
+    """
+    
+    program = os.path.basename(command[0])
+    if program in {'bwa', 'samtools', 'bedtools'} and len(command) > 1:
+        return f'{program} {command[1]}'
+    return program
+
+
+def with_threads(command, threads):
+    """Add a ``-@`` option to a samtools command that does not have one
+    
+    Parameters
+    ----------
+    command : tuple
+        arguments for subprocess.Popen
+    threads : int
+        total number of threads for the command
+    
+    Returns
+    -------
+    tuple
+        the command, with a thread option if applicable
+    """
+    
+    if (
+        stage_name(command).split()[-1] in THREADED_SAMTOOLS_COMMANDS
+        and command[0] == 'samtools'
+        and '-@' not in command
+    ):
+        return command[:2] + ('-@', str(threads - 1)) + command[2:]
+    return command
+
+
+def compression_options(level):
+    """Options setting the compression level of BAM output from samtools
+    
+    Level 0 is written as ``-u`` (uncompressed BAM). Other levels use
+    ``--output-fmt-option``, which every samtools subcommand accepts, since
+    ``-l`` means something else to some of them (e.g. markdup).
+    
+    Parameters
+    ----------
+    level : int
+        compression level from 0 to 9, or None for the samtools default
+    
+    Returns
+    -------
+    tuple
+        command line options
+    """
+    
+    if level is None:
+        return ()
+    if level == 0:
+        return ('-u',)
+    return ('--output-fmt-option', f'level={level}')
+
+
+def with_compression(command, level):
+    """Set the compression level of a samtools command that writes BAM and
+    does not set one already
+    
+    Parameters
+    ----------
+    command : tuple
+        arguments for subprocess.Popen
+    level : int
+        compression level from 0 to 9, or None to leave the command as it is
+    
+    Returns
+    -------
+    tuple
+        the command, with compression options if applicable
+    """
+    
+    if (
+        level is None
+        or command[0] != 'samtools'
+        or len(command) < 2
+        or command[1] not in COMPRESSING_SAMTOOLS_COMMANDS
+        or '-u' in command
+        or any(str(arg).startswith('level=') for arg in command)
+    ):
+        return command
+    if command[1] == 'view' and not any(
+        arg.startswith('-') and not arg.startswith('--') and 'b' in arg
+        for arg in command[2:]
+        if isinstance(arg, str)
+    ):
+        return command
+    return command[:2] + compression_options(level) + command[2:]
+
+
+def wait_for_rusage(process):
+    """Wait for a process to exit and return its resource usage
+    
+    Parameters
+    ----------
+    process : subprocess.Popen
+        a running process, whose returncode is set on exit
+    
+    Returns
+    -------
+    resource.struct_rusage
+        resource usage of the process
+    """
+    
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = (
+        -os.WTERMSIG(status) if os.WIFSIGNALED(status)
+        else os.WEXITSTATUS(status)
+    )
+    return rusage
+
+
+def available_memory():
+    """Memory available to new processes, from /proc/meminfo if possible
+    
+    Returns
+    -------
+    int
+        available memory in bytes
+    """
+    
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def check_returncodes(*processes):
+    """Raise an AlignmentError if any of a set of finished processes failed
+    
+    Parameters
+    ----------
+    *processes
+        subprocess.Popen objects that have exited
+    """
+    
+    for process in processes:
+        if process.returncode:
+            raise AlignmentError(
+                f'{process.args[0]} exited with status {process.returncode}'
+            )
+
+
+def send_file(source, destination):
+    """Copy the rest of a file to another file or a pipe inside the kernel
+    
+    os.copy_file_range() is tried first, which can share the data blocks on
+    filesystems that support reflinks, then os.sendfile(), and the data is
+    only read into memory if neither is supported for the two files.
+    
+    Parameters
+    ----------
+    source : file object
+        binary file to copy from, from its current position
+    destination : file object or int
+        binary file object or file descriptor to copy to, at its current
+        position
+    
+    Returns
+    -------
+    int
+        number of bytes copied through the memory of this process, which is
+        0 unless both kernel copies are unsupported
+    """
+    
+    if isinstance(destination, int):
+        destination_fd = destination
+    else:
+        destination.flush()
+        destination_fd = destination.fileno()
+    source_fd = source.fileno()
+    offset = source.tell()
+    end = os.fstat(source_fd).st_size
+    kernel_copies = []
+    if hasattr(os, 'copy_file_range'):
+        kernel_copies.append(
+            lambda count: os.copy_file_range(
+                source_fd,
+                destination_fd,
+                count,
+                offset
+            )
+        )
+    if hasattr(os, 'sendfile'):
+        kernel_copies.append(
+            lambda count: os.sendfile(destination_fd, source_fd, offset, count)
+        )
+    for kernel_copy in kernel_copies:
+        try:
+            while offset < end:
+                copied = kernel_copy(end - offset)
+                if not copied:
+                    break
+                offset += copied
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_UNSUPPORTED:
+                raise
+        else:
+            source.seek(offset)
+            return 0
+    source.seek(offset)
+    data = source.read()
+    with open(destination_fd, 'wb', closefd=False) as f:
+        f.write(data)
+    return len(data)
+
+
+def write_to_pipe(pipe, data):
+    """Write data to a pipe and close it, tolerating an early exit of the
+    reading process
+    
+    Parameters
+    ----------
+    pipe : file object
+        the write end of a pipe
+    data : bytes
+        data to write
+    """
+    
+    try:
+        pipe.write(data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+
+async def write_to_pipe_async(writer, data, chunk_size=1 << 20):
+    """Write data to the stdin of an asyncio subprocess and close it,
+    tolerating an early exit of the process
+    
+    The data is written in chunks so that it is never copied into the
+    transport's buffer all at once.
+    
+    Parameters
+    ----------
+    writer : asyncio.StreamWriter
+        the stdin of a subprocess
+    data : bytes-like
+        data to write
+    chunk_size : int
+        size of each chunk in bytes
+    """
+    
+    view = memoryview(data)
+    try:
+        for start in range(0, len(view), chunk_size):
+            writer.write(view[start:start + chunk_size])
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+def bgzf_block_size(data, offset):
+    """Size of the BGZF block at an offset
+    
+    Parameters
+    ----------
+    data : bytes-like
+        BGZF-compressed data
+    offset : int
+        offset of the block within the data
+    
+    Returns
+    -------
+    tuple
+        the length of the gzip extra field and the total size of the block
+    """
+    
+    if bytes(data[offset:offset + 4]) != b'\x1f\x8b\x08\x04':
+        raise BAMFormatError(f'No BGZF block at offset {offset}')
+    extra_length, = struct.unpack_from('<H', data, offset + 10)
+    subfield_offset = offset + 12
+    while subfield_offset < offset + 12 + extra_length:
+        si1, si2, subfield_length = struct.unpack_from(
+            '<BBH',
+            data,
+            subfield_offset
+        )
+        if (si1, si2) == (66, 67):
+            block_size, = struct.unpack_from('<H', data, subfield_offset + 4)
+            return extra_length, block_size + 1
+        subfield_offset += 4 + subfield_length
+    raise BAMFormatError(f'No BGZF block size at offset {offset}')
+
+
+def bgzf_uncompressed_size(data):
+    """Total uncompressed size of BGZF-compressed data, read from the block
+    footers without decompressing
+    
+    Parameters
+    ----------
+    data : bytes-like
+        BGZF-compressed data
+    
+    Returns
+    -------
+    int
+        uncompressed size in bytes
+    """
+    
+    size = 0
+    offset = 0
+    while offset < len(data):
+        offset += bgzf_block_size(data, offset)[1]
+        size += struct.unpack_from('<I', data, offset - 4)[0]
+    return size
+
+
+def read_bgzf_block(data, offset):
+    """Decompress a single BGZF block
+    
+    Parameters
+    ----------
+    data : bytes-like
+        BGZF-compressed data
+    offset : int
+        offset of the block within the data
+    
+    Returns
+    -------
+    tuple
+        the decompressed block contents and the offset of the next block
+    """
+    
+    extra_length, block_size = bgzf_block_size(data, offset)
+    next_offset = offset + block_size
+    return (
+        zlib.decompress(
+            data[offset + 12 + extra_length:next_offset - 8],
+            -15
+        ),
+        next_offset
+    )
+
+
+def bam_file_is_complete(bam_path):
+    """Check that a BAM file is not empty and ends with the BGZF EOF marker
+    
+    Parameters
+    ----------
+    bam_path : str
+        Path to a BAM file
+    
+    Returns
+    -------
+    bool
+        True if the file is complete
+    """
+    
+    with open(bam_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < len(BGZF_EOF):
+            return False
+        f.seek(-len(BGZF_EOF), os.SEEK_END)
+        return f.read() == BGZF_EOF
+
+
+def read_bam_header(bam):
+    """Read the header of a BAM file
+    
+    Parameters
+    ----------
+    bam : bytes-like
+        a BAM file
+    
+    Returns
+    -------
+    tuple
+        the SAM header text (str) and a tuple of (name, length) pairs for the
+        reference sequences
+    """
+    
+    return parse_bam_header(BGZFReader(bam))
+
+
+def parse_bam_header(reader):
+    """Parse the header of a BAM file, leaving the reader at the first record
+    
+    Parameters
+    ----------
+    reader : BGZFReader
+        reader positioned at the start of a BAM file
+    
+    Returns
+    -------
+    tuple
+        the SAM header text (str) and a tuple of (name, length) pairs for the
+        reference sequences
+    """
+    
+    if reader.read(4) != b'BAM\x01':
+        raise BAMFormatError('Input is not a BAM file')
+    text_length, = struct.unpack('<i', reader.read(4))
+    text = reader.read(text_length).rstrip(b'\x00').decode()
+    n_references, = struct.unpack('<i', reader.read(4))
+    references = []
+    for _ in range(n_references):
+        name_length, = struct.unpack('<i', reader.read(4))
+        name = reader.read(name_length)[:-1].decode()
+        length, = struct.unpack('<i', reader.read(4))
+        references.append((name, length))
+    return text, tuple(references)
+
+
+def encode_bam_header(text, references):
+    """Encode a BAM header
+    
+    Parameters
+    ----------
+    text : str
+        SAM header text
+    references
+        (name, length) pairs for the reference sequences
+    
+    Returns
+    -------
+    bytes
+        the uncompressed BAM header
+    """
+    
+    text = text.encode()
+    return b''.join(
+        (
+            b'BAM\x01',
+            struct.pack('<i', len(text)),
+            text,
+            struct.pack('<i', len(references))
+        )
+        + tuple(
+            struct.pack('<i', len(name) + 1)
+            + name.encode()
+            + b'\x00'
+            + struct.pack('<i', length)
+            for name, length in references
+        )
+    )
+
+
+def iter_bam_records(reader):
+    """Iterate over the records of a BAM file
+    
+    Parameters
+    ----------
+    reader : BGZFReader
+        reader positioned at a record, usually by parse_bam_header()
+    
+    Yields
+    ------
+    bytes
+        a raw BAM record, including its block_size field
+    """
+    
+    while True:
+        block_size = reader.read(4)
+        if len(block_size) < 4:
+            return
+        yield block_size + reader.read(struct.unpack('<i', block_size)[0])
+
+
+def read_record_position(record):
+    """Read the reference ID, position and flag of a raw BAM record
+    
+    Parameters
+    ----------
+    record : bytes
+        a raw BAM record, including its block_size field
+    
+    Returns
+    -------
+    tuple
+        reference ID, 0-based leftmost position, and flag
+    """
+    
+    reference_id, position, _, _, _, _, flag, *_ = BAM_CORE.unpack_from(
+        record,
+        4
+    )
+    return reference_id, position, flag
+
+
+def alignment_end(record):
+    """Compute the end of the alignment of a raw BAM record
+    
+    Parameters
+    ----------
+    record : bytes
+        a raw BAM record, including its block_size field
+    
+    Returns
+    -------
+    int
+        0-based exclusive end position. Records that consume no reference
+        bases are treated as covering one base.
+    """
+    
+    _, position, name_length, _, _, n_cigar_operations, *_ = (
+        BAM_CORE.unpack_from(record, 4)
+    )
+    reference_length = sum(
+        operation >> 4
+        for operation in struct.unpack_from(
+            f'<{n_cigar_operations}I',
+            record,
+            36 + name_length
+        )
+        if operation & 0xf in CIGAR_REFERENCE_OPERATIONS
+    )
+    return position + (reference_length or 1)
+
+
+def five_prime_position(record):
+    """Compute the unclipped 5' position of a raw BAM record
+    
+    Parameters
+    ----------
+    record : bytes
+        a raw BAM record, including its block_size field
+    
+    Returns
+    -------
+    int
+        0-based position of the first base of the read, counting clipped
+        bases: the leftmost base for the forward strand, or the rightmost
+        base for the reverse strand. This may be negative, but is never
+        less than minus the read length.
+    """
+    
+    _, position, name_length, _, _, n_cigar_operations, flag, *_ = (
+        BAM_CORE.unpack_from(record, 4)
+    )
+    operations = struct.unpack_from(
+        f'<{n_cigar_operations}I',
+        record,
+        36 + name_length
+    )
+    if flag & 0x10:
+        clipped = itertools.takewhile(
+            lambda operation: operation & 0xf in CIGAR_CLIP_OPERATIONS,
+            reversed(operations)
+        )
+        return alignment_end(record) - 1 + sum(
+            operation >> 4 for operation in clipped
+        )
+    clipped = itertools.takewhile(
+        lambda operation: operation & 0xf in CIGAR_CLIP_OPERATIONS,
+        operations
+    )
+    return position - sum(operation >> 4 for operation in clipped)
+
+
+def encode_umi(umi):
+    """Pack a UMI into an integer
+    
+    UMIs made up of ``A``, ``C``, ``G`` and ``T`` take 2 bits per base.
+    Others (e.g. with ``N``, or the ``-`` between the halves of a dual UMI)
+    take 8 bits per character. A leading 1 bit keeps UMIs of different
+    lengths apart, and the lowest bit tells the two encodings apart.
+    
+    Parameters
+    ----------
+    umi : bytes
+        the UMI, or None
+    
+    Returns
+    -------
+    int
+        the packed UMI, or 0 if umi is None
+    """
+    
+    if umi is None:
+        return 0
+    if not umi.translate(None, b'ACGT'):
+        return int(b'1' + umi.translate(UMI_BASE_DIGITS), 4) << 1
+    return int.from_bytes(b'\x01' + umi, 'big') << 1 | 1
+
+
+def read_record_tag(record, tag):
+    """Read the value of an optional field of a raw BAM record
+    
+    Parameters
+    ----------
+    record : bytes
+        a raw BAM record, including its block_size field
+    tag : bytes
+        two-character tag, such as ``b'RX'``
+    
+    Returns
+    -------
+    bytes
+        the raw value of the field (without the terminating null byte for
+        strings), or None if the record does not have it
+    """
+    
+    _, _, name_length, _, _, n_cigar_operations, _, read_length, *_ = (
+        BAM_CORE.unpack_from(record, 4)
+    )
+    offset = (
+        36 + name_length + 4 * n_cigar_operations
+        + (read_length + 1) // 2 + read_length
+    )
+    while offset + 3 <= len(record):
+        field_tag = record[offset:offset + 2]
+        value_type = record[offset + 2:offset + 3]
+        offset += 3
+        if value_type in {b'Z', b'H'}:
+            end = record.index(b'\x00', offset)
+            value, size = record[offset:end], end + 1 - offset
+        else:
+            if value_type == b'B':
+                count, = struct.unpack_from('<i', record, offset + 1)
+                size = 5 + AUX_VALUE_SIZES[record[offset:offset + 1]] * count
+            else:
+                size = AUX_VALUE_SIZES[value_type]
+            value = record[offset:offset + size]
+        if field_tag == tag:
+            return bytes(value)
+        offset += size
+    return None
+
+
+def write_bam(header, records, stdout=subprocess.PIPE, compression_level=6):
+    """Compress a BAM header and records into a BAM file
+    
+    Parameters
+    ----------
+    header : bytes
+        uncompressed BAM header, as from encode_bam_header()
+    records
+        iterable of raw BAM records
+    stdout
+        binary file object to write to, or subprocess.PIPE to return the data
+    compression_level : int
+        zlib compression level
+    
+    Returns
+    -------
+    bytes
+        A BAM file in memory, or None if stdout is not subprocess.PIPE
+    """
+    
+    output = io.BytesIO() if stdout == subprocess.PIPE else stdout
+    with BGZFWriter(output, compression_level=compression_level) as writer:
+        writer.write(header)
+        for record in records:
+            writer.write(record)
+    return output.getvalue() if stdout == subprocess.PIPE else None
+
+
+def intervals_overlap(intervals, start, end):
+    """Check whether a region overlaps any of a set of merged intervals
+    
+    Parameters
+    ----------
+    intervals : tuple
+        sorted, non-overlapping interval starts and ends, as stored by an
+        IntervalIndex
+    start : int
+        0-based start of the region
+    end : int
+        end of the region (exclusive)
+    
+    Returns
+    -------
+    bool
+        True if the region overlaps an interval by at least one base
+    """
+    
+    starts, ends = intervals
+    i = bisect.bisect_left(starts, end) - 1
+    return (i >= 0) and (ends[i] > start)
+
+
+def load_interval_index(bed_path):
+    """Load an IntervalIndex for a BED file, reusing a cached one if the file
+    has not changed
+    
+    Parameters
+    ----------
+    bed_path : str
+        Path to a BED file on disk
+    
+    Returns
+    -------
+    IntervalIndex
+        index of the intervals in the BED file
+    """
+    
+    stat = os.stat(bed_path)
+    return cached_interval_index(
+        os.path.abspath(bed_path),
+        stat.st_mtime_ns,
+        stat.st_size
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def cached_interval_index(bed_path, mtime_ns, size):
+    """Build an IntervalIndex, caching it for the life of the process
+    
+    Parameters
+    ----------
+    bed_path : str
+        Absolute path to a BED file on disk
+    mtime_ns : int
+        modification time of the file, as part of the cache key
+    size : int
+        size of the file, as part of the cache key
+    
+    Returns
+    -------
+    IntervalIndex
+        index of the intervals in the BED file
+    """
+    
+    return IntervalIndex.from_bed(bed_path)
+
+
+def parse_bai(index, bins=True):
+    """Parse a BAI or CSI index
+    
+    Parameters
+    ----------
+    index : bytes
+        BAI or CSI index file generated by samtools index
+    bins : bool
+        if False, skip over the bins and linear index and only collect the
+        read counts, which is much faster
+    
+    Returns
+    -------
+    tuple
+        a list with a dict for each reference sequence, and the number of
+        reads with no coordinates. Each dict has keys ``mapped`` and
+        ``unmapped`` giving read counts, ``bins`` mapping bin numbers to
+        lists of (start, end) virtual offset pairs, and ``intervals`` giving
+        the virtual offsets of the linear index (the last two are None if
+        bins is False; a CSI index has no linear index, so ``intervals`` is
+        empty)
+    """
+    
+    index = decompress_index(index)
+    if index[:4] == b'BAI\x01':
+        pseudo_bin = BAI_PSEUDO_BIN
+        csi = False
+        n_references, = struct.unpack_from('<i', index, 4)
+        offset = 8
+    elif index[:4] == b'CSI\x01':
+        _, depth, aux_length = struct.unpack_from('<iii', index, 4)
+        pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        csi = True
+        n_references, = struct.unpack_from('<i', index, 16 + aux_length)
+        offset = 20 + aux_length
+    else:
+        raise BAMFormatError('Input is not a BAI or CSI index')
+    references = []
+    for _ in range(n_references):
+        reference = {
+            'mapped': 0,
+            'unmapped': 0,
+            'bins': {} if bins else None,
+            'intervals': None
+        }
+        n_bins, = struct.unpack_from('<i', index, offset)
+        offset += 4
+        for _ in range(n_bins):
+            bin, = struct.unpack_from('<I', index, offset)
+            offset += 12 if csi else 4
+            n_chunks, = struct.unpack_from('<i', index, offset)
+            offset += 4
+            if bin == pseudo_bin:
+                reference['mapped'], reference['unmapped'] = (
+                    struct.unpack_from('<QQ', index, offset + 16)
+                )
+            elif bins:
+                chunks = struct.unpack_from(f'<{2 * n_chunks}Q', index, offset)
+                reference['bins'][bin] = list(zip(chunks[::2], chunks[1::2]))
+            offset += 16 * n_chunks
+        if csi:
+            if bins:
+                reference['intervals'] = ()
+            references.append(reference)
+            continue
+        n_intervals, = struct.unpack_from('<i', index, offset)
+        offset += 4
+        if bins:
+            reference['intervals'] = struct.unpack_from(
+                f'<{n_intervals}Q',
+                index,
+                offset
+            )
+        offset += 8 * n_intervals
+        references.append(reference)
+    no_coordinate = (
+        struct.unpack_from('<Q', index, offset)[0]
+        if len(index) >= offset + 8
+        else 0
+    )
+    return references, no_coordinate
+
+
+def decompress_index(index):
+    """Decompress a BGZF-compressed index, as samtools writes CSI indexes
+    
+    Parameters
+    ----------
+    index : bytes
+        BAI or CSI index, which may be BGZF-compressed
+    
+    Returns
+    -------
+    bytes
+        the uncompressed index
+    """
+    
+    if index[:2] != b'\x1f\x8b':
+        return index
+    blocks = []
+    offset = 0
+    while offset < len(index):
+        block, offset = read_bgzf_block(index, offset)
+        blocks.append(block)
+    return b''.join(blocks)
+
+
+@functools.lru_cache(maxsize=4)
+def cached_region_index(index):
+    """Parse the bins of an index for region queries, caching the result so
+    that repeated queries on the same index do not parse it again
+    
+    Parameters
+    ----------
+    index : bytes
+        BAI or CSI index
+    
+    Returns
+    -------
+    tuple
+        the references from parse_bai(), the minimum shift (the log2 size of
+        the smallest bin) and the depth of the binning scheme
+    """
+    
+    references, _ = parse_bai(index)
+    if index[:4] == b'BAI\x01':
+        min_shift, depth = 14, 5
+    else:
+        min_shift, depth = struct.unpack_from(
+            '<ii',
+            decompress_index(index),
+            4
+        )
+    return references, min_shift, depth
+
+
+def parse_region(region, references):
+    """Parse a region in samtools format
+    
+    Parameters
+    ----------
+    region : str
+        ``name``, ``name:start`` or ``name:start-end`` with 1-based inclusive
+        coordinates, or ``*`` for reads with no coordinates
+    references
+        (name, length) pairs for the reference sequences, from the header
+    
+    Returns
+    -------
+    tuple
+        reference ID (-1 for ``*``), and 0-based start and exclusive end
+    """
+    
+    reference_ids = {name: i for i, (name, _) in enumerate(references)}
+    if region == '*':
+        return -1, 0, 0
+    if region in reference_ids:
+        reference_id = reference_ids[region]
+        return reference_id, 0, references[reference_id][1]
+    name, _, interval = region.rpartition(':')
+    if name not in reference_ids:
+        raise ValueError(f'{region} is not a region of the BAM data')
+    reference_id = reference_ids[name]
+    start, _, end = interval.replace(',', '').partition('-')
+    try:
+        return (
+            reference_id,
+            max(int(start) - 1, 0),
+            int(end) if end else references[reference_id][1]
+        )
+    except ValueError:
+        raise ValueError(f'{region} is not a region of the BAM data')
+
+
+def region_bins(start, end, min_shift=14, depth=5):
+    """List the bins that may hold reads overlapping a region, as in the
+    SAM specification
+    
+    Parameters
+    ----------
+    start : int
+        0-based start of the region
+    end : int
+        end of the region (exclusive)
+    min_shift : int
+        log2 size of the smallest bin (14 for BAI)
+    depth : int
+        number of levels below the root bin (5 for BAI)
+    
+    Returns
+    -------
+    list
+        bin numbers
+    """
+    
+    end -= 1
+    bins = []
+    first_bin = 0
+    shift = min_shift + depth * 3
+    for level in range(depth + 1):
+        bins.extend(
+            range(first_bin + (start >> shift), first_bin + (end >> shift) + 1)
+        )
+        first_bin += 1 << (level * 3)
+        shift -= 3
+    return bins
+
+
+def plan_region_queries(regions, index_references, min_shift=14, depth=5):
+    """Merge regions and look up the chunks of BAM data that may hold reads
+    overlapping them
+    
+    Parameters
+    ----------
+    regions
+        (reference ID, start, end) tuples, from parse_region()
+    index_references : list
+        references from parse_bai()
+    min_shift : int
+        log2 size of the smallest bin
+    depth : int
+        number of levels below the root bin
+    
+    Returns
+    -------
+    list
+        (reference ID, start, end, chunks) tuples for non-overlapping regions
+        in coordinate order, where chunks are merged (start, end) virtual
+        offset pairs
+    """
+    
+    merged = []
+    for reference_id, start, end in sorted(
+        regions,
+        key=lambda region: (region[0] & 0xffffffff, region[1])
+    ):
+        if merged and merged[-1][0] == reference_id and start <= merged[-1][2]:
+            merged[-1][2] = max(merged[-1][2], end)
+        elif reference_id < 0 or end > start:
+            merged.append([reference_id, start, end])
+    queries = []
+    for reference_id, start, end in merged:
+        if reference_id < 0:
+            last_offset = max(
+                (
+                    chunk_end
+                    for reference in index_references
+                    for chunks in reference['bins'].values()
+                    for _, chunk_end in chunks
+                ),
+                default=0
+            )
+            queries.append((-1, 0, 0, [(last_offset, 1 << 64)]))
+            continue
+        reference = index_references[reference_id]
+        intervals = reference['intervals']
+        min_offset = (
+            intervals[start >> 14]
+            if intervals and (start >> 14) < len(intervals)
+            else 0
+        )
+        chunks = []
+        for chunk_start, chunk_end in sorted(
+            chunk
+            for bin in region_bins(start, end, min_shift, depth)
+            for chunk in reference['bins'].get(bin, ())
+            if chunk[1] > min_offset
+        ):
+            if chunks and chunk_start <= chunks[-1][1]:
+                chunks[-1][1] = max(chunks[-1][1], chunk_end)
+            else:
+                chunks.append([max(chunk_start, min_offset), chunk_end])
+        queries.append((reference_id, start, end, chunks))
+    return queries
+
+
+def iter_region_records(bam, queries):
+    """Iterate over the records overlapping regions, seeking directly to the
+    chunks of BAM data given by an index
+    
+    Parameters
+    ----------
+    bam : bytes-like
+        coordinate-sorted BAM data
+    queries : list
+        (reference ID, start, end, chunks) tuples, from plan_region_queries()
+    
+    Yields
+    ------
+    bytes
+        raw BAM records overlapping the regions, each once and in coordinate
+        order
+    """
+    
+    reader = BGZFReader(bam)
+    last_offset = -1
+    for reference_id, start, end, chunks in queries:
+        for chunk_start, chunk_end in chunks:
+            reader.seek(chunk_start)
+            if not chunk_start:
+                parse_bam_header(reader)
+            while reader.tell() < chunk_end:
+                offset = reader.tell()
+                block_size = reader.read(4)
+                if len(block_size) < 4:
+                    break
+                record = block_size + reader.read(
+                    struct.unpack('<i', block_size)[0]
+                )
+                record_reference_id, position, _ = read_record_position(record)
+                if reference_id >= 0 and (
+                    record_reference_id != reference_id or position >= end
+                ):
+                    break
+                if (
+                    offset > last_offset
+                    and record_reference_id == reference_id
+                    and (reference_id < 0 or alignment_end(record) > start)
+                ):
+                    last_offset = offset
+                    yield record
+            else:
+                continue
+            break
+
+
+def cache_directory():
+    """Return the directory for seqalign's persistent caches
+    
+    Returns
+    -------
+    str
+        ``$XDG_CACHE_HOME/seqalign``, or ``~/.cache/seqalign``
+    """
+    
+    return os.path.join(
+        os.environ.get(
+            'XDG_CACHE_HOME',
+            os.path.join(os.path.expanduser('~'), '.cache')
+        ),
+        'seqalign'
+    )
+
+
+def fingerprint_files(*paths):
+    """Fingerprint files by path, size, modification time and inode
+    
+    Parameters
+    ----------
+    *paths
+        file paths
+    
+    Returns
+    -------
+    list
+        [path, size, mtime_ns, inode] for each file
+    """
+    
+    fingerprints = []
+    for path in paths:
+        stat = os.stat(path)
+        fingerprints.append(
+            [
+                os.path.abspath(path),
+                stat.st_size,
+                stat.st_mtime_ns,
+                stat.st_ino
+            ]
+        )
+    return fingerprints
+
+
+def input_size(input_file):
+    """Size of the input for a SequenceAlignment
+    
+    Parameters
+    ----------
+    input_file : bytes, SpilledBAM, tuple, list, str
+        Sequencing data, as for SequenceAlignment()
+    
+    Returns
+    -------
+    int
+        size in bytes of the data in memory or of the files on disk
+    """
+    
+    if isinstance(input_file, str):
+        return os.path.getsize(input_file)
+    elif isinstance(input_file, (tuple, list)):
+        return sum(os.path.getsize(path) for path in input_file)
+    return len(input_file)
+
+
+def parse_markdup_stats(lines):
+    """Parse the statistics written by samtools markdup -f
+    
+    Parameters
+    ----------
+    lines
+        lines of the statistics file, such as an open file object
+    
+    Returns
+    -------
+    dict
+        the statistics, with keys in lower case and underscores for spaces
+        (e.g. ``read``, ``examined``, ``duplicate_total``), plus the
+        ``duplicate_fraction`` of examined reads if they were reported
+    """
+    
+    stats = {}
+    for line in lines:
+        key, separator, value = line.partition(':')
+        if not separator:
+            continue
+        value = value.strip()
+        stats[key.strip().lower().replace(' ', '_')] = (
+            int(value) if value.isdigit() else value
+        )
+    if stats.get('examined') and 'duplicate_total' in stats:
+        stats['duplicate_fraction'] = (
+            stats['duplicate_total'] / stats['examined']
+        )
+    return stats
+
+
+def file_format_from_extension(file_path):
+    """Infer the format of a sequencing data file from its extension
+    
+    Parameters
+    ----------
+    file_path : str
+        Path to a sequencing data file
+    
+    Returns
+    -------
+    str
+        one of ``fasta``, ``fastq``, ``sam``, ``bam``, ``cram``
+    """
+    
+    if (file_path.split('.')[-1] in {'fasta', 'fa'}) or (
+        file_path.split('.')[-1] == 'gz' and (
+            file_path.split('.')[-2] in {'fasta', 'fa'}
+        )
+    ):
+        format = 'fasta'
+    elif (file_path.split('.')[-1] in {'fastq', 'fq', 'fq1', 'fq2'}) or (
+        file_path.split('.')[-1] == 'gz' and (
+            file_path.split('.')[-2] in {'fastq', 'fq', 'fq1', 'fq2'}
+        )
+    ):
+        format = 'fastq'
+    elif file_path.split('.')[-1] in {'sam', 'bam', 'cram'}:
+        format = file_path.split('.')[-1]
+    else:
+        raise FileExtensionError(
+            f'Could not parse file extension of {os.path.basename(file_path)}'
+        )
+    return format
+
+
+def get_median_read_length(
+    raw_reads_paths,
+    number_of_reads,
+    sampling='head',
+    stride=1,
+    seed=None,
+    cache=None
+):
+    """Return the median read length of a FASTA or FASTQ file
+    
+    If paired-end, both files are sampled in parallel and the median is taken
+    over the reads of both.
+    
+    Parameters
+    ----------
+    raw_reads_paths : str, list, tuple
+        Path to raw reads file (or paths if paired-end)
+    number_of_reads : int
+        Maximum number of reads to read in before determining median read length
+    sampling : str
+        ``head`` to use the first reads of each file, ``stride`` to use every
+        stride-th read, or ``reservoir`` to use a uniform random sample of
+        the whole file
+    stride : int
+        Sampling interval for ``stride`` sampling
+    seed
+        Random seed for ``reservoir`` sampling
+    cache : ReadMetadataCache
+        If provided, histograms are looked up in (and saved to) this cache
+    
+    Returns
+    -------
+    int or float
+        The median read length
+    """
+    
+    if isinstance(raw_reads_paths, str):
+        raw_reads_paths = (raw_reads_paths,)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(raw_reads_paths)
+    ) as executor:
+        histograms = tuple(
+            executor.map(
+                lambda raw_reads_path: (
+                    cache.read_length_histogram if cache
+                    else read_length_histogram
+                )(
+                    raw_reads_path,
+                    number_of_reads,
+                    sampling=sampling,
+                    stride=stride,
+                    seed=seed
+                ),
+                raw_reads_paths
+            )
+        )
+    return median_from_histogram(sum(histograms, collections.Counter()))
+
+
+def read_length_histogram(
+    raw_reads_path,
+    number_of_reads,
+    sampling='head',
+    stride=1,
+    seed=None
+):
+    """Sample the read lengths of a FASTA or FASTQ file
+    
+    Parameters
+    ----------
+    raw_reads_path : str
+        Path to raw reads file
+    number_of_reads : int
+        Maximum number of reads to sample
+    sampling : str
+        ``head``, ``stride`` or ``reservoir``, as for get_median_read_length()
+    stride : int
+        Sampling interval for ``stride`` sampling
+    seed
+        Random seed for ``reservoir`` sampling
+    
+    Returns
+    -------
+    collections.Counter
+        Histogram mapping read lengths to read counts
+    """
+    
+    format = file_format_from_extension(raw_reads_path)
+    with open_raw_reads(raw_reads_path) as raw_reads:
+        chunks = (
+            iter_fastq_read_lengths(raw_reads)
+            if format == 'fastq'
+            else iter_fasta_read_lengths(raw_reads)
+        )
+        if sampling == 'reservoir':
+            return collections.Counter(
+                reservoir_sample(chunks, number_of_reads, seed=seed)
+            )
+        elif sampling in {'head', 'stride'}:
+            return collections.Counter(
+                itertools.islice(
+                    itertools.chain.from_iterable(chunks),
+                    0,
+                    number_of_reads * stride,
+                    stride if sampling == 'stride' else 1
+                )
+            )
+        else:
+            raise ValueError('sampling must be head, stride, or reservoir')
+
 
-    Attributes
+@contextlib.contextmanager
+def open_raw_reads(raw_reads_path):
+    """Open a (possibly gzipped) raw reads file in binary mode
+    
+    Gzipped files are decompressed by pigz in a separate process if it is
+    available.
+    
+    Parameters
     ----------
-    processes
-        number of processes to use
-    """
+    raw_reads_path : str
+        Path to raw reads file
     
-    def __init__(self, processes=1):
-        self.processes = processes
+    Yields
+    ------
+    file object
+        The decompressed file
+    """
     
-    def __call__(self, bam, log=None):
+    if not raw_reads_path.endswith('.gz'):
+        with open(raw_reads_path, 'rb') as raw_reads:
+            yield raw_reads
+    elif shutil.which('pigz'):
         with subprocess.Popen(
-            (
-              'samtools', 'view',
-              '-bh',
-              '-F', '0x400',
-              '-@', str(self.processes - 1)
-            ),
-            stdin=subprocess.PIPE,
+            ('pigz', '-dc', raw_reads_path),
             stdout=subprocess.PIPE,
-            stderr=log if log else os.devnull
-        ) as samtools_view:
-            return samtools_view.communicate()[0]
+            stderr=subprocess.DEVNULL
+        ) as pigz:
+            try:
+                yield pigz.stdout
+            finally:
+                pigz.kill()
+    else:
+        with gzip.open(raw_reads_path, 'rb') as raw_reads:
+            yield raw_reads
 
 
+def iter_fastq_read_lengths(raw_reads, chunk_size=1 << 22):
+    """Read the lengths of the reads in a FASTQ file, a chunk at a time
+    
+    Runs of complete records in the usual four-line layout are measured
+    directly. Records whose sequence and quality are wrapped over several
+    lines are parsed line by line: the sequence runs up to the ``+`` separator
+    line, and the quality is read until it is as long as the sequence, since
+    quality lines may themselves begin with ``@`` or ``+``.
+    
+    Parameters
+    ----------
+    raw_reads : file object
+        FASTQ file opened in binary mode
+    chunk_size : int
+        Number of bytes to read at a time
+    
+    Yields
+    ------
+    list
+        lengths of the reads completed within a chunk
+    """
+    
+    remainder = b''
+    state = 'header'
+    sequence_length = quality_length = 0
+    while True:
+        chunk = raw_reads.read(chunk_size)
+        if chunk:
+            lines = (remainder + chunk.replace(b'\r', b'')).split(b'\n')
+            remainder = lines.pop()
+        else:
+            lines = [remainder] if remainder else []
+        lengths = []
+        fast_path_tried = False
+        index = 0
+        while index < len(lines):
+            if state == 'header' and not fast_path_tried:
+                fast_path_tried = True
+                end = index + (len(lines) - index) // 4 * 4
+                headers = lines[index:end:4]
+                separators = lines[index + 2:end:4]
+                sequence_lengths = list(map(len, lines[index + 1:end:4]))
+                # Lines sort bytewise, so every line starts with the same
+                # byte as the least and greatest ones if those two agree
+                if (
+                    headers
+                    and min(headers)[:1] == max(headers)[:1] == b'@'
+                    and min(separators)[:1] == max(separators)[:1] == b'+'
+                    and list(map(len, lines[index + 3:end:4]))
+                    == sequence_lengths
+                ):
+                    lengths.extend(sequence_lengths)
+                    index = end
+                    continue
+            line = lines[index]
+            index += 1
+            if state == 'header':
+                if line.startswith(b'@'):
+                    state = 'sequence'
+                    sequence_length = 0
+            elif state == 'sequence':
+                if line.startswith(b'+'):
+                    state = 'quality'
+                    quality_length = 0
+                else:
+                    sequence_length += len(line)
+                    continue
+            else:
+                quality_length += len(line)
+            if state == 'quality' and quality_length >= sequence_length:
+                lengths.append(sequence_length)
+                state = 'header'
+        yield lengths
+        if not chunk:
+            return
 
 
-# Exceptions ===================================================================
+def iter_fasta_read_lengths(raw_reads, chunk_size=1 << 22):
+    """Read the lengths of the reads in a FASTA file, a chunk at a time
+    
+    Parameters
+    ----------
+    raw_reads : file object
+        FASTA file opened in binary mode
+    chunk_size : int
+        Number of bytes to read at a time
+    
+    Yields
+    ------
+    list
+        lengths of the reads completed within a chunk
+    """
+    
+    remainder = b''
+    length = None
+    while True:
+        chunk = raw_reads.read(chunk_size)
+        if chunk:
+            lines = (remainder + chunk.replace(b'\r', b'')).split(b'\n')
+            remainder = lines.pop()
+        else:
+            lines = [remainder]
+        lengths = []
+        for line in lines:
+            if line.startswith(b'>'):
+                if length is not None:
+                    lengths.append(length)
+                length = 0
+            elif length is not None:
+                length += len(line)
+        if not chunk:
+            if length is not None:
+                lengths.append(length)
+            yield lengths
+            return
+        yield lengths
 
-class Error(Exception):
-   """Base class for other exceptions"""
-   
-   pass
+
+def reservoir_sample(chunks, size, seed=None):
+    """Draw a uniform random sample from items arriving in chunks
+    
+    Uses Li's Algorithm L, which skips directly between replaced items.
+    
+    Parameters
+    ----------
+    chunks
+        iterable of lists of items
+    size : int
+        Size of the sample
+    seed
+        Random seed
+    
+    Returns
+    -------
+    list
+        The sample, empty if size is not positive
+    """
+    
+    if size <= 0:
+        return []
+    rng = random.Random(seed)
+    reservoir = []
+    weight = math.exp(math.log(rng.random()) / size)
+    next_index = size + int(math.log(rng.random()) / math.log(1 - weight))
+    chunk_start = 0
+    for chunk in chunks:
+        if len(reservoir) < size:
+            reservoir.extend(chunk[:size - len(reservoir)])
+        while next_index < chunk_start + len(chunk):
+            reservoir[rng.randrange(size)] = chunk[next_index - chunk_start]
+            weight *= math.exp(math.log(rng.random()) / size)
+            next_index += int(
+                math.log(rng.random()) / math.log(1 - weight)
+            ) + 1
+        chunk_start += len(chunk)
+    return reservoir
 
 
-class FileExtensionError(Error):
-    """File extension error"""
+def median_from_histogram(histogram):
+    """Compute the median from a histogram
     
-    pass
+    Parameters
+    ----------
+    histogram : dict
+        Maps values to counts
+    
+    Returns
+    -------
+    int or float
+        The median value
+    """
+    
+    if not histogram:
+        raise Exception('No reads in input file')
+    read_lengths = tuple(sorted(histogram))
+    total_reads = sum(histogram.values())
+    cumulative_count = 0
+    for i, length in enumerate(read_lengths):
+        cumulative_count += histogram[length]
+        if cumulative_count > total_reads / 2:
+            return length
+        elif cumulative_count == total_reads / 2:
+            return (length + read_lengths[i + 1]) / 2
 
 
-class MemoryLimitError(Error):
-    """Memory limit error"""
+def split_raw_reads(raw_reads_path, reads_per_shard, prefix):
+    """Split a FASTA or FASTQ file into shards of consecutive reads
     
-    pass
+    FASTQ records are found as by iter_fastq_read_lengths(), so records
+    whose sequence and quality are wrapped over several lines are kept whole.
+    Shards are written uncompressed.
+    
+    Parameters
+    ----------
+    raw_reads_path : str
+        Path to raw reads file
+    reads_per_shard : int
+        Number of reads in each shard (the last may have fewer)
+    prefix : str
+        Prefix for shard file paths
+    
+    Returns
+    -------
+    list
+        Paths to the shard files, in input order
+    """
+    
+    format = file_format_from_extension(raw_reads_path)
+    shard_paths = []
+    shard = None
+    reads = 0
+    state = 'header'
+    sequence_length = quality_length = 0
+    try:
+        with open_raw_reads(raw_reads_path) as raw_reads:
+            for line in raw_reads:
+                if format == 'fastq':
+                    record_start = state == 'header' and line.startswith(b'@')
+                    length = len(line.rstrip(b'\r\n'))
+                    if record_start:
+                        state = 'sequence'
+                        sequence_length = 0
+                    elif state == 'sequence':
+                        if line.startswith(b'+'):
+                            state = 'quality'
+                            quality_length = 0
+                        else:
+                            sequence_length += length
+                    elif state == 'quality':
+                        quality_length += length
+                    if state == 'quality' and quality_length >= sequence_length:
+                        state = 'header'
+                else:
+                    record_start = line.startswith(b'>')
+                if record_start:
+                    if reads % reads_per_shard == 0:
+                        if shard:
+                            shard.close()
+                        shard_paths.append(
+                            f'{prefix}.{len(shard_paths)}.{format}'
+                        )
+                        shard = open(shard_paths[-1], 'wb')
+                    reads += 1
+                if shard:
+                    shard.write(line)
+    finally:
+        if shard:
+            shard.close()
+    return shard_paths
 
 
-class MissingInputError(Error):
-    """Missing input error"""
+def spill_merge_inputs(bams, temp_dir):
+    """Write the inputs in memory of a merge to temporary files, except for
+    as many as can be fed through pipes
     
-    pass
+    Each pipe holds two file descriptors in this process until the merge has
+    started, so only merge_fan_in() inputs in memory are kept in memory.
+    
+    Parameters
+    ----------
+    bams
+        paths to BAM files on disk or BAM files as bytes-like objects
+    temp_dir : str
+        directory for the temporary files
+    
+    Returns
+    -------
+    list
+        the inputs, with those written to disk replaced by their paths
+    """
+    
+    members, piped = [], 0
+    for i, bam in enumerate(bams):
+        if not isinstance(bam, str) and piped >= merge_fan_in():
+            path = os.path.join(temp_dir, f'input{i}.bam')
+            with open(path, 'wb') as f:
+                f.write(bam)
+            bam = path
+        piped += not isinstance(bam, str)
+        members.append(bam)
+    return members
 
 
+def plan_merge(bams, threads=1, output=('-',), fan_in=None):
+    """Plan samtools merge commands for a set of inputs, fed through pipes
+    
+    Inputs in memory are passed to samtools as ``/dev/fd`` paths of pipes,
+    so nothing is written to disk. Use spill_merge_inputs() first to bound
+    the number of pipes. If there are more than fan_in inputs, they are
+    merged as a balanced tree: groups of inputs are merged into uncompressed
+    streams, which are merged by the next level up.
+    
+    Commands are generated in the order they should be started. The pipes of
+    a merge are created just before it is generated, and this process's
+    copies of its input pipes are closed when the generator resumes, so the
+    caller must start each command before requesting the next.
+    
+    Parameters
+    ----------
+    bams
+        paths to BAM files on disk or BAM files as bytes-like objects
+    threads : int
+        total threads for the final merge
+    output : tuple
+        output arguments for the final merge
+    fan_in : int
+        maximum number of inputs for each samtools merge, defaults to
+        merge_fan_in()
+    
+    Yields
+    ------
+    tuple
+        arguments, stdout and pass_fds for a command, with a stdout of None
+        for the final merge, and a list of (file descriptor, data) pairs to
+        feed to its pipes. The caller is responsible for closing the file
+        descriptors of the feeds.
+    """
+    
+    fan_in = max(2, fan_in or merge_fan_in())
+    members = list(bams)
+    while len(members) > fan_in:
+        n_groups = math.ceil(len(members) / fan_in)
+        size, extra = divmod(len(members), n_groups)
+        bounds = tuple(
+            itertools.accumulate(
+                (size + (i < extra) for i in range(n_groups)),
+                initial=0
+            )
+        )
+        members = [
+            members[start:end] for start, end in zip(bounds, bounds[1:])
+        ]
+    
+    def merge_commands(members, stdout=None):
+        paths, pass_fds, feeds = [], [], []
+        try:
+            for member in members:
+                if isinstance(member, str):
+                    paths.append(member)
+                    continue
+                read_fd, write_fd = os.pipe()
+                pass_fds.append(read_fd)
+                paths.append(f'/dev/fd/{read_fd}')
+                if isinstance(member, list):
+                    try:
+                        yield from merge_commands(member, stdout=write_fd)
+                    finally:
+                        os.close(write_fd)
+                else:
+                    feeds.append((write_fd, member))
+            command_feeds, feeds = feeds, []
+            yield (
+                ('samtools', 'merge')
+                + (
+                    ('-u', '-') if stdout is not None
+                    else ('-@', str(max(1, threads) - 1)) + tuple(output)
+                )
+                + tuple(paths),
+                stdout,
+                tuple(pass_fds),
+                command_feeds
+            )
+        finally:
+            for fd in pass_fds:
+                os.close(fd)
+            for fd, _ in feeds:
+                os.close(fd)
+    
+    yield from merge_commands(members)
 
 
-# Functions ====================================================================
+def merge_fan_in():
+    """Maximum number of inputs for one samtools merge, given the limit on
+    open file descriptors
+    
+    Returns
+    -------
+    int
+        MERGE_FAN_IN, or less if the file descriptor limit is low
+    """
+    
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return MERGE_FAN_IN
+    return max(2, min(MERGE_FAN_IN, soft_limit // 4))
 
-def samtools_fixmate(bam: bytes, log=None):
-    """Apply samtools fixmate to a BAM file (bytes object)
 
+def merge_output(stdout, index_path=None):
+    """Output arguments for samtools merge
+    
     Parameters
     ----------
-    bam : bytes
-        bytes object representing a BAM file
+    stdout
+        destination for the merged data
+    index_path : str
+        If set, write an index here during the merge. stdout must then be a
+        file object for a named file.
     
     Returns
     -------
-    bytes
-        BAM file with mates fixed
+    tuple
+        the output arguments
     """
+    
+    if index_path is None:
+        return ('-',)
+    return ('--write-index', '-o', f'{stdout.name}##idx##{index_path}')
 
-    with subprocess.Popen(
-        ('samtools', 'fixmate', '-r', '-', '-'),
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=log,
-    ) as samtools_fixmate:
-        return samtools_fixmate.communicate(bam)[0]
 
-def file_format_from_extension(file_path):
-    """Infer the format of a sequencing data file from its extension
+def start_feeds(feeds):
+    """Start a thread writing data to each of a set of pipes
     
     Parameters
     ----------
-    file_path : str
-        Path to a sequencing data file
+    feeds
+        (file descriptor, data) pairs, as from plan_merge()
     
     Returns
     -------
-    str
-        one of ``fasta``, ``fastq``, ``sam``, ``bam``
+    list
+        the started threads
     """
     
-    if (file_path.split('.')[-1] in {'fasta', 'fa'}) or (
-        file_path.split('.')[-1] == 'gz' and (
-            file_path.split('.')[-2] in {'fasta', 'fa'}
-        )
-    ):
-        format = 'fasta'
-    elif (file_path.split('.')[-1] in {'fastq', 'fq', 'fq1', 'fq2'}) or (
-        file_path.split('.')[-1] == 'gz' and (
-            file_path.split('.')[-2] in {'fastq', 'fq', 'fq1', 'fq2'}
-        )
-    ):
-        format = 'fastq'
-    elif file_path.split('.')[-1] in {'sam', 'bam'}:
-        format = file_path.split('.')[-1]
-    else:
-        raise FileExtensionError(
-            f'Could not parse file extension of {os.path.basename(file_path)}'
-        )
-    return format
+    writers = [
+        threading.Thread(target=write_to_pipe, args=(open(fd, 'wb'), data))
+        for fd, data in feeds
+    ]
+    for writer in writers:
+        writer.start()
+    return writers
 
 
-def get_median_read_length(raw_reads_paths, number_of_reads):
-    """Return the median read length of a FASTA or FASTQ file
+def samtools_merge(
+    *bams,
+    temp_dir=None,
+    stdout=subprocess.PIPE,
+    threads=1,
+    index_path=None,
+    log=None,
+    fan_in=None,
+    compression_level=None
+):
+    """Merge BAM files using samtools merge
+    
+    BAM files in memory are streamed to samtools through pipes rather than
+    written to temporary files, and many inputs are merged as a balanced
+    tree (see plan_merge()).
     
     Parameters
     ----------
-    raw_reads_paths : str, list, tuple
-        Path to raw reads file (or paths if paired-end)
-    number_of_reads : int
-        Maximum number of reads to read in before determining median read length
+    *bams
+        Variable number of paths to BAM files on disk or BAM files as bytes
+        objects (the two can be mixed)
+    temp_dir
+        directory for temporary copies of inputs in memory that are not fed
+        through pipes (see spill_merge_inputs())
+    stdout
+        destination for the merged BAM data, as for subprocess.Popen
+    threads : int
+        total threads for samtools merge
+    index_path : str
+        If set, build an index here during the merge (the inputs must be
+        coordinate-sorted). stdout must then be a file object for a named
+        file.
+    log : file object
+        File object to which stderr of samtools will be written
+    fan_in : int
+        maximum number of inputs for each samtools merge
+    compression_level : int
+        compression level of the merged BAM data, or None for the samtools
+        default. Intermediate merges are always uncompressed.
     
     Returns
     -------
-    int or float
-        The median read length
+    bytes
+        A BAM file in memory, or None if stdout is not subprocess.PIPE
+    
+    Raises
+    ------
+    AlignmentError
+        If any of the samtools merge processes fails
     """
     
-    histogram = {}
-    if not isinstance(raw_reads_paths, str):
-        formats = tuple(
-            file_format_from_extension(raw_reads_paths[i]) for i in range(2)
+    with contextlib.ExitStack() as stack:
+        commands = stack.enter_context(
+            contextlib.closing(
+                plan_merge(
+                    spill_merge_inputs(
+                        bams,
+                        stack.enter_context(
+                            tempfile.TemporaryDirectory(dir=temp_dir)
+                        )
+                    ),
+                    threads=threads,
+                    output=(
+                        compression_options(compression_level)
+                        + merge_output(stdout, index_path)
+                    ),
+                    fan_in=fan_in
+                )
+            )
         )
-    else:
-        formats = (file_format_from_extension(raw_reads_paths),)
-        raw_reads_paths = (raw_reads_paths,)
-    for raw_reads_path, format in zip(raw_reads_paths, formats):
-        with (
-            gzip.open(raw_reads_path, 'rt')
-            if raw_reads_path[-3:] == '.gz'
-            else open(raw_reads_path, 'r')
-        ) as raw_reads:
-            for record in itertools.islice(
-                SeqIO.parse(raw_reads, format),
-                number_of_reads
-            ):
-                try:
-                    histogram[len(record.seq)] += 1
-                except KeyError:
-                    histogram[len(record.seq)] = 1
-        if not histogram:
-            raise Exception('No reads in input file')
-        read_lengths = tuple(
-            length for length, count in sorted(histogram.items())
-        )
-        total_reads = sum(count for length, count in histogram.items())
-        cumulative_count = 0
-        for length, count in sorted(histogram.items()):
-            cumulative_count += count
-            if cumulative_count > total_reads / 2:
-                median = length
-                break
-            elif cumulative_count == total_reads / 2:
-                read_lengths = tuple(
-                    length for length, count in sorted(histogram.items())
+        processes, feeds = [], []
+        try:
+            for args, pipe, pass_fds, command_feeds in commands:
+                feeds.extend(command_feeds)
+                processes.append(
+                    stack.enter_context(
+                        subprocess.Popen(
+                            args,
+                            stdout=(
+                                pipe if pipe is not None
+                                else subprocess.DEVNULL if index_path
+                                else stdout
+                            ),
+                            stderr=log,
+                            pass_fds=pass_fds
+                        )
+                    )
                 )
-                next_length = read_lengths[read_lengths.index(length) + 1]
-                median = (length + next_length) / 2
-                break
-    return median
+        except BaseException:
+            commands.close()
+            for fd, _ in feeds:
+                os.close(fd)
+            raise
+        writers = start_feeds(feeds)
+        bam, _ = processes[-1].communicate()
+        for process in processes:
+            process.wait()
+        for writer in writers:
+            writer.join()
+    check_returncodes(*processes)
+    return bam
 
 
-def samtools_merge(*bams, temp_dir=None):
-    """Merge BAM files using samtools merge
+async def samtools_merge_async(
+    *bams,
+    temp_dir=None,
+    stdout=subprocess.PIPE,
+    threads=1,
+    index_path=None,
+    log=None,
+    fan_in=None,
+    compression_level=None
+):
+    """Merge BAM files using samtools merge, as for samtools_merge()
     
     Parameters
     ----------
@@ -1030,31 +7783,71 @@ def samtools_merge(*bams, temp_dir=None):
         Variable number of paths to BAM files on disk or BAM files as bytes
         objects (the two can be mixed)
     temp_dir
-        directory for tempoarary files
+        directory for temporary copies of inputs in memory that are not fed
+        through pipes (see spill_merge_inputs())
+    stdout
+        destination for the merged BAM data
+    threads : int
+        total threads for samtools merge
+    index_path : str
+        If set, build an index here during the merge
+    log : file object
+        File object to which stderr of samtools will be written
+    fan_in : int
+        maximum number of inputs for each samtools merge
+    compression_level : int
+        compression level of the merged BAM data
     
     Returns
     -------
     bytes
-        A BAM file in memory
-    """
-    
-    bam_file_paths = []
-    temp_files = []
-    for bam in bams:
-        if isinstance(bam, str):
-            bam_file_paths.append(bam)
-        elif isinstance(bam, bytes):
-            temp = tempfile.NamedTemporaryFile(dir=temp_dir)
-            temp.write(bam)
-            temp_files.append(temp)
-            bam_file_paths.append(temp.name)
-    with subprocess.Popen(
-        ['samtools', 'merge', '-'] + bam_file_paths,
-        stdout=subprocess.PIPE
-    ) as samtools_merge:
-        bam, _ = samtools_merge.communicate()
-    for temp in temp_files:
-        temp.close()
+        A BAM file in memory, or None if stdout is not subprocess.PIPE
+    """
+    
+    with tempfile.TemporaryDirectory(dir=temp_dir) as spill_dir:
+        commands = plan_merge(
+            await asyncio.to_thread(spill_merge_inputs, bams, spill_dir),
+            threads=threads,
+            output=(
+                compression_options(compression_level)
+                + merge_output(stdout, index_path)
+            ),
+            fan_in=fan_in
+        )
+        processes, feeds = [], []
+        try:
+            for args, pipe, pass_fds, command_feeds in commands:
+                feeds.extend(command_feeds)
+                processes.append(
+                    await asyncio.create_subprocess_exec(
+                        *args,
+                        stdout=(
+                            pipe if pipe is not None
+                            else subprocess.DEVNULL if index_path
+                            else stdout
+                        ),
+                        stderr=log,
+                        pass_fds=pass_fds
+                    )
+                )
+        except BaseException:
+            commands.close()
+            for process in processes:
+                process.kill()
+            for fd, _ in feeds:
+                os.close(fd)
+            raise
+        writers = start_feeds(feeds)
+        bam, _ = await processes[-1].communicate()
+        for process in processes:
+            await process.wait()
+        for writer in writers:
+            await asyncio.to_thread(writer.join)
+    for process in processes:
+        if process.returncode:
+            raise AlignmentError(
+                f'samtools exited with status {process.returncode}'
+            )
     return bam
 
 
@@ -1076,7 +7869,63 @@ def to_bam(alignment):
     if isinstance(alignment, (bytes, str)):
         return alignment
     elif isinstance(alignment, SequenceAlignment):
-        return alignment.bam
+        bam = alignment.bam
+        return alignment.bam_storage.name if alignment.bam_storage else bam
+
+def merged_sort_state(sequence_alignments):
+    """Whether merged data will be sorted, and the format for its index
+    
+    Parameters
+    ----------
+    sequence_alignments
+        the inputs to a merge
+    
+    Returns
+    -------
+    tuple
+        True if every input is a sorted SequenceAlignment, and ``csi`` if any
+        input has a CSI index, otherwise ``bai``
+    """
+    
+    return (
+        all(
+            isinstance(sa, SequenceAlignment) and sa.is_sorted
+            for sa in sequence_alignments
+        ),
+        'csi' if any(
+            getattr(sa, 'index_format', None) == 'csi'
+            for sa in sequence_alignments
+        ) else 'bai'
+    )
+
+
+def merged_storage(sequence_alignments):
+    """Storage format and reference genome for merged data
+    
+    Parameters
+    ----------
+    sequence_alignments
+        the inputs to a merge
+    
+    Returns
+    -------
+    tuple
+        the storage_format and the reference_genome_path of the
+        SequenceAlignment inputs, each of which is ``bam`` or None
+        respectively unless all of them agree on it
+    """
+    
+    inputs = tuple(
+        sa for sa in sequence_alignments if isinstance(sa, SequenceAlignment)
+    )
+    storage_formats = {sa.storage_format for sa in inputs}
+    reference_genome_paths = {sa.reference_genome_path for sa in inputs}
+    return (
+        storage_formats.pop() if len(storage_formats) == 1 else 'bam',
+        reference_genome_paths.pop() if len(reference_genome_paths) == 1
+        else None
+    )
+
 
 def merge(
     *sequence_alignments,
@@ -1085,12 +7934,19 @@ def merge(
     dedupper=None,
     processes=1,
     log=None,
-    temp_dir=None
+    temp_dir=None,
+    spill_threshold=None,
+    profiler=None,
+    compression_level=None
 ):
     """Merge SequenceAlignment objects
     
     Produces a new SequenceAlignment object with a merged bam attribute and
-    other parameters as provided
+    other parameters as provided. BAM data in memory is streamed to samtools
+    merge, which uses ``processes`` threads. If every input is sorted, the
+    merged data is marked as sorted and indexed during the merge. The
+    storage format and reference genome of the inputs are kept if they all
+    agree on them (see merged_storage()).
     
     Parameters
     ----------
@@ -1110,6 +7966,13 @@ def merge(
         File object to which logging information will be written
     temp_dir
         directory for tempoarary files
+    spill_threshold : int
+        Size in bytes above which the merged data is stored on disk
+    profiler : Profiler
+        If set, the merge is recorded as a stage
+    compression_level : int
+        Compression level of the merged BAM data, or None for the samtools
+        default
     
     Returns
     -------
@@ -1117,18 +7980,159 @@ def merge(
         A new SequenceAlignment object representing merged data
     """
     
-    return SequenceAlignment(
-        samtools_merge(
-            *(to_bam(sa) for sa in sequence_alignments),
-            temp_dir=temp_dir
-        ),
+    bams = tuple(to_bam(sa) for sa in sequence_alignments)
+    is_sorted, index_format = merged_sort_state(sequence_alignments)
+    with (
+        profiler.stage(
+            'merge',
+            bytes_in=sum(
+                os.path.getsize(bam) if isinstance(bam, str) else len(bam)
+                for bam in bams
+            )
+        ) if profiler else contextlib.nullcontext({})
+    ) as record:
+        if is_sorted:
+            merged_bam, index = capture_indexed_bam(
+                lambda stdout, index_path: samtools_merge(
+                    *bams,
+                    stdout=stdout,
+                    threads=processes,
+                    index_path=index_path,
+                    log=log,
+                    temp_dir=temp_dir,
+                    compression_level=compression_level
+                ),
+                index_format=index_format,
+                spill_threshold=spill_threshold,
+                temp_dir=temp_dir
+            )
+        else:
+            merged_bam, index = capture_bam(
+                lambda stdout: samtools_merge(
+                    *bams,
+                    stdout=stdout,
+                    threads=processes,
+                    log=log,
+                    temp_dir=temp_dir,
+                    compression_level=compression_level
+                ),
+                spill_threshold=spill_threshold,
+                temp_dir=temp_dir
+            ), None
+        record['bytes_out'] = len(merged_bam)
+    storage_format, reference_genome_path = merged_storage(
+        sequence_alignments
+    )
+    merged = SequenceAlignment(
+        merged_bam,
+        mapping_quality=mapping_quality,
+        processes=processes,
+        aligner=aligner,
+        dedupper=dedupper,
+        log=log,
+        temp_dir=temp_dir,
+        spill_threshold=spill_threshold,
+        profiler=profiler,
+        storage_format=storage_format,
+        reference_genome_path=reference_genome_path
+    )
+    merged.is_sorted = is_sorted
+    if index:
+        merged.index, merged.index_format = index, index_format
+    return merged
+
+
+async def merge_async(
+    *sequence_alignments,
+    mapping_quality=10,
+    aligner=None,
+    dedupper=None,
+    processes=1,
+    log=None,
+    temp_dir=None,
+    spill_threshold=None,
+    profiler=None,
+    compression_level=None
+):
+    """Merge SequenceAlignment objects without blocking the event loop, as
+    for merge()
+    
+    Parameters
+    ----------
+    *sequence_alignments
+        One or more SequenceAlignment objects
+    **kwargs
+        parameters for the merged SequenceAlignment, as for merge()
+    
+    Returns
+    -------
+    SequenceAlignment
+        A new SequenceAlignment object representing merged data
+    """
+    
+    for sa in sequence_alignments:
+        if isinstance(sa, SequenceAlignment):
+            await sa.bam_async()
+    bams = tuple(to_bam(sa) for sa in sequence_alignments)
+    is_sorted, index_format = merged_sort_state(sequence_alignments)
+    with (
+        profiler.stage(
+            'merge_async',
+            bytes_in=sum(
+                os.path.getsize(bam) if isinstance(bam, str) else len(bam)
+                for bam in bams
+            )
+        ) if profiler else contextlib.nullcontext({})
+    ) as record:
+        if is_sorted:
+            merged_bam, index = await capture_indexed_bam_async(
+                lambda stdout, index_path: samtools_merge_async(
+                    *bams,
+                    stdout=stdout,
+                    threads=processes,
+                    index_path=index_path,
+                    log=log,
+                    temp_dir=temp_dir,
+                    compression_level=compression_level
+                ),
+                index_format=index_format,
+                spill_threshold=spill_threshold,
+                temp_dir=temp_dir
+            )
+        else:
+            merged_bam, index = await capture_bam_async(
+                lambda stdout: samtools_merge_async(
+                    *bams,
+                    stdout=stdout,
+                    threads=processes,
+                    log=log,
+                    temp_dir=temp_dir,
+                    compression_level=compression_level
+                ),
+                spill_threshold=spill_threshold,
+                temp_dir=temp_dir
+            ), None
+        record['bytes_out'] = len(merged_bam)
+    storage_format, reference_genome_path = merged_storage(
+        sequence_alignments
+    )
+    merged = SequenceAlignment(
+        merged_bam,
         mapping_quality=mapping_quality,
         processes=processes,
         aligner=aligner,
         dedupper=dedupper,
         log=log,
-        temp_dir=temp_dir
+        temp_dir=temp_dir,
+        spill_threshold=spill_threshold,
+        profiler=profiler,
+        storage_format=storage_format,
+        reference_genome_path=reference_genome_path
     )
+    merged.is_sorted = is_sorted
+    if index:
+        merged.index, merged.index_format = index, index_format
+    return merged
 
 
 def trim_galore(reads1, reads2, output):